@@ -2,4 +2,4 @@
 
 mimic drop-json --input-json $1 --output-path config.json
 cat config.json
-mimic log-odds run-batch-infer-partition config.json
\ No newline at end of file
+mimic log-odds run-batch-infer-worker config.json
\ No newline at end of file
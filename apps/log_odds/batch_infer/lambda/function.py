@@ -4,6 +4,30 @@ from copy import copy
 
 import boto3
 
+def submit_planned(client, event, base_config, job_queue, job_definition, name):
+    # with a plan every split is a single array job whose children
+    # pick their partition of the plan from their array index
+    for train in [True, False]:
+        total_partitions = event['train_partitions'] if train else event['test_partitions']
+        config = copy(base_config)
+        config['train'] = train
+
+        command = json.dumps(config).replace(' ', '')
+        job = {
+            "jobName": f"{job_definition}-{name}-{train}",
+            "jobQueue": job_queue,
+            "jobDefinition": job_definition,
+            "containerOverrides": {
+                "command": [
+                    command
+                ]
+            },
+        }
+        # array jobs need at least two children
+        if total_partitions > 1:
+            job["arrayProperties"] = {"size": total_partitions}
+        client.submit_job(**job)
+
 def handler(event, context):
     client = boto3.client('batch', 'us-east-1')
 
@@ -12,15 +36,26 @@ def handler(event, context):
 
     upload_table = event['upload_table'].replace('_', '-')
     
+    # each job scores a contiguous range of partitions
+    # so the model is only loaded once per range
+    partitions_per_job = event.get('partitions_per_job', 1)
+
     base_config = copy(event)
     del base_config['train_partitions']
     del base_config['test_partitions']
+    base_config.pop('partitions_per_job', None)
+    if 'plan' in event:
+        submit_planned(client, event, base_config, job_queue, job_definition, upload_table)
+        return {
+            'statusCode': 200
+        }
+
     for train in [True, False]:
         total_partitions = event['train_partitions'] if train else event['test_partitions']
-        for partition in range(total_partitions):
+        for partition in range(0, total_partitions, partitions_per_job):
             config = copy(base_config)
             config['train'] = train
-            config['partition'] = partition
+            config['partition_range'] = [partition, min(partition + partitions_per_job, total_partitions)]
             config['total_partitions'] = total_partitions
 
             command = json.dumps(config).replace(' ', '')
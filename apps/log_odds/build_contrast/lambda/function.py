@@ -4,6 +4,30 @@ from copy import copy
 
 import boto3
 
+def submit_planned(client, event, base_config, job_queue, job_definition, name):
+    # with a plan every split is a single array job whose children
+    # pick their partition of the plan from their array index
+    for train in [True, False]:
+        total_partitions = event['train_partitions'] if train else event['test_partitions']
+        config = copy(base_config)
+        config['train'] = train
+
+        command = json.dumps(config).replace(' ', '')
+        job = {
+            "jobName": f"{job_definition}-{name}-{train}",
+            "jobQueue": job_queue,
+            "jobDefinition": job_definition,
+            "containerOverrides": {
+                "command": [
+                    command
+                ]
+            },
+        }
+        # array jobs need at least two children
+        if total_partitions > 1:
+            job["arrayProperties"] = {"size": total_partitions}
+        client.submit_job(**job)
+
 def handler(event, context):
     client = boto3.client('batch', 'us-east-1')
 
@@ -15,6 +39,12 @@ def handler(event, context):
     base_config = copy(event)
     del base_config['train_partitions']
     del base_config['test_partitions']
+    if 'plan' in event:
+        submit_planned(client, event, base_config, job_queue, job_definition, dataset)
+        return {
+            'statusCode': 200
+        }
+
     for train in [True, False]:
         total_partitions = event['train_partitions'] if train else event['test_partitions']
         for partition in range(total_partitions):
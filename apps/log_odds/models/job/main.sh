@@ -1,3 +1,3 @@
 #!/bin/bash
 
-mimic log-odds run-train-model $1 $2
\ No newline at end of file
+mimic log-odds run-train-model "$@"
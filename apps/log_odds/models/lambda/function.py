@@ -5,6 +5,33 @@ from copy import copy
 
 import boto3
 
+def list_objects(s3, bucket, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [
+        content
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for content in page.get('Contents', [])
+    ]
+
+def fingerprints(s3, experiment_name, dataset):
+    # run ids hash these as well so that editing layers.py or
+    # rebuilding the dataset retrains runs whose config is unchanged
+    response = s3.get_object(Bucket="mimic-log-odds-models", Key=f"{experiment_name}/layers.py")
+    layers = hashlib.sha256(response['Body'].read()).hexdigest()
+    shards = sorted(
+        f"{content['Key']}:{content['ETag']}"
+        for content in list_objects(s3, "mimic-log-odds-tfrecords", f"{dataset}/")
+    )
+    dataset = hashlib.sha256("\n".join(shards).encode("utf-8")).hexdigest()
+    return {"layers": layers, "dataset": dataset}
+
+def completed_runs(s3, experiment_name):
+    return {
+        content['Key'].split('/')[-2]
+        for content in list_objects(s3, "mimic-log-odds-models", f"{experiment_name}/")
+        if content['Key'].endswith('/complete.json')
+    }
+
 def handler(event, context):
     client = boto3.client('batch', 'us-east-1')
 
@@ -18,28 +45,45 @@ def handler(event, context):
     response = s3.get_object(Bucket="mimic-log-odds-models", Key=config_key)
     config = json.loads(response['Body'].read().decode('utf-8'))
 
+    # runs of an experiment share their dataset so group_size of them
+    # can be trained by a single job, these are popped before hashing
+    # so grouping never changes a run_id
+    group_size = config.pop("group_size", 1)
+    group_order = config.pop("group_order", "sequential")
+
+    config["fingerprints"] = fingerprints(s3, experiment_name, config["dataset"])
+    force = event.get("force", False)
+    completed = set() if force else completed_runs(s3, experiment_name)
+
+    run_ids = []
     for model in config["models"]:
         run_config = copy(config)
         run_config["model"] = model
         del run_config["models"]
         run_id = hashlib.sha256(json.dumps(run_config, sort_keys=True).encode("utf-8")).hexdigest()
+        if run_id in completed:
+            continue
         run_config["run_id"] = run_id
         key = f"{experiment_name}/{run_id}/config.json"
         s3.put_object(Bucket="mimic-log-odds-models", Key=key, Body=json.dumps(run_config))
+        run_ids.append(run_id)
 
+    for start in range(0, len(run_ids), group_size):
+        group = run_ids[start:start + group_size]
+        options = ["--order", group_order] if len(group) > 1 else []
+        if force:
+            options.append("--force")
         client.submit_job(
-            jobName=f"{job_definition}-{experiment_name}-{run_id}",
+            jobName=f"{job_definition}-{experiment_name}-{group[0]}",
             jobQueue=job_queue,
             jobDefinition=job_definition,
             containerOverrides={
-                "command": [
-                    experiment_name, run_id
-                ]
+                "command": options + [experiment_name] + group
             }
         )
 
-
-
     return {
-        'statusCode': 200
+        'statusCode': 200,
+        'submitted': len(run_ids),
+        'skipped': len(config["models"]) - len(run_ids),
     }
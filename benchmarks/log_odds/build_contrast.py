@@ -0,0 +1,101 @@
+"""
+Compares the NumPy contrast sampling engine against the original
+groupby().sample() implementation, in time and peak traced memory.
+
+    python benchmarks/log_odds/build_contrast.py --individuals 20000
+"""
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+
+from mimic.log_odds.build_contrast import build_contrast
+
+
+def legacy_build_contrast(data, decisions_per_individual, alternatives_per_decision):
+    selections = (
+        data[data['_selected']].groupby('_individual')
+        .sample(n=decisions_per_individual, replace=True)
+    )
+    alternatives = (
+        data[~data['_selected']].groupby(['_individual', '_decision'])
+        .sample(n=alternatives_per_decision, replace=True)
+    )
+    alternatives = selections[['_individual', '_decision']].merge(
+        alternatives, on=['_individual', '_decision'], how='inner'
+    )
+    selections = pd.concat([selections] * alternatives_per_decision)
+    selections = (
+        selections.sort_values(['_individual', '_decision'])
+        .reset_index(drop=True).reset_index()
+        .rename(columns={'index': '_decision', '_decision': '_old_decision'})
+    )
+    alternatives = (
+        alternatives.sort_values(['_individual', '_decision'])
+        .reset_index(drop=True).reset_index()
+        .rename(columns={'index': '_decision', '_decision': '_old_decision'})
+    )
+    return (
+        pd.concat([selections, alternatives])
+        .reset_index(drop=True).reset_index()
+        .rename(columns={'index': '_choice', '_choice': '_old_choice'})
+    )
+
+
+def make_source(individuals, decisions_per_individual, choices, n_features, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = individuals * decisions_per_individual * choices
+    decision = np.arange(rows) // choices
+    data = pd.DataFrame({
+        '_individual': decision // decisions_per_individual,
+        '_decision': decision,
+        '_choice': np.arange(rows),
+        '_selected': np.arange(rows) % choices == 0,
+        '_train': True,
+    })
+    for j in range(n_features):
+        data[f"feature{j}"] = rng.random(rows)
+    return data.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+@click.command()
+@click.option('--individuals', default=5000, show_default=True)
+@click.option('--source-decisions', default=10, show_default=True)
+@click.option('--choices', default=8, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--decisions-per-individual', default=5, show_default=True)
+@click.option('--alternatives-per-decision', default=4, show_default=True)
+def main(individuals, source_decisions, choices, n_features, decisions_per_individual, alternatives_per_decision):
+    data = make_source(individuals, source_decisions, choices, n_features)
+    print(f"{len(data)} source rows, {data.memory_usage(deep=True).sum() / 1e6:.0f}MB")
+
+    contrast, seconds, peak = measure(
+        build_contrast, data, decisions_per_individual, alternatives_per_decision, np.random.default_rng(0)
+    )
+    print(f"numpy:  {seconds:.3f}s, peak {peak:.0f}MB, {len(contrast)} rows")
+
+    expected, legacy_seconds, legacy_peak = measure(
+        legacy_build_contrast, data, decisions_per_individual, alternatives_per_decision
+    )
+    print(
+        f"legacy: {legacy_seconds:.3f}s, peak {legacy_peak:.0f}MB, {len(expected)} rows "
+        f"({legacy_seconds / seconds:.1f}x slower)"
+    )
+    assert len(contrast) == len(expected)
+    assert list(contrast.columns) == list(expected.columns)
+
+
+if __name__ == '__main__':
+    main()
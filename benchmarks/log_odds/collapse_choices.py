@@ -0,0 +1,98 @@
+"""
+Compares the columnar collapse_choices engine against the original
+groupby/iterrows implementation on synthetic choice data.
+
+    python benchmarks/log_odds/collapse_choices.py --decisions 20000
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from mimic.log_odds.build_tfrecord import collapse_choices
+
+
+def legacy_collapse_choices_row(max_choices, features, missing_values_map, group):
+    new_row = {}
+    for i, (_, row) in enumerate(group.iterrows()):
+        for feature in features:
+            if row['_selected']:
+                new_row['_selected'] = i
+            new_row[f"{feature}_{i}"] = row[feature]
+
+    if i < max_choices - 1:
+        for j in range(i + 1, max_choices):
+            for feature in features:
+                new_row[f"{feature}_{j}"] = missing_values_map[feature]
+
+    return pd.DataFrame([new_row])
+
+
+def legacy_collapse_choices(max_choices, features, missing_values_map, dataframe):
+    collapsed = (
+        dataframe.groupby(['_decision', '_individual'])
+        .apply(
+            lambda g: legacy_collapse_choices_row(
+                max_choices,
+                features,
+                missing_values_map,
+                g
+            )
+        )
+        .reset_index()
+    )
+    return collapsed[[c for c in collapsed.columns if c != 'level_2']]
+
+
+def make_choices(decisions, max_choices, n_features, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, max_choices + 1, size=decisions)
+    decision = np.repeat(np.arange(decisions), sizes)
+    position = np.arange(len(decision)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    chosen = np.repeat(rng.integers(0, sizes), sizes)
+    data = pd.DataFrame({
+        '_individual': decision % 97,
+        '_decision': decision,
+        '_selected': position == chosen,
+    })
+    for j in range(n_features):
+        data[f"feature{j}"] = rng.random(len(data))
+    return data.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+@click.command()
+@click.option('--decisions', default=5000, show_default=True)
+@click.option('--max-choices', default=12, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--skip-legacy', is_flag=True, help="only time the new engine")
+def main(decisions, max_choices, n_features, skip_legacy):
+    data = make_choices(decisions, max_choices, n_features)
+    features = [f"feature{j}" for j in range(n_features)]
+    missing_values_map = {feature: -1.0 for feature in features}
+    print(f"{len(data)} choice rows, {decisions} decisions")
+
+    start = time.perf_counter()
+    result = collapse_choices(max_choices, features, missing_values_map, data)
+    columnar = time.perf_counter() - start
+    print(f"columnar: {columnar:.3f}s")
+
+    if skip_legacy:
+        return
+
+    start = time.perf_counter()
+    expected = legacy_collapse_choices(max_choices, features, missing_values_map, data)
+    legacy = time.perf_counter() - start
+    print(f"legacy:   {legacy:.3f}s ({legacy / columnar:.1f}x slower)")
+
+    assert_frame_equal(
+        result[expected.columns].reset_index(drop=True),
+        expected.reset_index(drop=True),
+        check_dtype=False,
+    )
+    print("outputs match")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares training steps per second of the stacked model with and without
+XLA (config["model"]["jit_compile"]) and the accuracy and size of the
+numpy export at every precision, on synthetic data.
+
+    python benchmarks/log_odds/compile.py --individuals 2000 --epochs 3
+"""
+import os
+import tempfile
+import time
+
+import click
+import keras
+import numpy as np
+from tensorflow.keras.layers import Dense
+
+from mimic.log_odds.build_model import STACKED_LAYERS, build_export_model, build_stacked_model, export_numpy_model
+from mimic.log_odds.build_tfrecord import collapse_choices_arrays
+from mimic.log_odds.numpy_model import PRECISIONS, NumpyModel
+from mimic.log_odds.synthetic import feature_names, make_choices
+
+
+class StepTimer(keras.callbacks.Callback):
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds = time.perf_counter() - self.start
+
+
+def make_layers():
+    return [Dense(16, activation='relu'), Dense(32, activation='relu'), Dense(16, activation='relu')]
+
+
+def choice_accuracy(scores, selected, n_choices):
+    """
+    Returns the fraction of decisions whose selected choice has the
+    highest score among the real choices of the decision
+    """
+    slots = np.arange(scores.shape[1])
+    scores = np.where(slots < n_choices[:, None], scores, -np.inf)
+    return float(np.mean(scores.argmax(axis=1) == selected))
+
+
+@click.command()
+@click.option('--individuals', default=1000, show_default=True)
+@click.option('--decisions', default=10, show_default=True, help="decisions per individual")
+@click.option('--max-choices', default=12, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--epochs', default=3, show_default=True, help="the first epoch is not timed")
+def main(individuals, decisions, max_choices, n_features, batch_size, epochs):
+    features = feature_names(n_features)
+    data = make_choices(individuals, decisions, max_choices, n_features)
+    _, values, selected, n_choices = collapse_choices_arrays(
+        max_choices, features, {feature: 0.0 for feature in features}, data,
+    )
+    inputs = {
+        'inputs': values.astype(np.float32),
+        'mask': (np.arange(max_choices) < n_choices[:, None]).astype(np.float32),
+    }
+    labels = np.eye(max_choices, dtype=np.float32)[selected]
+    steps = int(np.ceil(len(values) / batch_size))
+
+    models = {}
+    for jit_compile in [False, True]:
+        keras.utils.set_random_seed(0)
+        model, _ = build_stacked_model({'model': {'jit_compile': jit_compile}}, max_choices, features, make_layers())
+        timer = StepTimer()
+        model.fit(inputs, labels, batch_size=batch_size, epochs=1, verbose=0)
+        seconds = []
+        for _ in range(epochs - 1):
+            model.fit(inputs, labels, batch_size=batch_size, epochs=1, verbose=0, callbacks=[timer])
+            seconds.append(timer.seconds)
+        models[jit_compile] = model
+        print(f"jit_compile={str(jit_compile):5s} {steps / min(seconds):8.0f} steps/s")
+
+    export = build_export_model(
+        features, [layer for layer in models[True].layers if not isinstance(layer, STACKED_LAYERS)],
+    )
+    flat = inputs['inputs'].reshape(-1, n_features)
+    expected = export.predict(flat, batch_size=10000, verbose=0).reshape(len(values), max_choices)
+    print(f"{'keras':8s} accuracy {choice_accuracy(expected, selected, n_choices):.4f}")
+    with tempfile.TemporaryDirectory() as directory:
+        for precision in PRECISIONS:
+            path = os.path.join(directory, f'{precision}.npz')
+            export_numpy_model(export, path, precision)
+            scores = NumpyModel.load(path).predict(flat).reshape(len(values), max_choices)
+            print(
+                f"{precision:8s} accuracy {choice_accuracy(scores, selected, n_choices):.4f} "
+                f"max error {np.abs(scores - expected).max():.2e} "
+                f"size {os.path.getsize(path) / 1e3:.1f}KB"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares epoch times of the stacked model reading synthetic tfrecords
+with each load_data cache mode. Epoch 1 parses (and caches) the records,
+later epochs read the cached tensors. The disk mode is run twice to show
+a second run starting from the snapshot left by the first.
+
+    python benchmarks/log_odds/data_cache.py --individuals 5000 --epochs 4
+"""
+import os
+import tempfile
+import time
+
+import click
+import keras
+from tensorflow.keras.layers import Dense
+
+from mimic.log_odds.build_model import build_stacked_model, load_data
+from mimic.log_odds.build_tfrecord import collapse_choices_arrays, record_features, write_tfrecord_shards
+from mimic.log_odds.synthetic import feature_names, make_choices
+
+
+class EpochTimer(keras.callbacks.Callback):
+    def on_train_begin(self, logs=None):
+        self.seconds = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds.append(time.perf_counter() - self.start)
+
+
+@click.command()
+@click.option('--individuals', default=2000, show_default=True)
+@click.option('--decisions', default=10, show_default=True, help="decisions per individual")
+@click.option('--max-choices', default=12, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--layout', default='columns', type=click.Choice(['columns', 'packed']), show_default=True)
+@click.option('--epochs', default=4, show_default=True)
+def main(individuals, decisions, max_choices, n_features, batch_size, layout, epochs):
+    features = feature_names(n_features)
+    data = make_choices(individuals, decisions, max_choices, n_features)
+    _, values, selected, n_choices = collapse_choices_arrays(
+        max_choices, features, {feature: 0.0 for feature in features}, data,
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = os.path.join(directory, 'tfrecords')
+        os.makedirs(data_dir)
+        write_tfrecord_shards(*record_features(features, values, selected, layout, n_choices), os.path.join(data_dir, 'data'))
+        cache_dir = os.path.join(directory, 'cache')
+
+        for name, cache in [('none', None), ('memory', 'memory'), ('disk', 'disk'), ('disk again', 'disk')]:
+            train = load_data(
+                data_dir, max_choices, features, batch_size, batch_size * 10,
+                layout=layout, stacked=True, cache=cache, cache_dir=cache_dir,
+            )
+            model, _ = build_stacked_model(
+                {'model': {}}, max_choices, features, [Dense(16, activation='relu'), Dense(16, activation='relu')],
+            )
+            timer = EpochTimer()
+            model.fit(train, epochs=epochs, verbose=0, callbacks=[timer])
+            later = sum(timer.seconds[1:]) / max(len(timer.seconds) - 1, 1)
+            print(f"{name:12s} epoch 1 {timer.seconds[0]:7.2f}s  epochs 2+ {later:7.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares scoring an exported model with NumpyModel against keras.
+
+    python benchmarks/log_odds/infer_backend.py --rows 1000000
+"""
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+
+
+@click.command()
+@click.option('--rows', default=200000, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--batch-size', default=1024, show_default=True)
+def main(rows, n_features, batch_size):
+    start = time.perf_counter()
+    from mimic.log_odds.numpy_model import NumpyModel
+    print(f"numpy import: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    from tensorflow.keras.layers import Dense
+    from mimic.log_odds.build_model import build_export_model, export_numpy_model
+    print(f"tensorflow import: {time.perf_counter() - start:.2f}s")
+
+    features = [f"feature{j}" for j in range(n_features)]
+    layers = [Dense(16, activation='relu'), Dense(32, activation='relu'), Dense(16, activation='relu'), Dense(1)]
+    model = build_export_model(features, layers)
+    x = np.random.default_rng(0).random((rows, n_features)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.npz')
+        export_numpy_model(model, path)
+        numpy_model = NumpyModel.load(path)
+
+    start = time.perf_counter()
+    expected = model.predict(x, batch_size=batch_size, verbose=0)
+    keras_seconds = time.perf_counter() - start
+    print(f"keras: {1e6 * keras_seconds / rows:.3f} us/row")
+
+    start = time.perf_counter()
+    result = numpy_model.predict(x, batch_size=batch_size)
+    numpy_seconds = time.perf_counter() - start
+    print(f"numpy: {1e6 * numpy_seconds / rows:.3f} us/row ({keras_seconds / numpy_seconds:.1f}x faster)")
+    print(f"max abs difference: {np.abs(result - expected).max():.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares wide to long reshaping through a single block against the
+original per slot copy and concat of expand_choices, in time and peak
+traced memory.
+
+    python benchmarks/log_odds/reshape.py --decisions 200000 --max-choices 30
+"""
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+
+from mimic.log_odds.batch_infer import expand_choices
+
+
+def legacy_expand_choices(max_choices, data, features):
+    columns_to_expand = features + ['_choice', 'probability']
+    dataframes = []
+    for i in range(max_choices):
+        collapsed_columns = [f"{col}_{i}" for col in columns_to_expand]
+        dataframe = data[collapsed_columns + ['_individual', '_decision']].copy()
+        dataframe = dataframe.rename(columns=dict(zip(collapsed_columns, columns_to_expand)))
+        dataframes.append(dataframe)
+    return pd.concat(dataframes)
+
+
+def make_wide(decisions, max_choices, n_features, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        '_individual': np.arange(decisions) % 97,
+        '_decision': np.arange(decisions),
+    }
+    for i in range(max_choices):
+        for j in range(n_features):
+            columns[f"feature{j}_{i}"] = rng.random(decisions)
+        columns[f"_choice_{i}"] = np.arange(decisions) * max_choices + i
+        columns[f"probability_{i}"] = rng.random(decisions)
+    return pd.DataFrame(columns)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+@click.command()
+@click.option('--decisions', default=100000, show_default=True)
+@click.option('--max-choices', default=30, show_default=True)
+@click.option('--features', 'n_features', default=8, show_default=True)
+def main(decisions, max_choices, n_features):
+    data = make_wide(decisions, max_choices, n_features)
+    features = [f"feature{j}" for j in range(n_features)]
+    print(f"{decisions} decisions, {data.memory_usage(deep=True).sum() / 1e6:.0f}MB wide")
+
+    result, seconds, peak = measure(expand_choices, max_choices, data, features)
+    print(f"block:  {seconds:.3f}s, peak {peak:.0f}MB")
+
+    expected, legacy_seconds, legacy_peak = measure(legacy_expand_choices, max_choices, data, features)
+    print(f"legacy: {legacy_seconds:.3f}s, peak {legacy_peak:.0f}MB ({legacy_seconds / seconds:.1f}x slower)")
+
+    expected = expected.sort_values(['_decision', '_choice']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+    print("outputs match")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Times and memory profiles every stage of the log odds pipeline on
+synthetic data, offline. Results can be saved as a JSON baseline and
+later runs compared against it, failing when a stage is slower or uses
+more memory than the baseline allows.
+
+    python benchmarks/log_odds/suite.py --individuals 2000 --output baseline.json
+    python benchmarks/log_odds/suite.py --individuals 2000 --baseline baseline.json
+
+Time is the best of `--repeats` untraced runs and memory is the peak
+traced by tracemalloc over one more run (allocations made inside
+tensorflow's runtime are not traced).
+"""
+import os
+import json
+import tempfile
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from mimic.log_odds.build_contrast import build_contrast
+from mimic.log_odds.build_tfrecord import collapse_choices_arrays, record_features, write_tfrecord_shards
+from mimic.log_odds.batch_infer import infer
+from mimic.log_odds.numpy_model import NumpyModel
+from mimic.log_odds.synthetic import feature_names, make_choices
+
+STAGES = ['collapse', 'write_tfrecord', 'load_data', 'train', 'infer', 'contrast']
+
+
+def measure(func, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": min(seconds),
+        "peak_mb": peak / 1e6,
+        "rows": rows,
+        "rows_per_second": rows / min(seconds) if min(seconds) else 0.0,
+    }
+
+
+def make_stages(params, directory):
+    """
+    Returns the stage name to benchmark function map, each function
+    returns the number of rows it processed
+    """
+    max_choices, layout = params['max_choices'], params['layout']
+    features = feature_names(params['features'])
+    data = make_choices(
+        params['individuals'], params['decisions'], max_choices, params['features'], seed=params['seed'],
+    )
+    missing_values_map = {feature: 0.0 for feature in features}
+    _, values, selected, n_choices = collapse_choices_arrays(max_choices, features, missing_values_map, data)
+    data_dir = os.path.join(directory, 'tfrecords')
+    os.makedirs(data_dir)
+    write_tfrecord_shards(*record_features(features, values, selected, layout, n_choices), os.path.join(data_dir, 'data'))
+
+    def collapse():
+        collapse_choices_arrays(max_choices, features, missing_values_map, data)
+        return len(data)
+
+    def write_tfrecord():
+        paths = write_tfrecord_shards(
+            *record_features(features, values, selected, layout, n_choices),
+            os.path.join(directory, 'write'),
+        )
+        for path in paths:
+            os.remove(path)
+        return len(values)
+
+    def dataset():
+        from mimic.log_odds.build_model import load_data
+        return load_data(
+            data_dir, max_choices, features, params['batch_size'], params['batch_size'] * 10,
+            layout=layout, stacked=True,
+        )
+
+    def load():
+        for _ in dataset():
+            pass
+        return len(values)
+
+    model = None
+
+    def train():
+        nonlocal model
+        if model is None:
+            from tensorflow.keras.layers import Dense
+            from mimic.log_odds.build_model import build_stacked_model
+            layers = [Dense(16, activation='relu'), Dense(16, activation='relu')]
+            model, _ = build_stacked_model({'model': {}}, max_choices, features, layers)
+        model.fit(dataset(), epochs=1, verbose=0)
+        return len(values)
+
+    rng = np.random.default_rng(params['seed'])
+    scorer = NumpyModel([
+        (rng.normal(size=(len(features), 16)).astype(np.float32), np.zeros(16, dtype=np.float32), 'relu'),
+        (rng.normal(size=(16, 1)).astype(np.float32), np.zeros(1, dtype=np.float32), 'linear'),
+    ])
+
+    def score():
+        infer(scorer, data.copy(), features, batch_size=params['batch_size'] * 100)
+        return len(data)
+
+    def contrast():
+        build_contrast(data, 5, 4, np.random.default_rng(params['seed']))
+        return len(data)
+
+    return {
+        'collapse': collapse,
+        'write_tfrecord': write_tfrecord,
+        'load_data': load,
+        'train': train,
+        'infer': score,
+        'contrast': contrast,
+    }
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """
+    Returns a list describing every stage that regressed beyond
+    the tolerances (fractions of the baseline value)
+    """
+    if results['params'] != baseline['params']:
+        raise click.UsageError("the baseline was recorded with different parameters")
+    regressions = []
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for metric, tolerance in [('seconds', time_tolerance), ('peak_mb', memory_tolerance)]:
+            limit = baseline['stages'][stage][metric] * (1 + tolerance)
+            if result[metric] > limit:
+                regressions.append(f"{stage} {metric}: {result[metric]:.3f} > {limit:.3f}")
+    return regressions
+
+
+@click.command()
+@click.option('--individuals', default=1000, show_default=True)
+@click.option('--decisions', default=10, show_default=True, help="decisions per individual")
+@click.option('--max-choices', default=12, show_default=True)
+@click.option('--features', default=6, show_default=True)
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--layout', default='columns', type=click.Choice(['columns', 'packed']), show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--stage', 'stages', multiple=True, type=click.Choice(STAGES), help="defaults to every stage")
+@click.option('--repeats', default=3, show_default=True)
+@click.option('--output', default=None, help="write the results to this JSON file")
+@click.option('--baseline', default=None, help="compare against the results in this JSON file")
+@click.option('--time-tolerance', default=0.25, show_default=True)
+@click.option('--memory-tolerance', default=0.10, show_default=True)
+def main(
+    individuals, decisions, max_choices, features, batch_size, layout, seed,
+    stages, repeats, output, baseline, time_tolerance, memory_tolerance,
+):
+    params = {
+        'individuals': individuals, 'decisions': decisions, 'max_choices': max_choices,
+        'features': features, 'batch_size': batch_size, 'layout': layout, 'seed': seed,
+    }
+    results = {'params': params, 'stages': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = make_stages(params, directory)
+        for stage in stages or STAGES:
+            result = measure(benchmarks[stage], repeats)
+            results['stages'][stage] = result
+            print(
+                f"{stage:15s} {result['seconds']:8.3f}s {result['peak_mb']:8.1f}MB "
+                f"{result['rows_per_second']:12.0f} rows/s"
+            )
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if baseline:
+        with open(baseline, 'r') as f:
+            regressions = compare(results, json.load(f), time_tolerance, memory_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("no regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares training step time of the per-choice tower model (build_model)
+against the shared tower model (build_stacked_model).
+
+    python benchmarks/log_odds/train_step.py --max-choices 24
+"""
+import time
+
+import click
+import numpy as np
+from tensorflow.keras.layers import Dense
+
+from mimic.log_odds.build_model import build_model, build_stacked_model
+
+
+def make_layers():
+    return [Dense(16, activation='relu'), Dense(32, activation='relu'), Dense(16, activation='relu')]
+
+
+def time_steps(model, inputs, labels, steps):
+    model.train_on_batch(inputs, labels)
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.train_on_batch(inputs, labels)
+    return (time.perf_counter() - start) / steps
+
+
+@click.command()
+@click.option('--max-choices', default=24, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--steps', default=50, show_default=True)
+def main(max_choices, n_features, batch_size, steps):
+    config = {'model': {}}
+    features = [f"feature{j}" for j in range(n_features)]
+    rng = np.random.default_rng(0)
+    values = rng.random((batch_size, max_choices, n_features)).astype(np.float32)
+    labels = np.eye(max_choices)[rng.integers(0, max_choices, size=batch_size)]
+
+    model, _ = build_model(config, max_choices, features, make_layers())
+    towers = time_steps(
+        model, {f"input_{i}": values[:, i] for i in range(max_choices)}, labels, steps
+    )
+    print(f"towers:  {1000 * towers:.2f} ms/step")
+
+    model, _ = build_stacked_model(config, max_choices, features, make_layers())
+    stacked = time_steps(
+        model, {"inputs": values, "mask": np.ones((batch_size, max_choices), dtype=np.float32)}, labels, steps
+    )
+    print(f"stacked: {1000 * stacked:.2f} ms/step ({towers / stacked:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares the bulk Example encoder against per-row serialize_row, and
+framing the records with TFRecordWriter against numpy. numpy framing
+only wins in spawned writers, where it saves importing tensorflow.
+
+    python benchmarks/log_odds/write_tfrecord.py --decisions 20000
+    python benchmarks/log_odds/write_tfrecord.py --decisions 2000 --processes 2
+"""
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from mimic.log_odds.shards import FRAMINGS, write_tfrecord_shards
+
+
+@click.command()
+@click.option('--decisions', default=20000, show_default=True)
+@click.option('--max-choices', default=12, show_default=True)
+@click.option('--features', 'n_features', default=6, show_default=True)
+@click.option('--processes', default=1, show_default=True)
+@click.option('--max-shard-bytes', default=None, type=int)
+@click.option('--per-row/--no-per-row', default=True, help="also time per-row serialize_row, slow for wide data")
+def main(decisions, max_choices, n_features, processes, max_shard_bytes, per_row):
+    # spawned shard writers re-import this script, so tensorflow
+    # is only imported here to keep it out of their start up
+    from mimic.log_odds.build_tfrecord import record_features, serialize_row
+
+    rng = np.random.default_rng(0)
+    features = [f"feature{j}" for j in range(n_features)]
+    values = rng.random((decisions, max_choices, n_features))
+    selected = rng.integers(0, max_choices, size=decisions)
+
+    timings = {}
+    for framing in FRAMINGS:
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            float_features, int_features = record_features(features, values, selected)
+            paths = write_tfrecord_shards(
+                float_features, int_features, os.path.join(directory, 'data'),
+                max_shard_bytes=max_shard_bytes, processes=processes, framing=framing,
+            )
+            timings[framing] = time.perf_counter() - start
+            size = sum(os.path.getsize(path) for path in paths)
+            print(f"bulk ({framing} framing): {timings[framing]:.3f}s, {len(paths)} shard(s), {size / 1e6:.1f} MB")
+    bulk = timings['tensorflow']
+    if not per_row:
+        return
+
+    columns = [f"{feature}_{i}" for i in range(max_choices) for feature in features]
+    frame = pd.DataFrame(values.reshape(decisions, -1), columns=columns)
+    frame['_selected'] = selected
+    start = time.perf_counter()
+    frame.apply(lambda row: serialize_row(max_choices, features, row), axis=1)
+    legacy = time.perf_counter() - start
+    ratio = f"{legacy / bulk:.2f}x slower" if legacy >= bulk else f"{bulk / legacy:.2f}x faster"
+    print(f"per-row: {legacy:.3f}s ({ratio} than tensorflow framing, serialization only)")
+
+
+if __name__ == '__main__':
+    main()
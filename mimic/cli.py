@@ -1,17 +1,23 @@
+import os
 import json
 
 import click
 import boto3
 
-from mimic.log_odds.build_tfrecord import build_tfrecord as log_odds_build_tfrecord
-from mimic.log_odds.build_model import (
-    setup_experiment,
-    pull_run_config,
-    pull_training_data,
-    train_model,
-)
 from mimic.log_odds.batch_infer import run_inference, clear_data
 from mimic.log_odds.build_contrast import build_contrast_func
+from mimic.log_odds.local import (
+    batch_infer_worker,
+    build_contrast_worker,
+    build_tfrecord_worker,
+    run_local,
+    worker_configs,
+)
+from mimic.log_odds.planner import plan_event, resolve_plan
+from mimic.log_odds.repartition import repartition as log_odds_repartition
+
+# the stages importing tensorflow are imported by their commands, so
+# that the others (and the numpy batch-infer workers) start quickly
 
 @click.group()
 def cli():
@@ -29,18 +35,52 @@ def drop_json(input_json, output_path):
 def log_odds():
     pass
 
+def launch_local(worker, config, processes, ranges=False):
+    failures = run_local(worker, worker_configs(config, ranges), processes)
+    for description, error in failures:
+        print(f"{description} failed:\n{error}")
+    if failures:
+        raise click.ClickException(
+            f"{len(failures)} partitions failed: {', '.join(description for description, _ in failures)}"
+        )
+
+local_option = click.option("--local", is_flag=True, help="run every partition on this machine instead of aws batch")
+processes_option = click.option("--processes", default=1, show_default=True, help="partitions run at once with --local")
+
 @log_odds.command()
 @click.argument("config_path", required=True)
 def build_tfrecord(config_path):
+    from mimic.log_odds.build_tfrecord import build_tfrecord as log_odds_build_tfrecord
+    from mimic.log_odds.manifest import resolve_manifest
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    log_odds_build_tfrecord(**resolve_manifest(resolve_plan(config)))
+
+@log_odds.command()
+@click.argument("config_path", required=True)
+def repartition(config_path):
     with open(config_path, "r") as f:
         config = json.load(f)
-    log_odds_build_tfrecord(**config)
+    log_odds_repartition(**config)
 
 @log_odds.command()
 @click.argument("config_path", required=True)
-def build_dataset(config_path):
+@local_option
+@processes_option
+def build_dataset(config_path, local, processes):
     with open(config_path, "r") as f:
         config = json.load(f)
+    if config.pop("plan_partitions", False):
+        config = plan_event(config, "tfrecords", config["dataset"], config["table"])
+    if config.pop("incremental", False):
+        from mimic.log_odds.manifest import incremental_event
+        config = incremental_event(config)
+        if not any(config["partitions"].values()):
+            print("every partition is up to date")
+            return
+    if local:
+        launch_local(build_tfrecord_worker, config, processes)
+        return
     client = boto3.client("lambda")
     client.invoke(
         FunctionName="mimic-log-odds-build-tfrecords",
@@ -51,7 +91,9 @@ def build_dataset(config_path):
 @log_odds.command()
 @click.argument("config_path", required=True)
 @click.argument("layers_path", required=True)
-def run_experiment(config_path, layers_path):
+@click.option("--force", is_flag=True, help="retrain runs that already completed")
+def run_experiment(config_path, layers_path, force):
+    from mimic.log_odds.build_model import setup_experiment
     setup_experiment(config_path, layers_path)
     with open(config_path, "r") as f:
         config = json.load(f)
@@ -61,16 +103,49 @@ def run_experiment(config_path, layers_path):
     client.invoke(
         FunctionName="mimic-log-odds-run-experiment",
         InvocationType="Event",
-        Payload=json.dumps({"experiment_name": experiment_name}),
+        Payload=json.dumps({"experiment_name": experiment_name, "force": force}),
     )
 
 @log_odds.command()
+@click.option("--order", type=click.Choice(["sequential", "round_robin"]), default="sequential", show_default=True)
+@click.option("--cache-records/--no-cache-records", default=None, help="defaults to caching when training several runs")
+@click.option("--force", is_flag=True, help="retrain runs that already completed")
 @click.argument("experiment_name", required=True)
-@click.argument("run_id", required=True)
-def run_train_model(experiment_name, run_id):
-    pull_run_config(experiment_name, run_id)
-    pull_training_data("config.json")
-    train_model("config.json")
+@click.argument("run_ids", nargs=-1, required=True)
+def run_train_model(order, cache_records, force, experiment_name, run_ids):
+    """
+    Trains one or more runs of an experiment in this process,
+    all of them reading the same (once downloaded) dataset
+    """
+    from mimic.log_odds.build_model import (
+        completed_runs,
+        pull_run_config,
+        pull_training_data,
+        train_models,
+    )
+    if not force:
+        completed = completed_runs(experiment_name)
+        for run_id in run_ids:
+            if run_id in completed:
+                print(f"skipping completed run {run_id}")
+        run_ids = [run_id for run_id in run_ids if run_id not in completed]
+        if not run_ids:
+            return
+
+    if len(run_ids) == 1:
+        config = json.loads(pull_run_config(experiment_name, run_ids[0]))
+        config_paths = ["config.json"]
+    else:
+        config_paths = [os.path.join("runs", run_id, "config.json") for run_id in run_ids]
+        for run_id, config_path in zip(run_ids, config_paths):
+            os.makedirs(os.path.dirname(config_path), exist_ok=True)
+            config = json.loads(pull_run_config(experiment_name, run_id, config_path))
+    # streaming runs read their shards straight from s3
+    if not config.get("streaming", False):
+        pull_training_data(config_paths[0])
+    if cache_records is None:
+        cache_records = len(run_ids) > 1
+    train_models(config_paths, order=order, cache_records=cache_records)
 
 @log_odds.command()
 @click.argument("config_path", required=True)
@@ -81,10 +156,28 @@ def run_batch_infer_partition(config_path):
 
 @log_odds.command()
 @click.argument("config_path", required=True)
-def run_batch_infer(config_path):
+def run_batch_infer_worker(config_path):
+    """
+    Scores a list of `partitions`, a [start, stop) `partition_range`
+    or a single `partition` with one load of the model
+    """
     with open(config_path, "r") as f:
         config = json.load(f)
-    
+    batch_infer_worker(config)
+
+@log_odds.command()
+@click.argument("config_path", required=True)
+@local_option
+@processes_option
+def run_batch_infer(config_path, local, processes):
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    if config.pop("plan_partitions", False):
+        config = plan_event(config, "batch-infer", config["upload_table"], config["table"])
+    if local:
+        launch_local(batch_infer_worker, config, processes, ranges=True)
+        return
+
     client = boto3.client("lambda")
     client.invoke(
         FunctionName="mimic-log-odds-batch-infer",
@@ -97,14 +190,21 @@ def run_batch_infer(config_path):
 def build_contrast_partition(config_path):
     with open(config_path, "r") as f:
         config = json.load(f)
-    build_contrast_func(**config)
+    build_contrast_func(**resolve_plan(config))
 
 @log_odds.command()
 @click.argument("config_path", required=True)
-def build_contrast(config_path):
+@local_option
+@processes_option
+def build_contrast(config_path, local, processes):
     with open(config_path, "r") as f:
         config = json.load(f)
-    
+    if config.pop("plan_partitions", False):
+        config = plan_event(config, "build-contrast", config["destination_table"], config["source_table"])
+    if local:
+        launch_local(build_contrast_worker, config, processes)
+        return
+
     client = boto3.client("lambda")
     client.invoke(
         FunctionName="mimic-log-odds-build-contrast",
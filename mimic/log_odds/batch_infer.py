@@ -1,32 +1,191 @@
 import os
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-import tensorflow.keras as keras
+from botocore.exceptions import ClientError
 import numpy as np
 import pandas as pd
 
-from mimic.log_odds.build_tfrecord import read_from_athena, collapse_choices
+from mimic.log_odds.instrument import JobMetrics, frame_bytes
+from mimic.log_odds.numpy_model import NumpyModel
+from mimic.log_odds.queries import KEY_COLUMNS, partition_sql, stage_columns
+from mimic.log_odds.reshape import wide_to_long
 
 import haven.db as db
 
-def expand_choices(max_choices, data, features):
-    columns_to_expand = features + ['_choice', 'probability']
-    dataframes = []
-    for i, _ in enumerate(range(max_choices)):
-        collapsed_columns = [f"{col}_{i}" for col in columns_to_expand]
-        dataframe = data[collapsed_columns + ['_individual', '_decision']].copy()
-        dataframe = dataframe.rename(columns=dict(zip(collapsed_columns, columns_to_expand)))
-        dataframes.append(dataframe)
-    return pd.concat(dataframes)
-
-def infer(model, data, features):
-    data['log_odds'] = model.predict(data[features])
+# columns infer adds, any of which the compact output can keep
+SCORE_COLUMNS = ['log_odds', 'odds', 'probability']
+
+# rows scored at once, which bounds the memory of a worker
+DEFAULT_CHUNK_ROWS = 1000000
+
+# every chunk of a partition is written to its own haven partition
+UPLOAD_PARTITION_COLUMNS = ['experiment_name', 'run_id', '_train', '_partition', '_chunk']
+
+DEFAULT_MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mimic", "models")
+
+def expand_choices(max_choices, data, features, n_choices=None):
+    """
+    Brings collapsed (wide) data back to one row per choice, in
+    decision order, dropping the padding slots if `n_choices` is given
+    """
+    return wide_to_long(
+        data, features + ['_choice', 'probability'], max_choices,
+        id_columns=['_individual', '_decision'], n_choices=n_choices,
+    )
+
+def infer(model, data, features, batch_size=None):
+    data['log_odds'] = model.predict(
+        data[features].to_numpy(dtype=np.float32), batch_size=batch_size, verbose=0
+    ).reshape(-1)
     data['odds'] = np.exp(data['log_odds'])
-    data['sum_odds'] = data.groupby(['_individual', '_decision'])['odds'].transform('sum')
-    data['probability'] = data['odds'] / data['sum_odds']
-    del data['sum_odds']
+    sum_odds = data.groupby(['_individual', '_decision'])['odds'].transform('sum')
+    data['probability'] = data['odds'] / sum_odds
     return data
 
+def compact_results(data, score_columns, passthrough_columns=()):
+    """
+    Inputs:
+    - data: pd.DataFrame, output of infer
+    - score_columns: list of strings, SCORE_COLUMNS to keep
+    - passthrough_columns: list of strings, source columns to keep
+
+    Returns the key columns, the passthrough columns and the score
+    columns downcast to float32
+    """
+    unknown = set(score_columns) - set(SCORE_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown score columns {sorted(unknown)}")
+    columns = KEY_COLUMNS + [column for column in passthrough_columns if column not in KEY_COLUMNS]
+    compact = {column: data[column].to_numpy() for column in columns}
+    for column in score_columns:
+        compact[column] = data[column].to_numpy(dtype=np.float32)
+    return pd.DataFrame(compact, index=data.index)
+
+def partition_chunks(
+    table, partition, total_partitions, train, chunk_rows,
+    partition_key="_decision", keys=None, bucket_column=None,
+):
+    """
+    Returns the number of chunks that keeps each chunk of
+    the partition at about `chunk_rows` rows
+    """
+    if chunk_rows is None:
+        return 1
+    counts = db.read_data(
+        partition_sql(
+            table, partition, total_partitions, train, key=partition_key,
+            keys=keys, bucket_column=bucket_column, columns=["count(*) as _rows"],
+        )
+    )
+    return max(math.ceil(int(counts['_rows'].iloc[0]) / chunk_rows), 1)
+
+def read_chunks(
+    database, table, partition, total_partitions, train, chunks=None,
+    partition_key="_decision", keys=None, bucket_column=None, columns=None,
+    chunk_rows=None,
+):
+    """
+    Yields the partition in `chunks` pieces, each holding whole
+    (_individual, _decision) groups, so only one piece is in memory.
+    Without `chunks` there are as many as keep each piece at about
+    `chunk_rows` rows.
+    """
+    os.environ["HAVEN_DATABASE"] = database
+    if chunks is None:
+        chunks = partition_chunks(
+            table, partition, total_partitions, train, chunk_rows, partition_key, keys, bucket_column,
+        )
+    for chunk in range(chunks):
+        yield db.read_data(
+            partition_sql(
+                table, partition, total_partitions, train, key=partition_key,
+                chunk=chunk, chunks=chunks, keys=keys, bucket_column=bucket_column,
+                columns=columns,
+            )
+        )
+
+def fetch_model_file(s3, bucket_name, key, path):
+    """
+    Returns the local copy of s3://bucket_name/key, cached at `path`
+    with the object's ETag added to the name so a run that is retrained
+    (--force) under the same run_id is downloaded again. Copies of
+    earlier versions are removed.
+    """
+    etag = s3.head_object(Bucket=bucket_name, Key=key)['ETag'].strip('"')
+    root, extension = os.path.splitext(path)
+    cached = f"{root}-{etag}{extension}"
+    if not os.path.exists(cached):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3.download_file(bucket_name, key, f"{cached}.partial")
+        os.replace(f"{cached}.partial", cached)
+        stale_prefix = f"{os.path.basename(root)}-"
+        for name in os.listdir(os.path.dirname(path)):
+            if name.startswith(stale_prefix) and name.endswith(extension) and name != os.path.basename(cached):
+                os.remove(os.path.join(os.path.dirname(path), name))
+    return cached
+
+def load_model(space, experiment_name, run_id, backend="auto", cache_dir=DEFAULT_MODEL_CACHE_DIR):
+    """
+    Inputs:
+    - space: str, space the models bucket belongs to
+    - experiment_name: str, name of the experiment
+    - run_id: str, id of the run
+    - backend: str, "numpy" to score with NumpyModel, "keras" to score
+      with keras or "auto" to use numpy when the run has a numpy export
+    - cache_dir: str, local directory models are cached in
+
+    Returns a model with a keras style predict method
+    """
+    bucket_name = f"{space}-models"
+    prefix = f"{experiment_name}/{run_id}"
+    local_dir = os.path.join(cache_dir, experiment_name, run_id)
+    s3 = boto3.client("s3")
+
+    if backend in ("auto", "numpy"):
+        try:
+            path = fetch_model_file(s3, bucket_name, f"{prefix}/model.npz", os.path.join(local_dir, "model.npz"))
+            return NumpyModel.load(path)
+        except ClientError:
+            if backend == "numpy":
+                raise
+
+    # tensorflow is slow to import so we only pull
+    # it in when there is no numpy export to use
+    import tensorflow.keras as keras
+
+    path = fetch_model_file(s3, bucket_name, f"{prefix}/model.keras", os.path.join(local_dir, "model.keras"))
+    return keras.models.load_model(path)
+
+def prefetch(iterable):
+    """
+    Yields the items of `iterable` while the next one is being
+    produced on a background thread
+    """
+    done = object()
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, done)
+        while True:
+            item = future.result()
+            if item is done:
+                return
+            future = executor.submit(next, iterator, done)
+            yield item
+
+def read_partitions(
+    database, table, partitions, total_partitions, train, chunks=None,
+    partition_key="_decision", keys=None, bucket_column=None, columns=None,
+    chunk_rows=None,
+):
+    for partition in partitions:
+        for chunk, data in enumerate(read_chunks(
+            database, table, partition, total_partitions, train, chunks,
+            partition_key, keys, bucket_column, columns, chunk_rows,
+        )):
+            yield partition, chunk, data
+
 def clear_data(database, table, experiment_name, run_id):
     os.environ["HAVEN_DATABASE"] = database
     db.delete_data(table, [{'experiment_name': experiment_name, 'run_id': run_id}])
@@ -34,22 +193,76 @@ def clear_data(database, table, experiment_name, run_id):
 def run_inference(
     database, table, partition, total_partitions, 
     train, features, upload_table, space, experiment_name, 
-    run_id
+    run_id, chunks=None, predict_batch_size=1024, backend="auto",
+    model_cache_dir=DEFAULT_MODEL_CACHE_DIR, partition_key="_decision", keys=None,
+    bucket_column=None, metrics_table=None, score_columns=None, passthrough_columns=None,
+    chunk_rows=DEFAULT_CHUNK_ROWS,
 ):
-    bucket_name = f"{space}-models"
-    model_key = f"{experiment_name}/{run_id}/model.keras"
-    s3 = boto3.client("s3")
-    s3.download_file(bucket_name, model_key, "model.keras")
+    run_inference_partitions(
+        database, table, [partition], total_partitions,
+        train, features, upload_table, space, experiment_name,
+        run_id, chunks, predict_batch_size, backend, model_cache_dir,
+        partition_key, keys, bucket_column, metrics_table,
+        score_columns, passthrough_columns, chunk_rows,
+    )
 
-    model = keras.models.load_model("model.keras")
+def run_inference_partitions(
+    database, table, partitions, total_partitions, 
+    train, features, upload_table, space, experiment_name, 
+    run_id, chunks=None, predict_batch_size=1024, backend="auto",
+    model_cache_dir=DEFAULT_MODEL_CACHE_DIR, partition_key="_decision", keys=None,
+    bucket_column=None, metrics_table=None, score_columns=None, passthrough_columns=None,
+    chunk_rows=DEFAULT_CHUNK_ROWS,
+):
+    """
+    Scores every partition in `partitions` with a single load of the
+    model. Each partition is read in chunks of about `chunk_rows` rows
+    (or a fixed number of `chunks`), the next chunk is read while the
+    current one is scored and written to its own `_chunk` partition of
+    the upload table, so chunks never overwrite each other and a retried
+    job rewrites the same partitions. `keys` (from a plan) is only
+    meaningful with a single partition.
 
-    data = read_from_athena(database, table, partition, total_partitions, train)
+    By default the features are written along with every score. Given
+    `score_columns` only the keys, those scores (as float32) and the
+    `passthrough_columns` are written. experiment_name and run_id are
+    partition columns so they are kept in the path, not in the rows.
+    """
+    if keys is not None and len(partitions) != 1:
+        raise ValueError("planned keys can only be given for a single partition")
+    metrics = JobMetrics(
+        "batch_infer", experiment_name=experiment_name, run_id=run_id,
+        partitions=list(partitions), train=train,
+    )
+    with metrics.stage("load_model"):
+        model = load_model(space, experiment_name, run_id, backend, model_cache_dir)
 
-    results = infer(model, data, features)
-    results['experiment_name'] = experiment_name
-    results['run_id'] = run_id
-    results['_partition'] = partition
-    results['_train'] = train
+    passthrough_columns = list(passthrough_columns or [])
+    chunks_to_score = read_partitions(
+        database, table, partitions, total_partitions, train, chunks,
+        partition_key, keys, bucket_column, stage_columns(KEY_COLUMNS, features + passthrough_columns),
+        chunk_rows,
+    )
+    # reads overlap with scoring so "read" is only the time
+    # spent waiting on them
+    for partition, chunk, data in metrics.iterate("read", prefetch(chunks_to_score)):
+        metrics.count("read", rows=len(data), bytes_read=frame_bytes(data))
+        if data.empty:
+            continue
+        with metrics.stage("infer") as counts:
+            results = infer(model, data, features, batch_size=predict_batch_size)
+            if score_columns is not None:
+                results = compact_results(results, score_columns, passthrough_columns)
+            results['experiment_name'] = experiment_name
+            results['run_id'] = run_id
+            results['_partition'] = partition
+            results['_chunk'] = chunk
+            results['_train'] = train
+            counts.update(rows=len(results))
 
-    os.environ["HAVEN_DATABASE"] = database
-    db.write_data(results, upload_table, ['experiment_name', 'run_id', '_train', '_partition'])
+        with metrics.stage("write") as counts:
+            os.environ["HAVEN_DATABASE"] = database
+            db.write_data(results, upload_table, UPLOAD_PARTITION_COLUMNS)
+            counts.update(rows=len(results), bytes_written=frame_bytes(results))
+        del data, results
+    metrics.emit(database, metrics_table)
@@ -1,94 +1,146 @@
 import os
 
+import numpy as np
 import pandas as pd
 import haven.db as db
 
-def load_source_data(database, source_table, partition, total_partitions, train):
+from mimic.log_odds.instrument import JobMetrics, frame_bytes
+from mimic.log_odds.queries import KEY_COLUMNS, partition_sql, stage_columns
+
+def load_source_data(
+    database, source_table, partition, total_partitions, train,
+    partition_key="_individual", keys=None, bucket_column=None, columns=None,
+):
     # the basic unit here is an individual so we partition
     # on them
-    sql = f'''
-    select 
-        *
-    from 
-        {source_table}
-    where 
-        _individual % {total_partitions} = {partition}
-        and {"" if train else "not"} _train
-    '''
+    sql = partition_sql(
+        source_table, partition, total_partitions, train, key=partition_key,
+        keys=keys, bucket_column=bucket_column, columns=columns,
+    )
     os.environ['HAVEN_DATABASE'] = database
     return db.read_data(sql)
 
-def build_selections(data, decisions_per_individual):
-    selections = data[data['_selected']]
-    # we sample with replacement to get the desired number of decisions
-    # per individual
-    selections = (
-        selections.groupby('_individual')
-        .sample(n=decisions_per_individual, replace=True)
-    )
-    return selections
-
-def build_alternatives(data, alternatives_per_decision, selections):
-    alternatives = data[~data['_selected']]
-    # we sample with replacement to get the desired number of alternatives
-    # per decision
-    alternatives = (
-        alternatives.groupby(['_individual', '_decision'])
-        .sample(n=alternatives_per_decision, replace=True)
-    )
-    # now we need to filter out the decisions that aren't
-    # in the selections
-    return (
-        selections[['_individual', '_decision']]
-        .merge(
-            alternatives,
-            on=['_individual', '_decision'],
-            how='inner'
-        )
+def group_offsets(codes, n_groups):
+    """
+    Returns the (starts, counts) of each group in an array of
+    group codes that is already sorted
+    """
+    counts = np.bincount(codes, minlength=n_groups)
+    return np.cumsum(counts) - counts, counts
+
+def sample_contrast_rows(individuals, decisions, selected, decisions_per_individual, alternatives_per_decision, rng):
+    """
+    Inputs:
+    - individuals: array, _individual of each row
+    - decisions: array, _decision of each row
+    - selected: bool array, _selected of each row
+    - decisions_per_individual: int, selections sampled per individual
+    - alternatives_per_decision: int, alternatives sampled per selection
+    - rng: np.random.Generator
+
+    Both samples are taken with replacement. Selections are drawn from
+    the selected rows of each individual and alternatives from the
+    unselected rows of each sampled decision only. Decisions without
+    any alternatives cannot be contrasted and are skipped.
+
+    Returns (selection_rows, alternative_rows), two equally long arrays
+    of row positions where each pair forms one contrast
+    """
+    individual_codes, individual_values = pd.factorize(individuals, sort=True)
+    decision_codes, _ = pd.factorize(decisions, sort=True)
+    order = np.lexsort((decision_codes, individual_codes))
+    individual_codes = individual_codes[order]
+    decision_codes = decision_codes[order]
+    selected = np.asarray(selected, dtype=bool)[order]
+
+    # rows of the same (individual, decision) are now contiguous
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (
+        (individual_codes[1:] != individual_codes[:-1])
+        | (decision_codes[1:] != decision_codes[:-1])
     )
+    group_codes = np.cumsum(new_group) - 1
+    n_groups = int(group_codes[-1]) + 1 if len(order) else 0
+
+    chosen = np.flatnonzero(selected)
+    others = np.flatnonzero(~selected)
 
-def combine(selections, alternatives, alternatives_per_decision):
-    # we repeat the selections to match the number of alternatives
-    selections = pd.concat([selections] * alternatives_per_decision)
-    # we need to add a new _decision label to the alternatives
-    # and selections first. We'll do this by sorting the
-    # selections and alternatives by individual and decision
-    # and then assigning the index as the new decision value
-    selections = (
-        selections.sort_values(['_individual', '_decision'])
-        .reset_index(drop=True).reset_index()
-        .rename(columns={'index': '_decision', '_decision': '_old_decision'})
+    # selections, sampled within each individual's block of selected rows
+    starts, counts = group_offsets(individual_codes[chosen], len(individual_values))
+    starts, counts = starts[counts > 0], counts[counts > 0]
+    samples = np.repeat(starts, decisions_per_individual) + rng.integers(
+        0, np.repeat(counts, decisions_per_individual)
     )
-    alternatives = (
-        alternatives.sort_values(['_individual', '_decision'])
-        .reset_index(drop=True).reset_index()
-        .rename(columns={'index': '_decision', '_decision': '_old_decision'})
+    # sorting keeps the contrasts in (individual, decision) order
+    selection_rows = chosen[np.sort(samples)]
+
+    # alternatives, sampled within each selection's block of unselected rows
+    starts, counts = group_offsets(group_codes[others], n_groups)
+    groups = group_codes[selection_rows]
+    selection_rows = selection_rows[counts[groups] > 0]
+    groups = np.repeat(group_codes[selection_rows], alternatives_per_decision)
+    samples = starts[groups] + rng.integers(0, counts[groups])
+
+    selection_rows = np.repeat(selection_rows, alternatives_per_decision)
+    alternative_rows = others[samples]
+    return order[selection_rows], order[alternative_rows]
+
+def build_contrast(data, decisions_per_individual, alternatives_per_decision, rng=None):
+    """
+    Inputs:
+    - data: pd.DataFrame, one row per choice
+    - decisions_per_individual: int, selections sampled per individual
+    - alternatives_per_decision: int, alternatives sampled per selection
+    - rng: np.random.Generator, a fresh unseeded one if not given
+
+    Returns a DataFrame with two rows per contrast. The selected row
+    of contrast d has _decision = _choice = d and its alternative has
+    _decision = d and _choice = contrasts + d. The original ids are
+    kept as _old_decision and _old_choice.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    selection_rows, alternative_rows = sample_contrast_rows(
+        data['_individual'].to_numpy(), data['_decision'].to_numpy(), data['_selected'].to_numpy(),
+        decisions_per_individual, alternatives_per_decision, rng,
     )
-    combination = pd.concat([selections, alternatives])
-    # now we need to create choice id's
-    combination = (
-        combination
-        .reset_index(drop=True).reset_index()
-        .rename(columns={'index': '_choice', '_choice': '_old_choice'})
+    contrasts = len(selection_rows)
+
+    contrast = (
+        data.take(np.concatenate([selection_rows, alternative_rows]))
+        .rename(columns={'_decision': '_old_decision', '_choice': '_old_choice'})
+        .reset_index(drop=True)
     )
-    return combination
+    contrast.insert(0, '_decision', np.tile(np.arange(contrasts), 2))
+    contrast.insert(0, '_choice', np.arange(2 * contrasts))
+    return contrast
 
 def build_contrast_func(
     database, source_table, partition, total_partitions, train, destination_table,
     decisions_per_individual, alternatives_per_decision,
+    partition_key="_individual", keys=None, bucket_column=None, features=None,
+    seed=None, metrics_table=None,
 ):
-    data = load_source_data(database, source_table, partition, total_partitions, train)
-
-    selections = build_selections(data, decisions_per_individual)
-    alternatives = build_alternatives(data, alternatives_per_decision, selections)
-    contrast = combine(selections, alternatives, alternatives_per_decision)
-
-    os.environ['HAVEN_DATABASE'] = database
-    contrast['partition'] = partition
-    db.write_data(contrast, destination_table, ['_train', 'partition'])
-
-
-    
-
+    metrics = JobMetrics("build_contrast", table=destination_table, partition=partition, train=train)
+    with metrics.stage("read") as counts:
+        # contrasts carry every column of the source table through
+        # unless the features to keep are given
+        data = load_source_data(
+            database, source_table, partition, total_partitions, train,
+            partition_key, keys, bucket_column, columns=stage_columns(KEY_COLUMNS, features),
+        )
+        counts.update(rows=len(data), bytes_read=frame_bytes(data))
 
+    with metrics.stage("sample") as counts:
+        # every partition of a seeded build gets its own stream so
+        # rebuilding a single partition reproduces it exactly
+        rng = np.random.default_rng(None if seed is None else [seed, int(train), partition])
+        contrast = build_contrast(data, decisions_per_individual, alternatives_per_decision, rng)
+        counts.update(rows=len(contrast))
+    del data
 
+    with metrics.stage("write") as counts:
+        os.environ['HAVEN_DATABASE'] = database
+        contrast['partition'] = partition
+        db.write_data(contrast, destination_table, ['_train', 'partition'])
+        counts.update(rows=len(contrast), bytes_written=frame_bytes(contrast))
+    metrics.emit(database, metrics_table)
@@ -1,14 +1,15 @@
 import os
 import json
-import shutil
+import hashlib
 import sys
+import time
 from functools import partial
 
 import boto3
 import tensorflow as tf
 from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Dense, Input, concatenate, InputLayer
+from tensorflow.keras.layers import Dense, Dropout, Input, concatenate, InputLayer
 from tensorflow.keras import optimizers
 from tensorflow.keras.callbacks import ModelCheckpoint
 import keras
@@ -17,6 +18,17 @@ import pandas as pd
 
 import haven.db as db
 
+from mimic.log_odds.instrument import JobMetrics, file_bytes
+from mimic.log_odds.numpy_model import NumpyModel, UnsupportedLayerError
+from mimic.log_odds.transfer import (
+    DEFAULT_CACHE_DIR,
+    download_prefix,
+    iter_s3_records,
+    list_objects,
+    parse_s3_uri,
+    report,
+)
+
 
 def setup_experiment(config_path, layers_path):
     with open(config_path, 'r') as fh:
@@ -36,60 +48,325 @@ def setup_experiment(config_path, layers_path):
     s3.put_object(Bucket=bucket_name, Key=layers_key, Body=layers)
 
 
+def feature_description(N, features, layout="columns"):
+    """
+    Inputs:
+    - N: int, number of choices
+    - features: list of strings, names of features
+    - layout: str, "columns" or "packed" (see build_tfrecord.record_features)
+
+    Returns the feature description used to parse the records
+    """
+    description = {
+        "_selected": tf.io.FixedLenFeature([], tf.int64),
+        # records written before choice counts were stored are
+        # treated as having every slot filled
+        "_n_choices": tf.io.FixedLenFeature([], tf.int64, default_value=N),
+    }
+    if layout == "packed":
+        description["_inputs"] = tf.io.FixedLenFeature([N * len(features)], tf.float32)
+    elif layout == "columns":
+        for i in range(N):
+            for feature in features:
+                description[f"{feature}_{i}"] = tf.io.FixedLenFeature(
+                    [], tf.float32
+                )
+    else:
+        raise ValueError(f"unknown record layout {layout}")
+    return description
+
+
 # pylint: disable=redefined-builtin
 def split_data(N, features, data):
     """
     Inputs:
     - N: int, number of choices
     - features: list of strings, names of features
-    - data: dict, data loaded from tfrecord file
+    - data: dict, batch of data parsed from the "columns" layout
 
     Splits the data into inputs and labels for the model
     """
     inputs = {}
     for i in range(N):
         input = tf.stack(
-            [tf.cast(data[f"{feature}_{i}"], tf.float32) for feature in features]
+            [tf.cast(data[f"{feature}_{i}"], tf.float32) for feature in features],
+            axis=-1,
         )
         inputs[f"input_{i}"] = input
     label = to_categorical(data["_selected"], num_classes=N)
     return inputs, label
 
 
-def load_data(data_dir, N, features, batch_size, shuffle_buffer_size):
+def split_packed_data(N, features, data):
+    """
+    Inputs:
+    - N: int, number of choices
+    - features: list of strings, names of features
+    - data: dict, batch of data parsed from the "packed" layout
+
+    Splits the data into inputs and labels for the model
+    """
+    stacked = tf.reshape(data["_inputs"], [-1, N, len(features)])
+    inputs = {f"input_{i}": stacked[:, i] for i in range(N)}
+    label = to_categorical(data["_selected"], num_classes=N)
+    return inputs, label
+
+
+def split_stacked_data(N, features, layout, data):
     """
     Inputs:
-    - data_dir: str, path to directory containing tfrecord files
     - N: int, number of choices
     - features: list of strings, names of features
+    - layout: str, "columns" or "packed" record layout
+    - data: dict, batch of parsed data
+
+    Splits the data into the (batch, N, features) inputs, choice mask
+    and labels expected by build_stacked_model
+    """
+    if layout == "packed":
+        stacked = tf.reshape(data["_inputs"], [-1, N, len(features)])
+    else:
+        stacked = tf.stack(
+            [
+                tf.stack([data[f"{feature}_{i}"] for feature in features], axis=-1)
+                for i in range(N)
+            ],
+            axis=1,
+        )
+    mask = tf.sequence_mask(data["_n_choices"], N, dtype=tf.float32)
+    label = to_categorical(data["_selected"], num_classes=N)
+    return {"inputs": stacked, "mask": mask}, label
+
+
+def trim_padding(inputs, label):
+    """
+    Drops the choice slots that are padding for every decision in the batch
+    """
+    width = tf.cast(tf.reduce_max(tf.reduce_sum(inputs["mask"], axis=1)), tf.int32)
+    inputs = {"inputs": inputs["inputs"][:, :width], "mask": inputs["mask"][:, :width]}
+    return inputs, label[:, :width]
+
+
+def bucket_by_choices(data, batch_size, bucket_boundaries):
+    """
+    Inputs:
+    - data: tf.data.Dataset, unbatched output of split_stacked_data
     - batch_size: int, batch size
-    - shuffle_buffer_size: int, size of buffer for shuffling data
+    - bucket_boundaries: list of ints, upper bounds (inclusive) on the
+      number of choices in each bucket, larger sets go in a final bucket
 
-    Returns a tf.data.Dataset object containing the data
+    Returns batches drawn from a single bucket each and padded only to
+    the largest choice set in the batch
     """
-    feature_description = {
-        "_selected": tf.io.FixedLenFeature([], tf.int64),
-    }
-    for i in range(N):
-        for feature in features:
-            feature_description[f"{feature}_{i}"] = tf.io.FixedLenFeature(
-                [], tf.float32
+    boundaries = tf.constant(bucket_boundaries, dtype=tf.float32)
+
+    def _bucket(inputs, label):
+        n_choices = tf.reduce_sum(inputs["mask"])
+        return tf.reduce_sum(tf.cast(n_choices > boundaries, tf.int64))
+
+    data = data.group_by_window(
+        key_func=_bucket,
+        reduce_func=lambda _, window: window.batch(batch_size),
+        window_size=batch_size,
+    )
+    return data.map(trim_padding, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+# modes of load_data's cache of parsed records
+CACHE_MODES = ["memory", "disk", "auto"]
+
+DEFAULT_DATA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mimic", "datasets")
+
+# records are parsed in batches of this size before they are cached
+# so that runs with different batch sizes can share a snapshot
+CACHE_PARSE_BATCH_SIZE = 1024
+
+# "auto" caches in memory when the records take up
+# less than this fraction of the available memory
+MEMORY_CACHE_FRACTION = 0.5
+
+
+def list_tfrecord_files(data_dir):
+    return sorted(
+        os.path.join(data_dir, path)
+        for path in os.listdir(data_dir)
+        if path.endswith(".tfrecord")
+    )
+
+
+def tfrecord_dataset(data_dir, num_parallel_reads=tf.data.AUTOTUNE):
+    """
+    Inputs:
+    - data_dir: str, local directory or s3://bucket/prefix holding
+      tfrecord files, files in s3 are streamed rather than downloaded
+    - num_parallel_reads: int, number of files read at once
+
+    Returns a tf.data.Dataset of the raw records across all files,
+    with the files read in a shuffled order
+    """
+    if data_dir.startswith("s3://"):
+        bucket, prefix = parse_s3_uri(data_dir)
+        s3 = boto3.client('s3')
+        tfrecord_files = sorted(
+            content['Key'] for content in list_objects(s3, bucket, prefix)
+            if content['Key'].endswith(".tfrecord")
+        )
+
+        def read(key):
+            return tf.data.Dataset.from_generator(
+                lambda key: iter_s3_records(s3, bucket, key.decode("utf-8")),
+                args=(key,),
+                output_signature=tf.TensorSpec(shape=(), dtype=tf.string),
             )
+    else:
+        tfrecord_files = list_tfrecord_files(data_dir)
+        read = tf.data.TFRecordDataset
+
+    files = tf.data.Dataset.from_tensor_slices(tf.constant(tfrecord_files, dtype=tf.string))
+    files = files.shuffle(buffer_size=max(len(tfrecord_files), 1))
+    return files.interleave(
+        read,
+        num_parallel_calls=num_parallel_reads,
+        deterministic=False,
+    )
+
+
+def dataset_bytes(data_dir):
+    """
+    Returns the size of the tfrecord files in a local
+    directory or under an s3://bucket/prefix
+    """
+    if data_dir.startswith("s3://"):
+        bucket, prefix = parse_s3_uri(data_dir)
+        return sum(
+            content['Size'] for content in list_objects(boto3.client('s3'), bucket, prefix)
+            if content['Key'].endswith(".tfrecord")
+        )
+    return file_bytes(list_tfrecord_files(data_dir))
+
+
+def available_memory_bytes():
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def resolve_cache(cache, data_dir):
+    """
+    Returns "memory" or "disk", "auto" picks memory when the
+    parsed records are expected to fit in it
+    """
+    if cache not in CACHE_MODES:
+        raise ValueError(f"unknown cache mode {cache}")
+    if cache != "auto":
+        return cache
+    # parsed tensors take up about as much as the serialized records
+    if dataset_bytes(data_dir) < MEMORY_CACHE_FRACTION * available_memory_bytes():
+        return "memory"
+    return "disk"
+
+
+def shard_fingerprint(data_dir):
+    """
+    Returns the key and ETag of every tfrecord file of an s3 data_dir, or
+    the name, size and modification time of every local one, which change
+    whenever the shards are rebuilt
+    """
+    if data_dir.startswith("s3://"):
+        bucket, prefix = parse_s3_uri(data_dir)
+        return sorted(
+            [content['Key'], content['ETag']]
+            for content in list_objects(boto3.client('s3'), bucket, prefix)
+            if content['Key'].endswith(".tfrecord")
+        )
+    fingerprint = []
+    for path in list_tfrecord_files(data_dir):
+        stat = os.stat(path)
+        fingerprint.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
 
-    def _parse_function(proto):
-        return tf.io.parse_single_example(proto, feature_description)
 
-    tfrecord_files = []
-    for path in os.listdir(data_dir):
-        if path.endswith(".tfrecord"):
-            tfrecord_files.append(os.path.join(data_dir, path))
+def snapshot_path(cache_dir, data_dir, N, features, layout, stacked, dataset=None):
+    """
+    Returns the directory of the on disk snapshot of a dataset, keyed
+    by everything that changes the parsed tensors, including the
+    shards themselves so that a rebuilt dataset is not read stale
+    """
+    if "://" not in data_dir:
+        data_dir = os.path.abspath(data_dir)
+    key = json.dumps([dataset, data_dir, shard_fingerprint(data_dir), N, features, layout, stacked])
+    return os.path.join(cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest()[:16])
 
-    data = tf.data.TFRecordDataset(tfrecord_files)
-    data = data.map(_parse_function)
-    data = data.map(partial(split_data, N, features))
+
+def load_data(
+    data_dir, N, features, batch_size, shuffle_buffer_size, layout="columns",
+    stacked=False, bucket_boundaries=None, cache_records=False, cache=None,
+    cache_dir=DEFAULT_DATA_CACHE_DIR, dataset=None,
+):
+    """
+    Inputs:
+    - data_dir: str, path to directory containing tfrecord files
+      or an s3://bucket/prefix to stream them from
+    - N: int, number of choices
+    - features: list of strings, names of features
+    - batch_size: int, batch size
+    - shuffle_buffer_size: int, size of buffer for shuffling data
+    - layout: str, "columns" or "packed" record layout
+    - stacked: bool, whether to produce inputs for build_stacked_model
+    - bucket_boundaries: list of ints, if given (stacked only) batches
+      are grouped by choice set size, see bucket_by_choices
+    - cache_records: bool, keep the serialized records in memory after
+      the first pass instead of re-reading the files every epoch
+    - cache: str, one of CACHE_MODES to keep the parsed tensors after the
+      first pass, "memory", "disk" for a snapshot under `cache_dir` that
+      later runs on the same host reuse, or "auto" for memory when the
+      records fit in it. Cached tensors are still reshuffled every epoch.
+    - cache_dir: str, local directory of the disk snapshots
+    - dataset: str, name of the dataset staged in data_dir, part of the
+      snapshot key
+
+    Returns a tf.data.Dataset object containing the data
+    """
+    if bucket_boundaries and not stacked:
+        raise ValueError("bucketing by choice set size requires stacked inputs")
+
+    description = feature_description(N, features, layout)
+    if stacked:
+        split = partial(split_stacked_data, layout=layout)
+    elif layout == "packed":
+        split = split_packed_data
+    else:
+        split = split_data
+
+    def _parse_function(protos):
+        return split(N, features, data=tf.io.parse_example(protos, description))
+
+    # parse whole batches rather than one record at a time
+    data = tfrecord_dataset(data_dir)
+    if cache is not None:
+        data = data.batch(batch_size=CACHE_PARSE_BATCH_SIZE)
+        data = data.map(_parse_function, num_parallel_calls=tf.data.AUTOTUNE)
+        if resolve_cache(cache, data_dir) == "memory":
+            data = data.cache()
+        else:
+            # snappy compressed snapshots fail to read back
+            # elements over 256KB, which parsed batches can be
+            data = data.snapshot(
+                snapshot_path(cache_dir, data_dir, N, features, layout, stacked, dataset), compression=None,
+            )
+        data = data.unbatch().shuffle(buffer_size=shuffle_buffer_size)
+        if bucket_boundaries:
+            data = bucket_by_choices(data, batch_size, bucket_boundaries)
+        else:
+            data = data.batch(batch_size=batch_size)
+        return data.prefetch(buffer_size=tf.data.AUTOTUNE)
+
+    if cache_records:
+        data = data.cache()
     data = data.shuffle(buffer_size=shuffle_buffer_size)
     data = data.batch(batch_size=batch_size)
-    data = data.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+    data = data.map(_parse_function, num_parallel_calls=tf.data.AUTOTUNE)
+    if bucket_boundaries:
+        data = bucket_by_choices(data.unbatch(), batch_size, bucket_boundaries)
+    data = data.prefetch(buffer_size=tf.data.AUTOTUNE)
     return data
 
 
@@ -120,12 +397,91 @@ def build_model(config, N, features, layers, final_activation="linear"):
     output_layer.trainable = False
 
     model = Model(inputs=inputs, outputs=output)
+    compile_model(config, model)
+
+    return model, layers
+
+
+def compile_model(config, model):
     optimizer = (
         optimizers.__dict__[config['model'].get('optimizer', 'Adam')](
             **config['model'].get('optimizer_kwargs', {})
         )
     )
-    model.compile(optimizer=optimizer, loss="categorical_crossentropy")
+    # jit_compile fuses the train step with XLA, keras' "auto"
+    # leaves it off on cpu. bucketed batches compile once per width
+    model.compile(
+        optimizer=optimizer, loss="categorical_crossentropy",
+        jit_compile=config['model'].get('jit_compile', "auto"),
+    )
+
+
+@keras.saving.register_keras_serializable(package="mimic")
+class FlattenChoices(keras.layers.Layer):
+    """
+    Reshapes (batch, choices, features) into (batch * choices, features)
+    so that the tower runs once over every choice in the batch
+    """
+    def call(self, inputs):
+        return keras.ops.reshape(inputs, (-1, inputs.shape[-1]))
+
+    def compute_output_shape(self, input_shape):
+        return (None, input_shape[-1])
+
+
+@keras.saving.register_keras_serializable(package="mimic")
+class UnflattenChoices(keras.layers.Layer):
+    """
+    Reshapes the (batch * choices, 1) tower output back into (batch, choices)
+    """
+    def call(self, scores, inputs):
+        return keras.ops.reshape(scores, keras.ops.shape(inputs)[:2])
+
+    def compute_output_shape(self, scores_shape, inputs_shape):
+        return tuple(inputs_shape[:2])
+
+
+@keras.saving.register_keras_serializable(package="mimic")
+class MaskedSoftmax(keras.layers.Layer):
+    """
+    Softmax over the choice axis that gives masked out choices
+    zero probability
+    """
+    def call(self, logits, choice_mask):
+        logits = keras.ops.where(choice_mask > 0, logits, keras.ops.full_like(logits, -1e9))
+        return keras.ops.softmax(logits, axis=-1)
+
+    def compute_output_shape(self, logits_shape, choice_mask_shape):
+        return logits_shape
+
+
+STACKED_LAYERS = (InputLayer, FlattenChoices, UnflattenChoices, MaskedSoftmax)
+
+
+def build_stacked_model(config, N, features, layers, final_activation="linear"):
+    """
+    Inputs:
+    - N: int, number of choices, or None to accept any number
+    - features: list of strings, names of features
+    - layers: list of keras layers
+    - final_activation: str, activation function for final layer
+
+    Returns a keras model taking a single (batch, N, features) input
+    and a (batch, N) choice mask. Unlike build_model the layers are
+    applied once to all batch * N choices rather than once per choice.
+    """
+    layers.append(Dense(1, activation=final_activation))
+    inputs = Input(shape=(N, len(features)), name="inputs")
+    mask = Input(shape=(N,), name="mask")
+
+    last_layer = FlattenChoices()(inputs)
+    for layer in layers:
+        last_layer = layer(last_layer)
+    logits = UnflattenChoices()(last_layer, inputs)
+    output = MaskedSoftmax()(logits, mask)
+
+    model = Model(inputs={"inputs": inputs, "mask": mask}, outputs=output)
+    compile_model(config, model)
 
     return model, layers
 
@@ -137,7 +493,31 @@ def build_export_model(features, layers):
         last_layer = layer(last_layer)
     return Model(inputs=input, outputs=last_layer)
 
-def pull_run_config(experiment_name, run_id):
+
+def export_numpy_model(model, path, precision="float32"):
+    """
+    Inputs:
+    - model: keras model from build_export_model
+    - path: str, where to write the .npz
+    - precision: str, precision of the stored kernels, see NumpyModel.save
+
+    Writes the weights and activations of the model for NumpyModel,
+    raises UnsupportedLayerError if the model is not a stack of Dense
+    (and Dropout) layers with supported activations
+    """
+    layers = []
+    for layer in model.layers:
+        if isinstance(layer, (InputLayer, Dropout)):
+            continue
+        if not isinstance(layer, Dense):
+            raise UnsupportedLayerError(f"unsupported layer {type(layer).__name__}")
+        kernel = layer.kernel.numpy()
+        bias = layer.bias.numpy() if layer.use_bias else np.zeros(kernel.shape[1], dtype=kernel.dtype)
+        layers.append((kernel, bias, keras.activations.serialize(layer.activation)))
+    NumpyModel(layers).save(path, precision)
+
+
+def pull_run_config(experiment_name, run_id, config_path="config.json"):
     bucket_name = "mimic-log-odds-models"
     config_key = f"{experiment_name}/{run_id}/config.json"
     layers_key = f"{experiment_name}/layers.py"
@@ -145,7 +525,7 @@ def pull_run_config(experiment_name, run_id):
     s3 = boto3.client('s3')
     response = s3.get_object(Bucket=bucket_name, Key=config_key)
     config = response['Body'].read().decode('utf-8')
-    with open("config.json", "w") as fh:
+    with open(config_path, "w") as fh:
         fh.write(config)
 
     response = s3.get_object(Bucket=bucket_name, Key=layers_key)
@@ -156,106 +536,341 @@ def pull_run_config(experiment_name, run_id):
     return config
 
 
+def run_marker_key(experiment_name, run_id):
+    return f"{experiment_name}/{run_id}/complete.json"
+
+
+def completed_runs(experiment_name, s3=None):
+    """
+    Returns the set of run_ids of the experiment that wrote
+    a completion marker, ie. whose results and models are all in
+    """
+    s3 = s3 or boto3.client('s3')
+    return {
+        content['Key'].split('/')[-2]
+        for content in list_objects(s3, "mimic-log-odds-models", f"{experiment_name}/")
+        if content['Key'].endswith('/complete.json')
+    }
+
+
+def write_run_marker(config, s3=None):
+    s3 = s3 or boto3.client('s3')
+    marker = {"run_id": config["run_id"], "completed_at": time.time()}
+    s3.put_object(
+        Bucket="mimic-log-odds-models",
+        Key=run_marker_key(config["experiment_name"], config["run_id"]),
+        Body=json.dumps(marker),
+    )
+
+
 def pull_training_data(config_path):
     with open(config_path, 'r') as fh:
         config = json.load(fh)
 
     bucket_name = "mimic-log-odds-tfrecords"
     dataset = config["dataset"]
+    cache_dir = config.get("shard_cache_dir", DEFAULT_CACHE_DIR)
+    max_workers = config.get("download_workers", 8)
 
     s3 = boto3.client('s3')
-    
-    response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        Prefix=f'{dataset}/train/'
-    )
-
-    if os.path.exists('train'):
-        shutil.rmtree('train')
-    os.mkdir('train')
-    for i, content in enumerate(response.get('Contents', [])):
-        key = content['Key']
-        s3.download_file(bucket_name, key, f'train/part{i}-{key.split("/")[-1]}')
-
-    response = s3.list_objects_v2(
-        Bucket=bucket_name,
-        Prefix=f'{dataset}/test/'
-    )
-
-    if os.path.exists('test'):
-        shutil.rmtree('test')
-    os.mkdir('test')
-    for i, content in enumerate(response.get('Contents', [])):
-        key = content['Key']
-        s3.download_file(bucket_name, key, f'test/part{i}-{key.split("/")[-1]}')
+    for split in ['train', 'test']:
+        stats = download_prefix(
+            bucket_name, f'{dataset}/{split}/', split,
+            cache_dir=cache_dir, max_workers=max_workers, s3=s3,
+        )
+        report(stats)
 
 
 def build_results(history):
     results = pd.DataFrame(history.history)
-    results['epoch'] = results.index + 1
+    results['epoch'] = np.array(history.epoch) + 1
     return results
 
 
 class TrainingEvaluationCallback(tf.keras.callbacks.Callback):
-    def __init__(self, train_data):
+    """
+    Logs train_loss, the loss over `train_data` with the weights at the
+    end of the epoch, every `every` epochs (NaN in between) along with
+    train_eval_seconds, the time the evaluation took
+    """
+    def __init__(self, train_data, every=1):
         super().__init__()
         self.train_data = train_data
+        self.every = every
 
     def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every:
+            logs['train_loss'] = np.nan
+            logs['train_eval_seconds'] = 0.0
+            return
+        start = time.perf_counter()
         train_loss = self.model.evaluate(self.train_data, verbose=0)
         logs['train_loss'] = train_loss
+        logs['train_eval_seconds'] = time.perf_counter() - start
 
 
-def train_model(config_path):
-    with open(config_path, 'r') as fh:
-        config = json.load(fh)
+class InputStallCallback(tf.keras.callbacks.Callback):
+    """
+    Logs input_stall_seconds, the time each epoch's training steps spent
+    blocked waiting on the input pipeline. Keras pulls each batch inside
+    the compiled train step, so the dataset has to be wrapped with
+    `watch` to stamp the moment each batch becomes available. The very
+    first batch is left out as its wait is mostly tracing the step.
+    """
+    def watch(self, dataset):
+        def _record():
+            self.available = time.perf_counter()
+            return 0.0
 
-    sys.path.append(os.getcwd())
-    from layers import LAYERS 
+        def _stamp(*element):
+            stamp = tf.py_function(_record, [], tf.float64)
+            with tf.control_dependencies([stamp]):
+                return tf.nest.map_structure(tf.identity, element)
+
+        return dataset.map(_stamp)
+
+    def on_train_begin(self, logs=None):
+        self.traced = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.stall = 0.0
 
+    def on_train_batch_begin(self, batch, logs=None):
+        self.begin = time.perf_counter()
+        self.available = None
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.available is not None and self.traced:
+            self.stall += max(self.available - self.begin, 0.0)
+        self.traced = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs['input_stall_seconds'] = self.stall
+
+
+def build_train_evaluation(train_data, settings=None):
+    """
+    Inputs:
+    - train_data: tf.data.Dataset, batched training data
+    - settings: dict, config["model"]["train_evaluation"] with
+        - mode: "full" re-reads the training data every time (default),
+          "subsample" evaluates on a fixed set of `batches` batches
+          kept in memory and "cached" evaluates on all of the training
+          data kept in memory after the first evaluation
+        - batches: int, number of batches for the "subsample" mode
+        - every: int, evaluate every this many epochs (default 1)
+
+    Returns a TrainingEvaluationCallback
+    """
+    settings = settings or {}
+    mode = settings.get("mode", "full")
+    if mode == "subsample":
+        data = train_data.take(settings["batches"]).cache()
+    elif mode == "cached":
+        data = train_data.cache()
+    elif mode == "full":
+        data = train_data
+    else:
+        raise ValueError(f"unknown train evaluation mode {mode}")
+    return TrainingEvaluationCallback(data, every=settings.get("every", 1))
+
+
+# every run trained in one group has to agree on these
+# as they all read the same shards through the same parser
+GROUP_KEYS = ["dataset", "max_choices", "features", "layout", "streaming"]
+
+TRAIN_ORDERS = ["sequential", "round_robin"]
+
+
+def data_dirs(config):
+    if config.get("streaming", False):
+        return [
+            f"s3://mimic-log-odds-tfrecords/{config['dataset']}/{split}/"
+            for split in ['train', 'test']
+        ]
+    return ['train', 'test']
+
+
+def check_group(configs):
+    for key in GROUP_KEYS:
+        values = set(json.dumps(config.get(key), sort_keys=True) for config in configs)
+        if len(values) > 1:
+            raise ValueError(f"runs trained together must share {key}")
+
+
+def prepare_run(config, run_dir, LAYERS, pipelines, cache_records=False):
+    """
+    Builds the model, data and callbacks of one run. Runs with the
+    same input settings share the datasets held in `pipelines`.
+    """
     batch_size = config["model"]["batch_size"]
-    epochs = config["model"]["epochs"]
     max_choices = config["max_choices"]
     features = config["features"]
+    layout = config.get("layout", "columns")
+    train_dir, test_dir = data_dirs(config)
+    stacked = config["model"].get("architecture", "towers") == "stacked"
+    bucket_boundaries = config["model"].get("bucket_boundaries")
+    cache = config["model"].get("cache")
     layers = [LAYERS[layer]() for layer in config["model"]["layers"]]
 
-    train = load_data('train', max_choices, features, batch_size=batch_size, shuffle_buffer_size=10000)
-    test = load_data('test', max_choices, features, batch_size=batch_size, shuffle_buffer_size=10000)
+    pipeline = (batch_size, stacked, tuple(bucket_boundaries or ()), cache)
+    if pipeline not in pipelines:
+        pipelines[pipeline] = [
+            load_data(
+                data_dir, max_choices, features, batch_size=batch_size, shuffle_buffer_size=10000,
+                layout=layout, stacked=stacked, bucket_boundaries=bucket_boundaries,
+                cache_records=cache_records and cache is None, cache=cache, dataset=config.get("dataset"),
+            )
+            for data_dir in [train_dir, test_dir]
+        ]
+    train, test = pipelines[pipeline]
 
-    model, layers = build_model(config, max_choices, features, layers)
+    if stacked:
+        # bucketed batches vary in width so the choice axis is left open
+        N = None if bucket_boundaries else max_choices
+        model, layers = build_stacked_model(config, N, features, layers)
+    else:
+        model, layers = build_model(config, max_choices, features, layers)
 
     # the normal loss provided is averaged over each batch 
     # during the epoch as weights are changing. therefore
     # for a real indication of the loss we'll want this callback
-    train_eval_callback = TrainingEvaluationCallback(train)
+    train_eval_callback = build_train_evaluation(train, config["model"].get("train_evaluation"))
 
     checkpoint = ModelCheckpoint(
-        filepath='model.keras',
+        filepath=os.path.join(run_dir, 'model.keras'),
         monitor='val_loss',
         save_best_only=True,
         mode='min',
         verbose=1
     )
 
-    history = model.fit(train, validation_data=test, epochs=epochs, callbacks=[train_eval_callback, checkpoint])
-    results = build_results(history)
+    stall_callback = InputStallCallback()
+    return {
+        "config": config,
+        "run_dir": run_dir,
+        "model": model,
+        "stacked": stacked,
+        "train": stall_callback.watch(train),
+        "train_dir": train_dir,
+        "test": test,
+        "callbacks": [stall_callback, train_eval_callback, checkpoint],
+        "results": [],
+        "cache_records": cache_records or cache is not None,
+        "metrics": JobMetrics("train_model", experiment_name=config['experiment_name'], run_id=config['run_id']),
+    }
+
+
+def fit_run(run, epochs, initial_epoch=0):
+    config = run["config"]
+    with run["metrics"].stage("fit") as counts:
+        history = run["model"].fit(
+            run["train"], validation_data=run["test"], epochs=epochs,
+            initial_epoch=initial_epoch, callbacks=run["callbacks"],
+        )
+        counts.update(
+            epochs=len(history.epoch),
+            input_stall_seconds=float(np.sum(history.history['input_stall_seconds'])),
+        )
+        # cached records and tensors are only read from the shards once
+        if not config.get("streaming", False) and not run["cache_records"]:
+            counts.update(bytes_read=file_bytes(list_tfrecord_files(run["train_dir"])) * len(history.epoch))
+    run["results"].append(build_results(history))
+
+
+def finish_run(run):
+    """
+    Writes the results rows of the run and uploads its
+    early stopped model under its run_id
+    """
+    config = run["config"]
+    model_path = os.path.join(run["run_dir"], 'model.keras')
+    results = pd.concat(run["results"], ignore_index=True)
     results['experiment_name'] = config['experiment_name']
     results['run_id'] = config['run_id']
+    results['train_evaluation'] = config["model"].get("train_evaluation", {}).get("mode", "full")
 
     os.environ["HAVEN_DATABASE"] = config["database"]
     db.write_data(results, config["table"], ['experiment_name', 'run_id'])
 
-    early_stop_model = keras.models.load_model('model.keras')
-    early_stop_layers = [
-        layer for layer in early_stop_model.layers[:-2]
-        if not isinstance(layer, InputLayer)
-    ]
+    early_stop_model = keras.models.load_model(model_path)
+    if run["stacked"]:
+        early_stop_layers = [
+            layer for layer in early_stop_model.layers
+            if not isinstance(layer, STACKED_LAYERS)
+        ]
+    else:
+        early_stop_layers = [
+            layer for layer in early_stop_model.layers[:-2]
+            if not isinstance(layer, InputLayer)
+        ]
 
-    model = build_export_model(features, early_stop_layers)
+    model = build_export_model(config["features"], early_stop_layers)
 
-    model.save('model.keras')
+    model.save(model_path)
 
     s3 = boto3.client('s3')
     bucket_name = "mimic-log-odds-models"
     key = f"{config['experiment_name']}/{config['run_id']}/model.keras"
-    s3.upload_file('model.keras', bucket_name, key)
+    s3.upload_file(model_path, bucket_name, key)
+
+    # models that can be scored without tensorflow also get
+    # an npz export, the rest are scored through keras
+    npz_path = os.path.join(run["run_dir"], 'model.npz')
+    try:
+        export_numpy_model(model, npz_path, config["model"].get("export_precision", "float32"))
+    except UnsupportedLayerError as error:
+        print(f"skipping numpy export: {error}")
+    else:
+        s3.upload_file(npz_path, bucket_name, f"{config['experiment_name']}/{config['run_id']}/model.npz")
+    # the marker goes last so a run that failed part way is retrained
+    write_run_marker(config, s3)
+    run["metrics"].emit(config["database"], config.get("metrics_table"))
+
+
+def train_models(config_paths, order="sequential", cache_records=False):
+    """
+    Inputs:
+    - config_paths: list of strings, run configs to train, each run
+      writes its model next to its config
+    - order: str, "sequential" trains the runs one after the other and
+      "round_robin" trains every run one epoch at a time
+    - cache_records: bool, keep the serialized records in memory after
+      the first pass so later epochs and runs do not re-read the shards
+
+    The runs must share the GROUP_KEYS of their configs and runs with
+    the same input settings share a single input pipeline
+    """
+    if order not in TRAIN_ORDERS:
+        raise ValueError(f"unknown training order {order}")
+    configs = []
+    for config_path in config_paths:
+        with open(config_path, 'r') as fh:
+            configs.append(json.load(fh))
+    check_group(configs)
+
+    sys.path.append(os.getcwd())
+    from layers import LAYERS 
+
+    pipelines = {}
+    runs = [
+        prepare_run(config, os.path.dirname(config_path), LAYERS, pipelines, cache_records)
+        for config, config_path in zip(configs, config_paths)
+    ]
+
+    if order == "sequential":
+        for run in runs:
+            fit_run(run, run["config"]["model"]["epochs"])
+            finish_run(run)
+        return
+
+    for epoch in range(max(run["config"]["model"]["epochs"] for run in runs)):
+        for run in runs:
+            if epoch < run["config"]["model"]["epochs"]:
+                fit_run(run, epoch + 1, initial_epoch=epoch)
+    for run in runs:
+        finish_run(run)
+
+
+def train_model(config_path):
+    train_models([config_path])
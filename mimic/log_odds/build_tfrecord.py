@@ -2,53 +2,93 @@ import os
 import json
 
 import tensorflow as tf 
-import pandas as pd
+import numpy as np
 import boto3
 
 import haven.db as db
 
-def read_from_athena(database, table, partition, total_partitions, train):
+from mimic.log_odds.encode import iter_encoded_chunks
+from mimic.log_odds.instrument import JobMetrics, file_bytes, frame_bytes
+from mimic.log_odds.queries import partition_sql, stage_columns
+from mimic.log_odds.reshape import block_to_wide, scatter_choices
+from mimic.log_odds.shards import write_tfrecord_shards
+
+# columns besides the features that collapsing choices needs
+KEY_COLUMNS = ['_decision', '_individual', '_selected', '_train']
+
+def read_from_athena(
+    database, table, partition, total_partitions, train,
+    partition_key="_decision", keys=None, bucket_column=None, columns=None,
+):
     os.environ["HAVEN_DATABASE"] = database
-    sql = f"""
-    select 
-        *
-    from 
-        {table}
-    where 
-        _decision % {total_partitions} = {partition}
-        and {"" if train else "not"} _train
-    """
+    sql = partition_sql(
+        table, partition, total_partitions, train, key=partition_key,
+        keys=keys, bucket_column=bucket_column, columns=columns,
+    )
     return db.read_data(sql)
 
-def collapse_choices_row(max_choices, features, missing_values_map, group):
-    new_row = {}
-    for i, (_, row) in enumerate(group.iterrows()):
-        for feature in features:
-            if row['_selected']:
-                new_row['_selected'] = i
-            new_row[f"{feature}_{i}"] = row[feature]
+def collapse_choices_arrays(max_choices, features, missing_values_map, dataframe):
+    """
+    Inputs:
+    - max_choices: int, number of choice slots per decision
+    - features: list of strings, names of features
+    - missing_values_map: dict, value used to pad each feature
+    - dataframe: pd.DataFrame, one row per choice
 
-    if i < max_choices - 1:
-        for j in range(i + 1, max_choices):
-            for feature in features:
-                new_row[f"{feature}_{j}"] = missing_values_map[feature]
+    Returns (keys, values, selected, n_choices) where keys is a
+    DataFrame of the (_decision, _individual) pairs, values is a
+    (decisions, max_choices, features) array, selected is the slot
+    of the chosen alternative and n_choices is the true size of each
+    choice set. Raises a ValueError naming the decisions that do not
+    have exactly one selected choice.
+    """
+    keys = ['_decision', '_individual']
+    # a stable sort keeps choices in their original order
+    # within each decision
+    data = dataframe.sort_values(keys, kind='mergesort')
+    grouped = data.groupby(keys, sort=False)
+    decision = grouped.ngroup().to_numpy()
+    position = grouped.cumcount().to_numpy()
 
-    return pd.DataFrame([new_row])
+    n_decisions = int(decision[-1]) + 1 if len(decision) else 0
+    n_choices = np.bincount(decision, minlength=n_decisions)
+    if n_decisions and n_choices.max() > max_choices:
+        raise ValueError(
+            f"found a choice set of size {n_choices.max()} "
+            f"but max_choices is {max_choices}"
+        )
 
-def collapse_choices(max_choices, features, missing_values_map, dataframe):
-    collapsed = (
-        dataframe.groupby(['_decision', '_individual'])
-        .apply(
-            lambda g: collapse_choices_row(
-                max_choices,
-                features,
-                missing_values_map,
-                g
-            )
+    values = scatter_choices(
+        decision, position, data[features].to_numpy(dtype=np.float64), max_choices,
+        np.array([missing_values_map[feature] for feature in features], dtype=np.float64),
+    )
+
+    starts = np.flatnonzero(position == 0)
+    keys = data[keys].iloc[starts].reset_index(drop=True)
+
+    is_selected = data['_selected'].to_numpy(dtype=bool)
+    n_selected = np.bincount(decision[is_selected], minlength=n_decisions)
+    if n_decisions and (n_selected != 1).any():
+        bad = np.flatnonzero(n_selected != 1)
+        examples = ", ".join(
+            f"({decision_key}, {individual}): {n_selected[i]} selected"
+            for i, (decision_key, individual) in zip(bad[:5], keys.iloc[bad[:5]].to_numpy())
+        )
+        raise ValueError(
+            f"{len(bad)} decisions do not have exactly one selected choice, eg. {examples}"
         )
-        .reset_index()
+
+    selected = np.empty(n_decisions, dtype=np.int64)
+    selected[decision[is_selected]] = position[is_selected]
+    return keys, values, selected, n_choices
+
+
+def collapse_choices(max_choices, features, missing_values_map, dataframe):
+    keys, values, selected, _ = collapse_choices_arrays(
+        max_choices, features, missing_values_map, dataframe
     )
-    return collapsed[[c for c in collapsed.columns if c != 'level_2']]
+    keys['_selected'] = selected
+    return block_to_wide(keys, values, features)
 
 def serialize_row(max_choices, features, row):
     feature = {
@@ -67,23 +107,125 @@ def serialize_row(max_choices, features, row):
     example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
     return example_proto.SerializeToString()
 
+def record_features(features, values, selected, layout="columns", n_choices=None):
+    """
+    Inputs:
+    - features: list of strings, names of features
+    - values: array of shape (decisions, max_choices, features)
+    - selected: array of shape (decisions,)
+    - layout: str, "columns" for one scalar {feature}_{i} entry per
+      choice and feature or "packed" for a single flat _inputs entry
+      holding all max_choices * features values
+    - n_choices: array of shape (decisions,), true size of each choice
+      set, stored as _n_choices when given
+
+    Returns the (float_features, int_features) pairs for encode_examples
+    """
+    if layout == "packed":
+        float_features = [("_inputs", values.reshape(values.shape[0], values.shape[1] * values.shape[2]))]
+    elif layout == "columns":
+        float_features = [
+            (f"{feature}_{i}", values[:, i, j])
+            for i in range(values.shape[1])
+            for j, feature in enumerate(features)
+        ]
+    else:
+        raise ValueError(f"unknown record layout {layout}")
+    int_features = [("_selected", selected)]
+    if n_choices is not None:
+        int_features.append(("_n_choices", n_choices))
+    return float_features, int_features
+
 def write_tfrecord(max_choices, features, dataframe, output_path):
+    columns = [f"{feature}_{i}" for i in range(max_choices) for feature in features]
+    values = dataframe[columns].to_numpy(dtype=np.float32).reshape(len(dataframe), max_choices, len(features))
+    n_choices = dataframe["_n_choices"].to_numpy(dtype=np.int64) if "_n_choices" in dataframe else None
+    float_features, int_features = record_features(
+        features, values, dataframe["_selected"].to_numpy(dtype=np.int64), n_choices=n_choices
+    )
     with tf.io.TFRecordWriter(output_path) as writer:
-        for serialized_row in dataframe.apply(lambda row: serialize_row(max_choices, features, row), axis=1):
-            writer.write(serialized_row)
+        for chunk in iter_encoded_chunks(float_features, int_features):
+            for record in chunk:
+                writer.write(record)
+
+def partition_prefix(dataset, partition, train):
+    return f"{dataset}/{'train' if train else 'test'}/partition={partition}/"
+
+def manifest_key(dataset, partition, train):
+    return partition_prefix(dataset, partition, train) + "manifest.json"
 
-def write_to_s3(space, dataset, partition, train, tfrecord_path):
+def write_manifest(space, dataset, partition, train, manifest):
+    boto3.client('s3').put_object(
+        Bucket=f"{space}-tfrecords",
+        Key=manifest_key(dataset, partition, train),
+        Body=json.dumps(manifest),
+    )
+
+def write_to_s3(space, dataset, partition, train, tfrecord_path, filename="data.tfrecord"):
     s3 = boto3.client('s3')
     bucket = f"{space}-tfrecords"
-    key = f"{dataset}/{'train' if train else 'test'}/partition={partition}/data.tfrecord"
+    key = partition_prefix(dataset, partition, train) + filename
     s3.upload_file(tfrecord_path, bucket, key)
 
-def build_tfrecord(database, table, partition, total_partitions, train, max_choices, features, missing_values_map, space, dataset):
-    data = read_from_athena(database, table, partition, total_partitions, train)
-    collapsed = collapse_choices(max_choices, features, missing_values_map, data)
-    tfrecord_path = f"{space}_{dataset}_{partition}.tfrecord"
-    write_tfrecord(max_choices, features, collapsed, tfrecord_path)
-    write_to_s3(space, dataset, partition, train, tfrecord_path)
-    os.remove(tfrecord_path)
+def write_shards_to_s3(space, dataset, partition, train, tfrecord_paths):
+    """
+    Uploads the shards of a partition and removes any shards (and the
+    manifest) left behind by an earlier build of the same partition
+    """
+    if len(tfrecord_paths) == 1:
+        filenames = ["data.tfrecord"]
+    else:
+        filenames = [f"data-{i:05d}.tfrecord" for i in range(len(tfrecord_paths))]
 
-        
+    s3 = boto3.client('s3')
+    bucket = f"{space}-tfrecords"
+    prefix = partition_prefix(dataset, partition, train)
+    paginator = s3.get_paginator('list_objects_v2')
+    existing = {
+        content['Key']
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for content in page.get('Contents', [])
+    }
+
+    for tfrecord_path, filename in zip(tfrecord_paths, filenames):
+        write_to_s3(space, dataset, partition, train, tfrecord_path, filename)
+
+    stale = sorted(existing - {prefix + filename for filename in filenames})
+    for key in stale:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+def build_tfrecord(
+    database, table, partition, total_partitions, train, max_choices, features, missing_values_map, space, dataset,
+    max_shard_bytes=None, processes=1, layout="columns", partition_key="_decision", keys=None,
+    bucket_column=None, metrics_table=None, manifest=None,
+):
+    """
+    Builds the shards of one partition, `manifest` (see manifest.py) is
+    written next to them once they are all uploaded
+    """
+    metrics = JobMetrics("build_tfrecord", dataset=dataset, partition=partition, train=train)
+    with metrics.stage("read") as counts:
+        data = read_from_athena(
+            database, table, partition, total_partitions, train, partition_key, keys, bucket_column,
+            columns=stage_columns(KEY_COLUMNS, features),
+        )
+        counts.update(rows=len(data), bytes_read=frame_bytes(data))
+    with metrics.stage("collapse") as counts:
+        _, values, selected, n_choices = collapse_choices_arrays(max_choices, features, missing_values_map, data)
+        counts.update(rows=len(values))
+    del data
+    with metrics.stage("write") as counts:
+        float_features, int_features = record_features(features, values, selected, layout, n_choices)
+        tfrecord_paths = write_tfrecord_shards(
+            float_features, int_features, f"{space}_{dataset}_{partition}",
+            max_shard_bytes=max_shard_bytes, processes=processes,
+        )
+        counts.update(rows=len(values), bytes_written=file_bytes(tfrecord_paths), shards=len(tfrecord_paths))
+    with metrics.stage("upload") as counts:
+        write_shards_to_s3(space, dataset, partition, train, tfrecord_paths)
+        if manifest is not None:
+            write_manifest(space, dataset, partition, train, manifest)
+        counts.update(bytes_written=file_bytes(tfrecord_paths))
+    for tfrecord_path in tfrecord_paths:
+        os.remove(tfrecord_path)
+    metrics.emit(database, metrics_table)
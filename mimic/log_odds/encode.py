@@ -0,0 +1,147 @@
+"""
+Bulk encoding of tf.train.Example records straight from NumPy arrays.
+
+Every record in a dataset has the same features with the same number of
+values, so almost all of a serialized Example is a constant byte prefix.
+Only the float payloads and the varint encoded integers change from row
+to row. We therefore assemble whole chunks of records as a single uint8
+matrix instead of building protos one row at a time.
+"""
+import numpy as np
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(tag, body):
+    return bytes([tag]) + _varint(len(body)) + body
+
+
+def _map_entry_prefix(name, feature_tag, list_prefix, payload_size):
+    """
+    Everything of a Features map entry that precedes the payload.
+
+    Features { map<string, Feature> feature = 1; } where each entry is
+    { string key = 1; Feature value = 2; } and the Feature holds a
+    packed FloatList (tag 2) or Int64List (tag 3).
+    """
+    key = _field(0x0A, name.encode("utf-8"))
+    list_size = len(list_prefix) + payload_size
+    feature_size = 1 + len(_varint(list_size)) + list_size
+    value_prefix = bytes([0x12]) + _varint(feature_size) + bytes([feature_tag]) + _varint(list_size) + list_prefix
+    entry_size = len(key) + len(value_prefix) + payload_size
+    return bytes([0x0A]) + _varint(entry_size) + key + value_prefix
+
+
+def _float_prefix(name, size):
+    payload = 4 * size
+    return _map_entry_prefix(name, 0x12, bytes([0x0A]) + _varint(payload), payload)
+
+
+def _int_prefix(name, varint_size):
+    return _map_entry_prefix(name, 0x1A, bytes([0x0A]) + _varint(varint_size), varint_size)
+
+
+def _varint_sizes(values):
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += (values >> np.uint64(shift)) != 0
+    return sizes
+
+
+def _varint_bytes(values, size):
+    out = np.empty((len(values), size), dtype=np.uint8)
+    for j in range(size):
+        byte = (values >> np.uint64(7 * j)) & np.uint64(0x7F)
+        if j < size - 1:
+            byte |= np.uint64(0x80)
+        out[:, j] = byte
+    return out
+
+
+def encode_examples(float_features, int_features):
+    """
+    Inputs:
+    - float_features: list of (name, array) pairs, each array of shape
+      (rows, size) and stored as a FloatList of `size` values
+    - int_features: list of (name, array) pairs, each array of shape
+      (rows,) and stored as a single value Int64List
+
+    Returns a list with one serialized tf.train.Example per row
+    """
+    float_features = [
+        (name, np.ascontiguousarray(values, dtype="<f4").reshape(len(values), -1))
+        for name, values in float_features
+    ]
+    int_features = [
+        (name, np.asarray(values, dtype=np.int64).view(np.uint64))
+        for name, values in int_features
+    ]
+    arrays = [values for _, values in float_features + int_features]
+    n_rows = len(arrays[0]) if arrays else 0
+
+    float_segments = []
+    for name, values in float_features:
+        prefix = np.frombuffer(_float_prefix(name, values.shape[1]), dtype=np.uint8)
+        float_segments.append((prefix, values.view(np.uint8)))
+
+    # integers are varint encoded so rows only share a layout
+    # when all of their integers need the same number of bytes
+    if int_features:
+        sizes = np.stack([_varint_sizes(values) for _, values in int_features], axis=1)
+        layouts, layout_of_row = np.unique(sizes, axis=0, return_inverse=True)
+        layout_of_row = layout_of_row.reshape(-1)
+    else:
+        layouts = np.zeros((1, 0), dtype=np.int64)
+        layout_of_row = np.zeros(n_rows, dtype=np.int64)
+
+    records = [None] * n_rows
+    for layout_index, layout in enumerate(layouts):
+        rows = np.flatnonzero(layout_of_row == layout_index)
+        segments = [(prefix, payload[rows]) for prefix, payload in float_segments]
+        for (name, values), size in zip(int_features, layout):
+            prefix = np.frombuffer(_int_prefix(name, int(size)), dtype=np.uint8)
+            segments.append((prefix, _varint_bytes(values[rows], int(size))))
+
+        body_size = sum(len(prefix) + payload.shape[1] for prefix, payload in segments)
+        header = np.frombuffer(bytes([0x0A]) + _varint(body_size), dtype=np.uint8)
+        record_size = len(header) + body_size
+
+        out = np.empty((len(rows), record_size), dtype=np.uint8)
+        out[:, :len(header)] = header
+        offset = len(header)
+        for prefix, payload in segments:
+            out[:, offset:offset + len(prefix)] = prefix
+            offset += len(prefix)
+            out[:, offset:offset + payload.shape[1]] = payload
+            offset += payload.shape[1]
+
+        buffer = out.tobytes()
+        for i, row in enumerate(rows):
+            records[row] = buffer[i * record_size:(i + 1) * record_size]
+
+    return records
+
+
+def iter_encoded_chunks(float_features, int_features, chunk_size=10000):
+    """
+    Yields lists of serialized Examples for consecutive chunks of
+    `chunk_size` rows so that only one chunk is ever held as bytes
+    """
+    arrays = [values for _, values in float_features + int_features]
+    n_rows = len(arrays[0]) if arrays else 0
+    for start in range(0, n_rows, chunk_size):
+        stop = start + chunk_size
+        yield encode_examples(
+            [(name, values[start:stop]) for name, values in float_features],
+            [(name, values[start:stop]) for name, values in int_features],
+        )
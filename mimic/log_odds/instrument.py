@@ -0,0 +1,115 @@
+"""
+Lightweight per job instrumentation. A job times its stages, counts the
+rows and bytes they handle and emits one JSON record with the totals and
+the peak resident memory, to size the memory and vcpus of the batch jobs.
+"""
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+import pandas as pd
+
+import haven.db as db
+
+# every job writes the same columns to the shared metrics table, with its
+# context and stages as JSON strings, so the table keeps a single schema
+METRICS_COLUMNS = ["job", "batch_job_id", "seconds", "peak_rss_mb", "children_peak_rss_mb", "context", "stages"]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def frame_bytes(data):
+    """
+    Returns the (shallow) in memory size of a DataFrame
+    """
+    return int(data.memory_usage(index=False).sum())
+
+
+def file_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+class JobMetrics:
+    """
+    Inputs:
+    - job: str, name of the job, eg. "build_tfrecord"
+    - context: identifying values (partition, run_id, ...) that are
+      kept under "context" in the record
+    """
+    def __init__(self, job, **context):
+        self.job = job
+        self.context = context
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    def count(self, name, **counts):
+        """
+        Adds `counts` (rows, bytes_read, bytes_written, ...)
+        to the totals of stage `name`
+        """
+        stage = self.stages.setdefault(name, {"seconds": 0.0})
+        for key, value in counts.items():
+            stage[key] = stage.get(key, 0) + value
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the body and yields a dict to set counts on, both are
+        added to the totals of stage `name` so a stage can be entered
+        once per chunk
+        """
+        counts = {}
+        start = time.perf_counter()
+        yield counts
+        self.count(name, seconds=time.perf_counter() - start, **counts)
+
+    def iterate(self, name, iterable):
+        """
+        Yields the items of `iterable`, adding the time spent
+        waiting on each of them to stage `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self):
+        return {
+            "job": self.job,
+            "batch_job_id": os.environ.get("AWS_BATCH_JOB_ID", ""),
+            "seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "context": self.context,
+            "stages": self.stages,
+        }
+
+    def emit(self, database=None, table=None):
+        """
+        Prints the job's record as a single JSON line and appends it to
+        the haven `table` (as METRICS_COLUMNS) if one is given
+
+        Returns the record
+        """
+        record = self.record()
+        print(json.dumps(record, default=str))
+        if table is not None:
+            row = {
+                **record,
+                "context": json.dumps(record["context"], sort_keys=True, default=str),
+                "stages": json.dumps(record["stages"], sort_keys=True),
+            }
+            os.environ["HAVEN_DATABASE"] = database
+            db.write_data(pd.DataFrame([row], columns=METRICS_COLUMNS), table, ['job'])
+        return record
+
@@ -0,0 +1,124 @@
+"""
+Runs every partition of a fan-out stage on this machine with a process
+pool instead of through the Lambda launchers and AWS Batch. The worker
+configs are expanded from the same launcher configs the Lambdas take.
+"""
+import time
+import traceback
+import multiprocessing
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# keys only the launchers understand
+LAUNCHER_KEYS = ["train_partitions", "test_partitions", "partitions", "partitions_per_job"]
+
+
+def worker_configs(event, ranges=False):
+    """
+    Inputs:
+    - event: dict, launcher config (as sent to the stage's Lambda)
+    - ranges: bool, give each worker a [start, stop) `partition_range`
+      of `partitions_per_job` partitions rather than one `partition`
+
+    Returns the list of worker configs the Lambda would submit, with a
+    plan every partition of a split gets its own config
+    """
+    base_config = copy(event)
+    for key in LAUNCHER_KEYS:
+        base_config.pop(key, None)
+    partitions_per_job = event.get("partitions_per_job", 1) if ranges and "plan" not in event else 1
+
+    configs = []
+    for split, train in [("train", True), ("test", False)]:
+        total_partitions = event[f"{split}_partitions"]
+        if "partitions" in event:
+            partitions = event["partitions"][split]
+        else:
+            partitions = range(0, total_partitions, partitions_per_job)
+        for partition in partitions:
+            config = copy(base_config)
+            config["train"] = train
+            config["total_partitions"] = total_partitions
+            if ranges and "plan" not in event:
+                config["partition_range"] = [partition, min(partition + partitions_per_job, total_partitions)]
+            else:
+                config["partition"] = partition
+            configs.append(config)
+    return configs
+
+
+def build_tfrecord_worker(config):
+    from mimic.log_odds.build_tfrecord import build_tfrecord
+    from mimic.log_odds.manifest import resolve_manifest
+    from mimic.log_odds.planner import resolve_plan
+    build_tfrecord(**resolve_manifest(resolve_plan(config)))
+
+
+def build_contrast_worker(config):
+    from mimic.log_odds.build_contrast import build_contrast_func
+    from mimic.log_odds.planner import resolve_plan
+    build_contrast_func(**resolve_plan(config))
+
+
+def batch_infer_worker(config):
+    """
+    Scores a list of `partitions`, a [start, stop) `partition_range`
+    or a single `partition` with one load of the model
+    """
+    from mimic.log_odds.batch_infer import run_inference_partitions
+    from mimic.log_odds.planner import resolve_plan
+    config = resolve_plan(config)
+    if "partition_range" in config:
+        config["partitions"] = list(range(*config.pop("partition_range")))
+    elif "partition" in config:
+        config["partitions"] = [config.pop("partition")]
+    run_inference_partitions(**config)
+
+
+def describe(config):
+    split = "train" if config["train"] else "test"
+    if "partition_range" in config:
+        return f"{split} partitions {config['partition_range'][0]}-{config['partition_range'][1] - 1}"
+    return f"{split} partition {config['partition']}"
+
+
+def _run(worker, config):
+    start = time.perf_counter()
+    try:
+        worker(config)
+    except Exception:
+        return time.perf_counter() - start, traceback.format_exc()
+    return time.perf_counter() - start, None
+
+
+def run_local(worker, configs, processes=1):
+    """
+    Inputs:
+    - worker: function, run with each config
+    - configs: list of dicts, worker configs
+    - processes: int, number of partitions run at once, 1 runs
+      them one after the other in this process
+
+    Prints a line as each partition finishes. Returns a list of
+    (description, traceback) for every partition that failed.
+    """
+    failures = []
+
+    def _report(done, config, seconds, error):
+        status = "failed" if error else "done"
+        print(f"[{done}/{len(configs)}] {describe(config)} {status} in {seconds:.1f}s", flush=True)
+        if error:
+            failures.append((describe(config), error))
+
+    if processes == 1:
+        for done, config in enumerate(configs, start=1):
+            _report(done, config, *_run(worker, config))
+        return failures
+
+    # tensorflow does not survive a fork so the workers are spawned
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = {executor.submit(_run, worker, config): config for config in configs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            _report(done, futures[future], *future.result())
+    return failures
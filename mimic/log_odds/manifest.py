@@ -0,0 +1,126 @@
+"""
+Fingerprints of the partitions of a dataset, so that an incremental
+build only rebuilds the partitions whose source rows (or build config)
+changed since they were last built.
+
+Every built partition has a manifest.json next to its shards, written
+only once the shards are uploaded, holding the fingerprints it was
+built from. The manifests an incremental build will write are stored
+in s3 and the launchers only pass their uri along, as with plans.
+"""
+import os
+import json
+import hashlib
+from copy import copy
+
+import boto3
+from botocore.exceptions import ClientError
+
+import haven.db as db
+
+from mimic.log_odds.build_tfrecord import KEY_COLUMNS, manifest_key
+from mimic.log_odds.queries import partition_fingerprints_sql, stage_columns
+from mimic.log_odds.transfer import parse_s3_uri
+
+# the parts of a build config that change the records of a partition
+CONFIG_KEYS = [
+    "table", "max_choices", "features", "missing_values_map", "layout",
+    "partition_key", "bucket_column", "train_partitions", "test_partitions",
+]
+
+
+def config_fingerprint(config):
+    fingerprinted = {key: config.get(key) for key in CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(fingerprinted, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_partition_fingerprints(
+    database, table, total_partitions, train, columns, key="_decision", bucket_column=None
+):
+    """
+    Returns a dict from partition (as a string) to the fingerprint of
+    its source rows, partitions without any rows are left out
+    """
+    os.environ["HAVEN_DATABASE"] = database
+    fingerprints = db.read_data(
+        partition_fingerprints_sql(table, total_partitions, train, columns, key, bucket_column)
+    )
+    return {
+        str(partition): f"{rows}-{checksum}"
+        for partition, rows, checksum in zip(
+            fingerprints['_partition'].tolist(), fingerprints['_rows'].tolist(), fingerprints['_checksum'].tolist(),
+        )
+    }
+
+
+def read_manifest(s3, bucket, dataset, partition, train):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=manifest_key(dataset, partition, train))
+    except ClientError:
+        return None
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def load_manifests(uri, s3=None):
+    bucket, key = parse_s3_uri(uri)
+    response = (s3 or boto3.client('s3')).get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def resolve_manifest(config):
+    """
+    For a worker config pointing at the `manifests` of an
+    incremental build, fills in the manifest of its partition
+    """
+    if "manifests" not in config:
+        return config
+    config = copy(config)
+    manifests = load_manifests(config.pop("manifests"))
+    split = "train" if config["train"] else "test"
+    config["manifest"] = manifests[split][str(config["partition"])]
+    return config
+
+
+def incremental_event(event, s3=None):
+    """
+    Inputs:
+    - event: dict, build-dataset launcher config
+
+    Fingerprints every partition of both splits and compares them with
+    the manifests of the current build, partitions being the values of
+    `bucket_column` when the table was written by repartition. Returns
+    the event restricted to the `partitions` of each split that need
+    rebuilding along with the uri of the `manifests` their workers write
+    once they are done, stored under _manifests/ in the tfrecords bucket
+    (or at `manifests_uri`) as they can outgrow a Lambda or Batch payload.
+    """
+    if "plan" in event:
+        raise ValueError("incremental builds are not supported for planned partitions")
+    s3 = s3 or boto3.client('s3')
+    event = copy(event)
+    bucket = f"{event['space']}-tfrecords"
+    uri = event.pop("manifests_uri", f"s3://{bucket}/_manifests/{event['dataset']}.json")
+    build = config_fingerprint(event)
+    columns = stage_columns(KEY_COLUMNS, event["features"])
+    key = event.get("partition_key", "_decision")
+
+    event["partitions"], manifests = {}, {}
+    for split, train in [("train", True), ("test", False)]:
+        total_partitions = event[f"{split}_partitions"]
+        fingerprints = read_partition_fingerprints(
+            event["database"], event["table"], total_partitions, train, columns, key,
+            event.get("bucket_column"),
+        )
+        event["partitions"][split], manifests[split] = [], {}
+        for partition in range(total_partitions):
+            manifest = {"config": build, "rows": fingerprints.get(str(partition), "empty")}
+            if read_manifest(s3, bucket, event["dataset"], partition, train) == manifest:
+                continue
+            event["partitions"][split].append(partition)
+            manifests[split][str(partition)] = manifest
+        print(f"{split}: rebuilding {len(event['partitions'][split])} of {total_partitions} partitions")
+
+    manifests_bucket, manifests_key = parse_s3_uri(uri)
+    s3.put_object(Bucket=manifests_bucket, Key=manifests_key, Body=json.dumps(manifests))
+    event["manifests"] = uri
+    return event
@@ -0,0 +1,120 @@
+"""
+A TensorFlow free runtime for the single choice models exported by
+build_model.build_export_model, which are plain stacks of Dense layers.
+"""
+import numpy as np
+
+
+def _sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+
+def _selu(x):
+    return 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0)))
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "relu6": lambda x: np.clip(x, 0, 6),
+    "leaky_relu": lambda x: np.where(x > 0, x, 0.2 * x),
+    "sigmoid": _sigmoid,
+    "tanh": np.tanh,
+    "elu": _elu,
+    "selu": _selu,
+    "softplus": lambda x: np.logaddexp(x, 0),
+    "softsign": lambda x: x / (1 + np.abs(x)),
+    "silu": lambda x: x * _sigmoid(x),
+    "swish": lambda x: x * _sigmoid(x),
+    "exponential": np.exp,
+}
+
+
+# precisions the kernels of an export can be stored in, the
+# biases are small and always kept in float32
+PRECISIONS = ["float32", "float16", "int8"]
+
+
+class UnsupportedLayerError(ValueError):
+    pass
+
+
+def quantize_kernel(kernel):
+    """
+    Returns the int8 kernel and the float32 scale of each of its output
+    columns (symmetric per column quantization) so that kernel is
+    approximately quantized * scale
+    """
+    scale = np.abs(kernel).max(axis=0) / 127
+    scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+    quantized = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+class NumpyModel:
+    """
+    Inputs:
+    - layers: list of (kernel, bias, activation) tuples applied in order
+    """
+    def __init__(self, layers):
+        for _, _, activation in layers:
+            if not isinstance(activation, str) or activation not in ACTIVATIONS:
+                raise UnsupportedLayerError(f"unsupported activation {activation}")
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an export of any precision, reduced precision kernels
+        are dequantized to float32 once here
+        """
+        with np.load(path) as arrays:
+            activations = [str(activation) for activation in arrays["activations"]]
+            layers = []
+            for i, activation in enumerate(activations):
+                kernel = arrays[f"kernel_{i}"]
+                if kernel.dtype in (np.float16, np.int8):
+                    kernel = kernel.astype(np.float32)
+                if f"scale_{i}" in arrays.files:
+                    kernel = kernel * arrays[f"scale_{i}"]
+                layers.append((kernel, arrays[f"bias_{i}"], activation))
+        return cls(layers)
+
+    def save(self, path, precision="float32"):
+        """
+        Inputs:
+        - path: str, where to write the .npz
+        - precision: str, one of PRECISIONS, float16 halves and int8
+          quarters the size of the kernels at some cost in accuracy
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"unknown precision {precision}")
+        arrays = {"activations": np.array([activation for _, _, activation in self.layers])}
+        for i, (kernel, bias, _) in enumerate(self.layers):
+            if precision == "float16":
+                kernel = kernel.astype(np.float16)
+            elif precision == "int8":
+                kernel, arrays[f"scale_{i}"] = quantize_kernel(kernel)
+            arrays[f"kernel_{i}"] = kernel
+            arrays[f"bias_{i}"] = bias
+        np.savez(path, **arrays)
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """
+        Mirrors keras.Model.predict for a (rows, features) array
+        """
+        x = np.asarray(x, dtype=np.float32)
+        batch_size = batch_size or max(len(x), 1)
+        outputs = []
+        for start in range(0, len(x), batch_size):
+            output = x[start:start + batch_size]
+            for kernel, bias, activation in self.layers:
+                output = ACTIVATIONS[activation](output @ kernel + bias)
+            outputs.append(output)
+        if not outputs:
+            return np.zeros((0, self.layers[-1][0].shape[1]), dtype=np.float32)
+        return np.concatenate(outputs)
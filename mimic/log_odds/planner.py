@@ -0,0 +1,101 @@
+import os
+import json
+import heapq
+from copy import copy
+
+import boto3
+
+import haven.db as db
+
+from mimic.log_odds.queries import key_weights_sql
+from mimic.log_odds.transfer import parse_s3_uri
+
+
+def read_key_weights(database, table, key, train):
+    """
+    Returns a dict of the number of rows for each value of `key`
+    """
+    os.environ["HAVEN_DATABASE"] = database
+    weights = db.read_data(key_weights_sql(table, key, train))
+    return dict(zip(weights[key].tolist(), weights['_rows'].tolist()))
+
+
+def plan_partitions(weights, total_partitions):
+    """
+    Inputs:
+    - weights: dict, number of rows for each key
+    - total_partitions: int, number of partitions to plan
+
+    Assigns keys, heaviest first, to whichever partition currently
+    holds the fewest rows. Returns a dict from partition (as a string,
+    as it will be stored in json) to the sorted list of its keys.
+    """
+    heap = [(0, partition) for partition in range(total_partitions)]
+    plan = {partition: [] for partition in range(total_partitions)}
+    for key, rows in sorted(weights.items(), key=lambda item: (-item[1], str(item[0]))):
+        load, partition = heapq.heappop(heap)
+        plan[partition].append(key)
+        heapq.heappush(heap, (load + rows, partition))
+    return {str(partition): sorted(keys) for partition, keys in plan.items()}
+
+
+def build_plan(database, table, key, train_partitions, test_partitions):
+    plan = {"key": key}
+    for split, train, total_partitions in [("train", True, train_partitions), ("test", False, test_partitions)]:
+        weights = read_key_weights(database, table, key, train)
+        plan[split] = plan_partitions(weights, total_partitions)
+    return plan
+
+
+def write_plan(uri, plan):
+    bucket, key = parse_s3_uri(uri)
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=json.dumps(plan))
+
+
+def load_plan(uri):
+    bucket, key = parse_s3_uri(uri)
+    response = boto3.client('s3').get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def plan_event(event, stage, name, table, default_key="_individual"):
+    """
+    Inputs:
+    - event: dict, launcher config with train_partitions and test_partitions
+    - stage: str, name of the stage being launched
+    - name: str, name of what the stage is building
+    - table: str, table the stage reads
+    - default_key: str, key to plan on when the event has no plan_key
+
+    Plans the partitions of both splits by row count, stores the plan
+    as a manifest and returns the event pointing the launcher at it
+    """
+    event = copy(event)
+    key = event.pop("plan_key", default_key)
+    space = event.get("space", "mimic-log-odds")
+    # the batch job role can read the tfrecords bucket, and the
+    # leading underscore keeps plans clear of dataset prefixes
+    uri = event.pop("plan_uri", f"s3://{space}-tfrecords/_plans/{stage}/{name}.json")
+
+    plan = build_plan(event["database"], table, key, event["train_partitions"], event["test_partitions"])
+    write_plan(uri, plan)
+    event["plan"] = uri
+    return event
+
+
+def resolve_plan(config):
+    """
+    For a worker config pointing at a plan manifest, picks the
+    partition from the batch array index and fills in its keys
+    """
+    if "plan" not in config:
+        return config
+    config = copy(config)
+    plan = load_plan(config.pop("plan"))
+    split = plan["train" if config["train"] else "test"]
+    partition = int(os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX", config.get("partition", 0)))
+    config["partition"] = partition
+    config["total_partitions"] = len(split)
+    config["partition_key"] = plan["key"]
+    config["keys"] = split[str(partition)]
+    return config
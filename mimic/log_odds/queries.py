@@ -0,0 +1,142 @@
+# columns besides the features that the stages reading one row
+# per choice (batch infer, contrasts, repartition) need
+KEY_COLUMNS = ['_individual', '_decision', '_choice', '_selected', '_train']
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def select_list(columns=None):
+    return "*" if columns is None else ", ".join(columns)
+
+
+def stage_columns(key_columns, features=None):
+    """
+    Returns the key columns followed by the features, without
+    duplicates, or None (select everything) if there are no features
+    """
+    if features is None:
+        return None
+    return list(dict.fromkeys(list(key_columns) + list(features)))
+
+
+def partition_sql(
+    table, partition, total_partitions, train, key="_decision",
+    chunk=None, chunks=None, keys=None, bucket_column=None, columns=None,
+):
+    """
+    Inputs:
+    - table: str, table to read from
+    - partition: int, partition to read
+    - total_partitions: int, number of partitions
+    - train: bool, whether to read the training or the test rows
+    - key: str, column rows are partitioned on
+    - chunk: int, chunk of the partition to read
+    - chunks: int, number of chunks the partition is split into, rows
+      sharing a _decision always land in the same chunk
+    - keys: list, values of `key` in the partition when the partition
+      comes from a plan (see planner) rather than `key % total_partitions`
+    - bucket_column: str, column of a table written by repartition that
+      already holds each row's partition, lets athena prune to it
+    - columns: list of strings, columns to select, all if not given
+
+    Returns the sql selecting the rows of the partition (or chunk)
+    """
+    if bucket_column is not None:
+        conditions = [f"{bucket_column} = {partition}"]
+    elif keys is None:
+        conditions = [f"{key} % {total_partitions} = {partition}"]
+    elif keys:
+        conditions = [f"{key} in ({', '.join(sql_literal(value) for value in keys)})"]
+    else:
+        conditions = ["false"]
+    conditions.append(f"{'' if train else 'not'} _train")
+    if chunks is not None and chunks > 1:
+        if bucket_column is None and keys is None and key == "_decision":
+            conditions.append(f"(_decision / {total_partitions}) % {chunks} = {chunk}")
+        else:
+            conditions.append(f"_decision % {chunks} = {chunk}")
+    where = "\n        and ".join(conditions)
+    return f"""
+    select 
+        {select_list(columns)}
+    from 
+        {table}
+    where 
+        {where}
+    """
+
+
+def split_sql(table, train, columns=None, key=None, chunk=None, chunks=None):
+    """
+    Returns the sql selecting all of the training or test rows, or
+    the `key % chunks = chunk` chunk of them when `chunks` is given
+    """
+    conditions = [f"{'' if train else 'not'} _train"]
+    if chunks is not None and chunks > 1:
+        conditions.append(f"{key} % {chunks} = {chunk}")
+    where = "\n        and ".join(conditions)
+    return f"""
+    select 
+        {select_list(columns)}
+    from 
+        {table}
+    where 
+        {where}
+    """
+
+
+def split_rows_sql(table, train):
+    """
+    Returns the sql counting the training or test rows
+    """
+    return f"""
+    select 
+        count(*) as _rows
+    from 
+        {table}
+    where 
+        {'' if train else 'not'} _train
+    """
+
+
+def key_weights_sql(table, key, train):
+    """
+    Returns the sql counting the rows of each value of `key`
+    """
+    return f"""
+    select 
+        {key}, count(*) as _rows
+    from 
+        {table}
+    where 
+        {'' if train else 'not'} _train
+    group by 
+        {key}
+    """
+
+
+def partition_fingerprints_sql(table, total_partitions, train, columns, key="_decision", bucket_column=None):
+    """
+    Returns the sql counting and checksumming the `columns` of
+    the rows of every `key % total_partitions` partition, or of every
+    `bucket_column` value for tables written by repartition. checksum
+    is order insensitive so any change to the rows of a partition
+    (and nothing else) changes its fingerprint.
+    """
+    partition = f"{key} % {total_partitions}" if bucket_column is None else bucket_column
+    return f"""
+    select 
+        {partition} as _partition,
+        count(*) as _rows,
+        to_hex(checksum(row({", ".join(columns)}))) as _checksum
+    from 
+        {table}
+    where 
+        {'' if train else 'not'} _train
+    group by 
+        1
+    """
@@ -0,0 +1,96 @@
+import os
+import math
+
+import numpy as np
+import haven.db as db
+
+from mimic.log_odds.planner import load_plan
+from mimic.log_odds.queries import KEY_COLUMNS, split_rows_sql, split_sql, stage_columns
+
+
+def assign_buckets(data, total_partitions, partition_key="_individual", assignments=None):
+    """
+    Inputs:
+    - data: pd.DataFrame, rows of one split
+    - total_partitions: int, number of partitions of the split
+    - partition_key: str, column rows are partitioned on
+    - assignments: dict, partition (as a string) to keys from a plan,
+      `partition_key % total_partitions` is used when not given
+
+    Returns the bucket (partition) of every row
+    """
+    if assignments is None:
+        return (data[partition_key] % total_partitions).to_numpy()
+    bucket_of_key = {
+        key: int(partition)
+        for partition, keys in assignments.items()
+        for key in keys
+    }
+    buckets = data[partition_key].map(bucket_of_key)
+    if buckets.isna().any():
+        raise ValueError(f"the plan does not cover every {partition_key}")
+    return buckets.to_numpy(dtype=np.int64)
+
+
+def split_chunks(table, train, chunk_rows):
+    """
+    Returns the number of chunks that keeps each chunk of
+    the split at about `chunk_rows` rows
+    """
+    if chunk_rows is None:
+        return 1
+    rows = int(db.read_data(split_rows_sql(table, train))['_rows'].iloc[0])
+    return max(math.ceil(rows / chunk_rows), 1)
+
+
+def repartition(
+    database, source_table, destination_table, train_partitions, test_partitions,
+    partition_key="_individual", plan=None, bucket_column="_bucket", features=None,
+    chunk_rows=5000000,
+):
+    """
+    Inputs:
+    - database: str, haven database
+    - source_table: str, table to repartition
+    - destination_table: str, table to write
+    - train_partitions, test_partitions: int, partitions of each split
+    - partition_key: str, column rows are partitioned on
+    - plan: str, s3 uri of a plan manifest to take the partitions from
+    - bucket_column: str, name of the column holding the partition
+    - features: list of strings, features to keep, every column of
+      the source table is kept if not given
+    - chunk_rows: int, about how many rows are read and written at
+      once, each split is read in one go if None
+
+    Reads each split of the source table in `partition_key % chunks`
+    chunks of about `chunk_rows` rows and writes them back out physically
+    partitioned on `bucket_column`, so stages reading a single partition
+    (with the same `bucket_column` in their config) only scan that
+    partition. Only one chunk is held in memory at a time. Each chunk is
+    written to its own `_chunk` partition, below `bucket_column`, so the
+    chunks of a bucket never overwrite each other and a retry rewrites
+    the same partitions. Without a plan the buckets are computed in the
+    query. Every chunk's query scans the split again, so fewer, larger
+    chunks scan less.
+    """
+    if plan is not None:
+        plan = load_plan(plan)
+        partition_key = plan["key"]
+
+    columns = stage_columns(KEY_COLUMNS + [partition_key], features)
+    os.environ["HAVEN_DATABASE"] = database
+    for split, train, total_partitions in [("train", True, train_partitions), ("test", False, test_partitions)]:
+        if plan is None:
+            split_columns = (columns or ["*"]) + [f"{partition_key} % {total_partitions} as {bucket_column}"]
+        else:
+            split_columns = columns
+        chunks = split_chunks(source_table, train, chunk_rows)
+        for chunk in range(chunks):
+            data = db.read_data(split_sql(source_table, train, split_columns, partition_key, chunk, chunks))
+            if data.empty:
+                continue
+            if plan is not None:
+                data[bucket_column] = assign_buckets(data, total_partitions, partition_key, plan[split])
+            data['_chunk'] = chunk
+            db.write_data(data, destination_table, ['_train', bucket_column, '_chunk'])
+            del data
@@ -0,0 +1,103 @@
+"""
+Conversions between the long layout (one row per choice) and the wide
+layout (one row per decision with a {column}_{i} column per choice slot)
+of choice data.
+
+Both directions go through a single contiguous (decisions, max_choices,
+columns) block, so switching layouts is a reshape (a view) rather than
+a concat of per slot copies.
+"""
+import numpy as np
+import pandas as pd
+
+
+def wide_columns(columns, max_choices):
+    """
+    Returns the wide names of `columns`, slot by slot, ie.
+    a_0, b_0, a_1, b_1, ...
+    """
+    return [f"{column}_{i}" for i in range(max_choices) for column in columns]
+
+
+def scatter_choices(decision, position, values, max_choices, fill):
+    """
+    Inputs:
+    - decision: int array, decision (row of the block) of each choice
+    - position: int array, slot of each choice within its decision
+    - values: array of shape (choices, columns)
+    - max_choices: int, number of slots per decision
+    - fill: array of shape (columns,), value of empty slots
+
+    Returns the (decisions, max_choices, columns) block
+    """
+    n_decisions = int(decision.max()) + 1 if len(decision) else 0
+    block = np.empty((n_decisions, max_choices, values.shape[1]), dtype=values.dtype)
+    block[:] = fill
+    block[decision, position] = values
+    return block
+
+
+def block_to_wide(keys, block, columns):
+    """
+    Inputs:
+    - keys: pd.DataFrame, one row per decision
+    - block: array of shape (decisions, max_choices, columns)
+    - columns: list of strings, names of the last axis of the block
+
+    Returns `keys` followed by the wide columns. The wide columns
+    share the memory of a contiguous block.
+    """
+    wide = pd.DataFrame(
+        # -1 cannot be resolved for a block without decisions
+        block.reshape(block.shape[0], block.shape[1] * block.shape[2]),
+        columns=wide_columns(columns, block.shape[1]),
+        copy=False,
+    )
+    for i, column in enumerate(keys.columns):
+        wide.insert(i, column, keys[column].to_numpy())
+    return wide
+
+
+def wide_to_block(data, columns, max_choices):
+    """
+    Returns the (decisions, max_choices, columns) block of the wide
+    columns of `data`, copied once into a common dtype
+    """
+    names = wide_columns(columns, max_choices)
+    # filling column by column avoids the intermediate frame
+    # that selecting all of the wide columns at once would copy
+    block = np.empty((len(data), len(names)), dtype=np.result_type(*data.dtypes[names]))
+    for j, name in enumerate(names):
+        block[:, j] = data[name].to_numpy()
+    return block.reshape(len(data), max_choices, len(columns))
+
+
+def wide_to_long(data, columns, max_choices, id_columns=(), n_choices=None):
+    """
+    Inputs:
+    - data: pd.DataFrame, wide layout with {column}_{i} columns
+    - columns: list of strings, columns to bring back to the long layout
+    - max_choices: int, number of slots per decision
+    - id_columns: list of strings, per decision columns to repeat for
+      each of its choices
+    - n_choices: array of shape (decisions,), number of real choices
+      of each decision, the padding slots are dropped when given
+
+    Returns one row per (decision, slot) in decision order, holding
+    `columns` followed by `id_columns`. A column keeps its dtype when
+    all of its slots share it.
+    """
+    block = wide_to_block(data, columns, max_choices)
+    long = pd.DataFrame(block.reshape(-1, len(columns)), columns=columns, copy=False)
+
+    for column in columns:
+        dtypes = set(data[f"{column}_{i}"].dtype for i in range(max_choices))
+        if len(dtypes) == 1 and long[column].dtype != next(iter(dtypes)):
+            long[column] = long[column].astype(next(iter(dtypes)))
+    for column in id_columns:
+        long[column] = np.repeat(data[column].to_numpy(), max_choices)
+
+    if n_choices is not None:
+        slots = np.tile(np.arange(max_choices), len(data))
+        long = long[slots < np.repeat(np.asarray(n_choices), max_choices)].reset_index(drop=True)
+    return long
@@ -0,0 +1,188 @@
+"""
+Writes serialized records to TFRecord shard files, either through
+tensorflow's TFRecordWriter or framed with numpy so that the processes
+writing shards in parallel start without importing tensorflow.
+
+A TFRecord file is a sequence of
+    uint64 length, uint32 masked crc32c(length), data, uint32 masked crc32c(data)
+all little endian. With numpy, records of the same length are framed
+together, with their crcs computed over all of them at once. That costs
+more per byte than TFRecordWriter's native crc, increasingly so for
+wide records, so it only pays off where it saves the tensorflow import.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from mimic.log_odds.encode import iter_encoded_chunks
+
+# how records are framed, "numpy" keeps tensorflow out of the process
+FRAMINGS = ["tensorflow", "numpy"]
+
+
+def _crc32c_table():
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0x82F63B78), table >> 1).astype(np.uint32)
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+
+
+def _crc32c(data):
+    crc = 0xFFFFFFFF
+    for byte in data.tobytes():
+        crc = int(CRC32C_TABLE[(crc ^ byte) & 0xFF]) ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+@lru_cache(maxsize=16)
+def _position_tables(length):
+    """
+    Returns the (length, 256) table of what each byte value at each
+    position of a `length` byte message xors into its crc
+    """
+    tables = np.empty((length, 256), dtype=np.uint32)
+    table = CRC32C_TABLE
+    for position in range(length - 1, -1, -1):
+        tables[position] = table
+        # one more byte after this position shifts its effect
+        table = CRC32C_TABLE[table & np.uint32(0xFF)] ^ (table >> np.uint32(8))
+    return tables
+
+
+def masked_crc32c(data):
+    """
+    Inputs:
+    - data: uint8 array of shape (records, length)
+
+    Returns the masked crc32c of every row, as stored in TFRecord files.
+    The crc is linear so every row's crc is that of the first row xored
+    with the effect of the bytes where it differs from it. Records of one
+    layout only differ in their payloads, which keeps this cheap.
+    """
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    first = data[0]
+    crc = np.full(len(data), _crc32c(first), dtype=np.uint32)
+    varying = np.flatnonzero((data != first).any(axis=0))
+    if len(varying):
+        tables = _position_tables(data.shape[1])
+        differences = np.ascontiguousarray((data[:, varying] ^ first[varying]).T)
+        for position, difference in zip(varying, differences):
+            crc ^= tables[position][difference]
+    return ((crc >> np.uint32(15)) | (crc << np.uint32(17))) + np.uint32(0xA282EAD8)
+
+
+def frame_records(records):
+    """
+    Returns the TFRecord framed bytes of every record, in order
+    """
+    lengths = np.array([len(record) for record in records], dtype=np.int64)
+    framed = [None] * len(records)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        data = np.frombuffer(b"".join(records[row] for row in rows), dtype=np.uint8).reshape(len(rows), int(length))
+        header = np.array([length], dtype="<u8").view(np.uint8)
+        header = header.tobytes() + masked_crc32c(header[None, :]).astype("<u4").tobytes()
+        footers = masked_crc32c(data).astype("<u4").tobytes()
+        for i, row in enumerate(rows):
+            framed[row] = header + records[row] + footers[4 * i:4 * i + 4]
+    return framed
+
+
+def _open_shard(path, framing):
+    if framing == "numpy":
+        return open(path, "wb")
+    import tensorflow as tf
+    return tf.io.TFRecordWriter(path)
+
+
+def write_records(records, output_prefix, max_shard_bytes=None, framing="tensorflow"):
+    """
+    Writes chunks of serialized records to {output_prefix}-{shard}.tfrecord
+    files, rolling over to a new shard once `max_shard_bytes` is reached.
+    `framing` is one of FRAMINGS.
+
+    Returns the list of paths written
+    """
+    if framing not in FRAMINGS:
+        raise ValueError(f"unknown framing {framing}")
+    paths = []
+    writer, shard_bytes = None, 0
+    try:
+        for chunk in records:
+            if framing == "numpy":
+                chunk = frame_records(chunk)
+            for record in chunk:
+                # TFRecordWriter adds 16 bytes of length and crc framing
+                record_bytes = len(record) + (16 if framing == "tensorflow" else 0)
+                if writer is None or (
+                    max_shard_bytes and shard_bytes
+                    and shard_bytes + record_bytes > max_shard_bytes
+                ):
+                    if writer is not None:
+                        writer.close()
+                    paths.append(f"{output_prefix}-{len(paths):05d}.tfrecord")
+                    writer, shard_bytes = _open_shard(paths[-1], framing), 0
+                writer.write(record)
+                shard_bytes += record_bytes
+    finally:
+        if writer is not None:
+            writer.close()
+    return paths
+
+
+def _write_tfrecord_shards(float_features, int_features, output_prefix, max_shard_bytes, chunk_size, framing):
+    records = iter_encoded_chunks(float_features, int_features, chunk_size=chunk_size)
+    return write_records(records, output_prefix, max_shard_bytes, framing)
+
+
+def write_tfrecord_shards(
+    float_features, int_features, output_prefix,
+    max_shard_bytes=None, processes=1, chunk_size=10000, framing=None,
+):
+    """
+    Inputs:
+    - float_features, int_features: feature arrays as taken by encode_examples
+    - output_prefix: str, prefix of the shard files written
+    - max_shard_bytes: int, size at which a new shard is started
+    - processes: int, number of processes encoding and writing in parallel.
+      The workers are spawned and re-import the main module of the
+      launching program, which takes seconds when that is the mimic cli
+      as it imports tensorflow, so more than one only pays off for
+      partitions that take longer than that to write
+    - chunk_size: int, number of rows encoded at once
+    - framing: str, one of FRAMINGS, defaults to "tensorflow" in this
+      process and "numpy" in the spawned ones
+
+    Returns the list of shard paths written
+    """
+    if processes <= 1:
+        return _write_tfrecord_shards(
+            float_features, int_features, output_prefix, max_shard_bytes, chunk_size, framing or "tensorflow",
+        )
+
+    n_rows = len((float_features + int_features)[0][1])
+    bounds = np.linspace(0, n_rows, processes + 1).astype(int)
+    # the parent usually holds tensorflow, which does not
+    # survive a fork, so the workers are spawned
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = [
+            executor.submit(
+                _write_tfrecord_shards,
+                [(name, values[start:stop]) for name, values in float_features],
+                [(name, values[start:stop]) for name, values in int_features],
+                f"{output_prefix}-{worker:03d}",
+                max_shard_bytes,
+                chunk_size,
+                framing or "numpy",
+            )
+            for worker, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))
+            if stop > start
+        ]
+        return [path for future in futures for path in future.result()]
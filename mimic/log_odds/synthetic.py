@@ -0,0 +1,58 @@
+"""
+Synthetic choice data shaped like the feature tables the pipeline reads,
+for benchmarks and tests that have to run offline.
+"""
+import numpy as np
+import pandas as pd
+
+
+def feature_names(n_features):
+    return [f"feature{j}" for j in range(n_features)]
+
+
+def make_choices(
+    individuals, decisions_per_individual, max_choices, n_features,
+    min_choices=1, train_fraction=0.8, seed=0,
+):
+    """
+    Inputs:
+    - individuals: int, number of individuals
+    - decisions_per_individual: int, decisions made by each individual
+    - max_choices: int, largest choice set
+    - n_features: int, number of features (feature0, feature1, ...)
+    - min_choices: int, smallest choice set, sizes are uniform in between
+    - train_fraction: float, fraction of individuals in the training split
+    - seed: int, seed of the generator
+
+    Returns a DataFrame with one row per choice and the _individual,
+    _decision, _choice, _selected and _train columns followed by the
+    features. The selected choice of each decision is drawn from a
+    softmax over a fixed linear utility of the features so that models
+    have something to learn. Rows come shuffled, as they do from athena.
+    """
+    rng = np.random.default_rng(seed)
+    decisions = individuals * decisions_per_individual
+    sizes = rng.integers(min_choices, max_choices + 1, size=decisions)
+    starts = np.cumsum(sizes) - sizes
+    decision = np.repeat(np.arange(decisions), sizes)
+    rows = len(decision)
+
+    values = rng.normal(size=(rows, n_features))
+    utility = values @ rng.normal(size=n_features) + rng.gumbel(size=rows)
+    # the row of the largest gumbel perturbed utility is a softmax draw
+    order = np.lexsort((-utility, decision))
+    selected = np.zeros(rows, dtype=bool)
+    selected[order[starts]] = True
+
+    individual = decision // decisions_per_individual
+    train_individuals = rng.random(individuals) < train_fraction
+    data = pd.DataFrame({
+        '_individual': individual,
+        '_decision': decision,
+        '_choice': np.arange(rows),
+        '_selected': selected,
+        '_train': train_individuals[individual],
+    })
+    for j, feature in enumerate(feature_names(n_features)):
+        data[feature] = values[:, j]
+    return data.take(rng.permutation(rows)).reset_index(drop=True)
@@ -0,0 +1,37 @@
+import os
+import importlib.util
+
+import pytest
+
+LAMBDAS = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'apps', 'log_odds')
+
+
+class StubBatch:
+    def __init__(self):
+        self.jobs = []
+
+    def submit_job(self, **job):
+        self.jobs.append(job)
+
+
+@pytest.fixture
+def load_lambda(monkeypatch):
+    """
+    Returns a function loading apps/log_odds/{app}/lambda/function.py
+    (the lambdas can not import mimic) with its batch client replaced by
+    the StubBatch at `function.batch` and its other clients by the ones
+    passed in by service name
+    """
+    def _load(app, **clients):
+        spec = importlib.util.spec_from_file_location(
+            f"{app}_function", os.path.join(LAMBDAS, app, 'lambda', 'function.py')
+        )
+        function = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(function)
+        function.batch = StubBatch()
+        monkeypatch.setattr(
+            function.boto3, 'client',
+            lambda service, *args, **kwargs: function.batch if service == 'batch' else clients[service],
+        )
+        return function
+    return _load
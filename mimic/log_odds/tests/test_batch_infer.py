@@ -0,0 +1,209 @@
+import os
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+import mimic.log_odds.batch_infer as batch_infer
+from mimic.log_odds.batch_infer import (
+    compact_results,
+    expand_choices,
+    fetch_model_file,
+    infer,
+    prefetch,
+    read_chunks,
+    run_inference_partitions,
+)
+
+
+class SumModel:
+    def predict(self, x, batch_size=None, verbose=0):
+        return x.sum(axis=1, keepdims=True)
+
+
+def test_infer():
+    data = pd.DataFrame([
+        {'_individual': 'a', '_decision': 0, 'f1': 0.0, 'f2': 0.0},
+        {'_individual': 'a', '_decision': 0, 'f1': np.log(3), 'f2': 0.0},
+        {'_individual': 'b', '_decision': 0, 'f1': 1.0, 'f2': 1.0},
+    ])
+
+    result = infer(SumModel(), data, ['f1', 'f2'])
+
+    np.testing.assert_allclose(result['probability'], [0.25, 0.75, 1.0], rtol=1e-6)
+    np.testing.assert_allclose(result['log_odds'], [0.0, np.log(3), 2.0], rtol=1e-6)
+
+
+def test_expand_choices():
+    data = pd.DataFrame({
+        '_individual': ['a', 'b'], '_decision': [0, 1],
+        'f1_0': [1.0, 2.0], '_choice_0': [0, 2], 'probability_0': [0.25, 1.0],
+        'f1_1': [3.0, 0.0], '_choice_1': [1, -1], 'probability_1': [0.75, 0.0],
+    })
+
+    result = expand_choices(2, data, ['f1'], n_choices=[2, 1])
+
+    assert result.to_dict('list') == {
+        'f1': [1.0, 3.0, 2.0],
+        '_choice': [0, 1, 2],
+        'probability': [0.25, 0.75, 1.0],
+        '_individual': ['a', 'a', 'b'],
+        '_decision': [0, 0, 1],
+    }
+
+
+def test_read_chunks(monkeypatch):
+    queries = []
+    monkeypatch.setattr(batch_infer.db, 'read_data', lambda sql: queries.append(sql) or pd.DataFrame())
+
+    chunks = list(read_chunks('haven', 'features', 1, 4, True, chunks=3))
+
+    assert len(chunks) == 3
+    assert [" ".join(sql.split())[-len("(_decision / 4) % 3 = 0"):] for sql in queries] == [
+        f"(_decision / 4) % 3 = {chunk}" for chunk in range(3)
+    ]
+
+
+def test_prefetch():
+    assert list(prefetch(iter(range(5)))) == [0, 1, 2, 3, 4]
+    assert list(prefetch([])) == []
+
+
+def test_fetch_model_file_refetches_retrained_model(tmp_path):
+    moto = pytest.importorskip("moto")
+    path = str(tmp_path / 'experiment' / 'run' / 'model.npz')
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='models')
+        s3.put_object(Bucket='models', Key='experiment/run/model.npz', Body=b'first')
+        first = fetch_model_file(s3, 'models', 'experiment/run/model.npz', path)
+        assert fetch_model_file(s3, 'models', 'experiment/run/model.npz', path) == first
+
+        # a forced retrain overwrites the model under the same run_id
+        s3.put_object(Bucket='models', Key='experiment/run/model.npz', Body=b'second')
+        second = fetch_model_file(s3, 'models', 'experiment/run/model.npz', path)
+
+    assert second != first and second.endswith('.npz')
+    assert open(second, 'rb').read() == b'second'
+    assert os.listdir(tmp_path / 'experiment' / 'run') == [os.path.basename(second)]
+
+
+def test_run_inference_partitions(monkeypatch):
+    loads, writes = [], []
+
+    def read_data(sql):
+        partition = int(" ".join(sql.split()).split("% 4 = ")[1].split()[0])
+        return pd.DataFrame([
+            {'_individual': 'a', '_decision': partition, 'f1': 0.0},
+            {'_individual': 'a', '_decision': partition, 'f1': 1.0},
+        ])
+
+    monkeypatch.setattr(batch_infer, 'load_model', lambda *args: loads.append(args) or SumModel())
+    monkeypatch.setattr(batch_infer.db, 'read_data', read_data)
+    monkeypatch.setattr(batch_infer.db, 'write_data', lambda data, table, partition_cols: writes.append(data))
+
+    run_inference_partitions(
+        'haven', 'features', [1, 3], 4, True, ['f1'], 'scores',
+        'space', 'experiment', 'run', chunks=2,
+    )
+
+    assert len(loads) == 1
+    assert [results['_partition'].iloc[0] for results in writes] == [1, 1, 3, 3]
+    assert all(np.isclose(results['probability'].sum(), 1.0) for results in writes)
+
+
+class PartitionedTable:
+    """
+    Keeps every write, a write replaces the rows
+    of the partitions it covers
+    """
+    def __init__(self):
+        self.partitions = {}
+
+    def write_data(self, data, table, partition_cols):
+        for values, rows in data.groupby(partition_cols):
+            self.partitions[values] = rows
+
+    def rows(self):
+        return pd.concat(self.partitions.values())
+
+
+def test_run_inference_partitions_chunk_writes(monkeypatch):
+    queries = []
+    # decisions 1, 5, ..., 21 of partition 1 of 4, two choices each
+    decisions = np.repeat(np.arange(1, 24, 4), 2)
+
+    def read_data(sql):
+        sql = " ".join(sql.split())
+        queries.append(sql)
+        if "count(*)" in sql:
+            return pd.DataFrame({'_rows': [len(decisions)]})
+        chunk = int(sql.split("% 3 = ")[1].split()[0])
+        chunk_decisions = decisions[(decisions // 4) % 3 == chunk]
+        return pd.DataFrame({
+            '_individual': 'a', '_decision': chunk_decisions, '_choice': np.arange(len(chunk_decisions)) % 2,
+            '_selected': False, '_train': True, 'f1': 1.0,
+        })
+
+    table = PartitionedTable()
+    monkeypatch.setattr(batch_infer, 'load_model', lambda *args: SumModel())
+    monkeypatch.setattr(batch_infer.db, 'read_data', read_data)
+    monkeypatch.setattr(batch_infer.db, 'write_data', table.write_data)
+
+    # the second run is a retry of the same job
+    for _ in range(2):
+        run_inference_partitions(
+            'haven', 'features', [1], 4, True, ['f1'], 'scores', 'space', 'experiment', 'run', chunk_rows=4,
+        )
+
+    assert queries[0] == "select count(*) as _rows from features where _decision % 4 = 1 and _train"
+    assert sorted(chunk for *_, chunk in table.partitions) == [0, 1, 2]
+    rows = table.rows()
+    assert sorted(rows['_decision']) == sorted(decisions)
+    np.testing.assert_allclose(rows['probability'], 0.5)
+
+
+def test_compact_results():
+    data = infer(SumModel(), pd.DataFrame({
+        '_individual': ['a', 'a'], '_decision': [0, 0], '_choice': [0, 1], '_selected': [True, False],
+        '_train': [True, True], 'f1': [0.0, 1.0], 'price': [3.5, 4.0],
+    }), ['f1'])
+
+    compact = compact_results(data, ['log_odds', 'probability'], ['price'])
+
+    assert list(compact.columns) == [
+        '_individual', '_decision', '_choice', '_selected', '_train', 'price', 'log_odds', 'probability',
+    ]
+    assert compact['probability'].dtype == np.float32 and compact['log_odds'].dtype == np.float32
+    np.testing.assert_allclose(compact['probability'], data['probability'], rtol=1e-6)
+    with pytest.raises(ValueError):
+        compact_results(data, ['logits'])
+
+
+def test_run_inference_partitions_compact(monkeypatch):
+    queries, writes = [], []
+
+    def read_data(sql):
+        queries.append(sql)
+        return pd.DataFrame({
+            '_individual': ['a', 'a'], '_decision': [1, 1], '_choice': [0, 1], '_selected': [True, False],
+            '_train': [True, True], 'f1': [0.0, 1.0], 'price': [3.5, 4.0],
+        })
+
+    monkeypatch.setattr(batch_infer, 'load_model', lambda *args: SumModel())
+    monkeypatch.setattr(batch_infer.db, 'read_data', read_data)
+    monkeypatch.setattr(
+        batch_infer.db, 'write_data', lambda data, table, partition_cols: writes.append((data, partition_cols)),
+    )
+
+    run_inference_partitions(
+        'haven', 'features', [1], 4, True, ['f1'], 'scores', 'space', 'experiment', 'run',
+        score_columns=['probability'], passthrough_columns=['price'], chunk_rows=None,
+    )
+
+    assert 'price' in queries[0]
+    (results, partition_cols), = writes
+    assert 'f1' not in results and 'log_odds' not in results
+    assert results['probability'].dtype == np.float32 and list(results['price']) == [3.5, 4.0]
+    assert {'experiment_name', 'run_id'} <= set(partition_cols)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from mimic.log_odds.build_contrast import build_contrast, sample_contrast_rows
+
+
+def make_data():
+    rows = []
+    choice = 0
+    for individual in ['a', 'b']:
+        for decision in range(3):
+            for position in range(3):
+                rows.append({
+                    '_individual': individual,
+                    '_decision': decision,
+                    '_choice': choice,
+                    '_selected': position == 1,
+                    '_train': True,
+                    'size': 10.0 * decision + position,
+                })
+                choice += 1
+    # the last decision of b has nothing to contrast against
+    data = pd.DataFrame(rows)
+    data = data[~((data['_individual'] == 'b') & (data['_decision'] == 2) & ~data['_selected'])]
+    return data.sample(frac=1.0, random_state=0).reset_index(drop=True)
+
+
+def test_sample_contrast_rows():
+    data = make_data()
+    selection_rows, alternative_rows = sample_contrast_rows(
+        data['_individual'].to_numpy(), data['_decision'].to_numpy(), data['_selected'].to_numpy(),
+        4, 3, np.random.default_rng(0),
+    )
+
+    selections = data.iloc[selection_rows]
+    alternatives = data.iloc[alternative_rows]
+    assert len(selections) == len(alternatives)
+    assert len(selections) % 3 == 0
+    assert selections['_selected'].all()
+    assert not alternatives['_selected'].any()
+    assert (selections['_individual'].to_numpy() == alternatives['_individual'].to_numpy()).all()
+    assert (selections['_decision'].to_numpy() == alternatives['_decision'].to_numpy()).all()
+    assert not ((selections['_individual'] == 'b') & (selections['_decision'] == 2)).any()
+    # selections come out in (individual, decision) order
+    keys = list(zip(selections['_individual'], selections['_decision']))
+    assert keys == sorted(keys)
+
+
+def test_build_contrast():
+    data = make_data()
+
+    contrast = build_contrast(data, 2, 2, np.random.default_rng(0))
+
+    contrasts = len(contrast) // 2
+    assert list(contrast.columns[:2]) == ['_choice', '_decision']
+    assert contrast['_choice'].tolist() == list(range(2 * contrasts))
+    assert contrast['_decision'].tolist() == list(range(contrasts)) * 2
+    assert contrast['_selected'].tolist() == [True] * contrasts + [False] * contrasts
+    assert (contrast.groupby('_decision')['_old_decision'].nunique() == 1).all()
+    assert (contrast.groupby('_decision')['_individual'].nunique() == 1).all()
+    merged = contrast.merge(data, left_on='_old_choice', right_on='_choice', suffixes=('', '_source'))
+    assert (merged['size'] == merged['size_source']).all()
+
+
+def test_build_contrast_seeded():
+    data = make_data()
+
+    first = build_contrast(data, 3, 2, np.random.default_rng(7))
+    second = build_contrast(data, 3, 2, np.random.default_rng(7))
+
+    pd.testing.assert_frame_equal(first, second)
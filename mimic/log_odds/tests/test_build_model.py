@@ -0,0 +1,322 @@
+import os
+import json
+import time
+
+import boto3
+import keras
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras.layers import Dense
+
+from mimic.log_odds.build_tfrecord import record_features, write_tfrecord_shards
+import mimic.log_odds.build_model as build_model
+from mimic.log_odds.build_model import (
+    STACKED_LAYERS,
+    InputStallCallback,
+    build_export_model,
+    build_results,
+    build_stacked_model,
+    build_train_evaluation,
+    load_data,
+    resolve_cache,
+    snapshot_path,
+    train_models,
+)
+
+
+def write_dataset(directory, layout, values, selected, features):
+    float_features, int_features = record_features(features, values, selected, layout)
+    write_tfrecord_shards(float_features, int_features, str(directory / 'data'), max_shard_bytes=2000)
+
+
+@pytest.mark.parametrize("layout", ["columns", "packed"])
+def test_load_data(tmp_path, layout):
+    features = ['f1', 'f2']
+    values = np.arange(30 * 3 * 2, dtype=np.float32).reshape(30, 3, 2)
+    selected = np.arange(30) % 3
+    write_dataset(tmp_path, layout, values, selected, features)
+
+    data = load_data(str(tmp_path), 3, features, batch_size=8, shuffle_buffer_size=100, layout=layout)
+    batches = list(data)
+
+    assert [len(label) for _, label in batches] == [8, 8, 8, 6]
+    inputs = {
+        name: np.concatenate([batch[name].numpy() for batch, _ in batches])
+        for name in batches[0][0]
+    }
+    labels = np.concatenate([label for _, label in batches])
+    assert sorted(inputs) == ['input_0', 'input_1', 'input_2']
+
+    # records come back shuffled so line them up by their first value
+    order = np.argsort(inputs['input_0'][:, 0])
+    for i in range(3):
+        np.testing.assert_array_equal(inputs[f'input_{i}'][order], values[:, i])
+    np.testing.assert_array_equal(labels[order].argmax(axis=1), selected)
+
+
+def test_stacked_model_exports_single_choice_scorer(tmp_path):
+    config = {'model': {}}
+    features = ['f1', 'f2']
+    layers = [Dense(4, activation='relu')]
+    model, layers = build_stacked_model(config, 3, features, layers)
+
+    rng = np.random.default_rng(0)
+    inputs = rng.random((5, 3, 2)).astype(np.float32)
+    mask = np.ones((5, 3), dtype=np.float32)
+    mask[0, 2] = 0.0
+    model.fit({'inputs': inputs, 'mask': mask}, np.eye(3)[[0, 1, 2, 0, 1]], epochs=1, verbose=0)
+
+    path = str(tmp_path / 'model.keras')
+    model.save(path)
+    loaded = keras.models.load_model(path)
+    tower = [layer for layer in loaded.layers if not isinstance(layer, STACKED_LAYERS)]
+    export = build_export_model(features, tower)
+
+    probabilities = loaded.predict({'inputs': inputs, 'mask': mask}, verbose=0)
+    log_odds = export.predict(inputs.reshape(-1, 2), verbose=0).reshape(5, 3)
+    odds = np.exp(log_odds) * mask
+    np.testing.assert_allclose(probabilities, odds / odds.sum(axis=1, keepdims=True), rtol=1e-5, atol=1e-6)
+    assert probabilities[0, 2] == 0.0
+
+
+def test_load_data_stacked(tmp_path):
+    features = ['f1', 'f2']
+    values = np.arange(10 * 3 * 2, dtype=np.float32).reshape(10, 3, 2)
+    selected = np.arange(10) % 3
+    write_dataset(tmp_path, 'columns', values, selected, features)
+
+    data = load_data(str(tmp_path), 3, features, batch_size=10, shuffle_buffer_size=1, layout='columns', stacked=True)
+    inputs, label = next(iter(data))
+
+    order = np.argsort(inputs['inputs'].numpy()[:, 0, 0])
+    np.testing.assert_array_equal(inputs['inputs'].numpy()[order], values)
+    np.testing.assert_array_equal(inputs['mask'].numpy(), np.ones((10, 3)))
+    np.testing.assert_array_equal(label.numpy()[order].argmax(axis=1), selected)
+
+
+def test_load_data_bucketed(tmp_path):
+    features = ['f1']
+    n_choices = np.array([1, 1, 2, 4, 3, 1, 4, 2])
+    values = np.where(np.arange(4)[None, :] < n_choices[:, None], 1.0, -1.0)[:, :, None]
+    values[:, 0, 0] = np.arange(8)
+    float_features, int_features = record_features(features, values, np.zeros(8), 'packed', n_choices)
+    write_tfrecord_shards(float_features, int_features, str(tmp_path / 'data'))
+
+    data = load_data(
+        str(tmp_path), 4, features, batch_size=2, shuffle_buffer_size=1,
+        layout='packed', stacked=True, bucket_boundaries=[1, 2],
+    )
+
+    seen = []
+    for inputs, label in data:
+        mask = inputs['mask'].numpy()
+        counts = n_choices[inputs['inputs'].numpy()[:, 0, 0].astype(int)]
+        # everything in a batch comes from the same bucket and
+        # the batch is only as wide as its largest choice set
+        assert len(set(np.searchsorted([1, 2], counts))) == 1
+        assert mask.shape[1] == counts.max() == label.shape[1]
+        np.testing.assert_array_equal(mask.sum(axis=1), counts)
+        seen.extend(counts)
+    assert sorted(seen) == sorted(n_choices)
+
+
+@pytest.mark.parametrize("cache", ["memory", "disk"])
+def test_load_data_cached(tmp_path, cache):
+    features = ['f1', 'f2']
+    values = np.arange(30 * 3 * 2, dtype=np.float32).reshape(30, 3, 2)
+    selected = np.arange(30) % 3
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    write_dataset(data_dir, 'packed', values, selected, features)
+    cache_dir = str(tmp_path / 'cache')
+
+    for batch_size in [8, 7]:
+        data = load_data(
+            str(data_dir), 3, features, batch_size=batch_size, shuffle_buffer_size=100, layout='packed',
+            stacked=True, cache=cache, cache_dir=cache_dir,
+        )
+        for _ in range(2):
+            batches = list(data)
+            assert [len(label) for _, label in batches] == [batch_size] * (30 // batch_size) + [30 % batch_size]
+            inputs = np.concatenate([batch['inputs'].numpy() for batch, _ in batches])
+            labels = np.concatenate([label for _, label in batches])
+            order = np.argsort(inputs[:, 0, 0])
+            np.testing.assert_array_equal(inputs[order], values)
+            np.testing.assert_array_equal(labels[order].argmax(axis=1), selected)
+
+    # both batch sizes read the same snapshot
+    if cache == 'disk':
+        assert len(os.listdir(cache_dir)) == 1
+    else:
+        assert not os.path.exists(cache_dir)
+
+
+def test_load_data_snapshot_rebuilt(tmp_path):
+    features = ['f1', 'f2']
+    selected = np.arange(30) % 3
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    cache_dir = str(tmp_path / 'cache')
+
+    for offset in [0, 1000]:
+        # rebuilding writes shards with the same names and sizes
+        values = offset + np.arange(30 * 3 * 2, dtype=np.float32).reshape(30, 3, 2)
+        write_dataset(data_dir, 'packed', values, selected, features)
+        data = load_data(
+            str(data_dir), 3, features, batch_size=8, shuffle_buffer_size=100, layout='packed',
+            stacked=True, cache='disk', cache_dir=cache_dir, dataset='dataset',
+        )
+        inputs = np.concatenate([batch['inputs'].numpy() for batch, _ in data])
+        np.testing.assert_array_equal(np.sort(inputs[:, 0, 0]), values[:, 0, 0])
+
+    assert len(os.listdir(cache_dir)) == 2
+    assert (
+        snapshot_path(cache_dir, str(data_dir), 3, features, 'packed', True, 'dataset')
+        != snapshot_path(cache_dir, str(data_dir), 3, features, 'packed', True, 'other')
+    )
+
+
+def test_resolve_cache(tmp_path, monkeypatch):
+    (tmp_path / 'data.tfrecord').write_bytes(b'x' * 1000)
+    monkeypatch.setattr(build_model, 'available_memory_bytes', lambda: 10000)
+    assert resolve_cache('auto', str(tmp_path)) == 'memory'
+    monkeypatch.setattr(build_model, 'available_memory_bytes', lambda: 1000)
+    assert resolve_cache('auto', str(tmp_path)) == 'disk'
+    assert resolve_cache('memory', str(tmp_path)) == 'memory'
+    with pytest.raises(ValueError):
+        resolve_cache('ssd', str(tmp_path))
+
+
+def test_stacked_model_any_width():
+    model, _ = build_stacked_model({'model': {}}, None, ['f1'], [Dense(2)])
+    for width in [2, 5]:
+        inputs = {'inputs': np.ones((3, width, 1)), 'mask': np.ones((3, width))}
+        assert model.predict(inputs, verbose=0).shape == (3, width)
+
+
+def test_stacked_model_jit_compile():
+    model, _ = build_stacked_model({'model': {'jit_compile': True}}, 3, ['f1', 'f2'], [Dense(4)])
+    assert model.jit_compile
+    rng = np.random.default_rng(0)
+    inputs = {'inputs': rng.random((8, 3, 2)).astype(np.float32), 'mask': np.ones((8, 3), dtype=np.float32)}
+    labels = np.eye(3, dtype=np.float32)[rng.integers(0, 3, size=8)]
+    assert np.isfinite(model.train_on_batch(inputs, labels))
+
+
+@pytest.mark.parametrize("settings", [None, {'mode': 'subsample', 'batches': 1, 'every': 2}, {'mode': 'cached'}])
+def test_train_evaluation(settings):
+    rng = np.random.default_rng(0)
+    inputs = {'inputs': rng.random((20, 2, 1)).astype(np.float32), 'mask': np.ones((20, 2), dtype=np.float32)}
+    labels = np.eye(2, dtype=np.float32)[rng.integers(0, 2, size=20)]
+    train = tf.data.Dataset.from_tensor_slices((inputs, labels)).batch(5)
+
+    model, _ = build_stacked_model({'model': {}}, 2, ['f1'], [Dense(2)])
+    history = model.fit(train, epochs=3, verbose=0, callbacks=[build_train_evaluation(train, settings)])
+    results = build_results(history)
+
+    assert len(results) == 3
+    assert (results['train_eval_seconds'] >= 0).all()
+    evaluated = results['train_loss'].notna().tolist()
+    if settings and settings.get('every') == 2:
+        assert evaluated == [False, True, False]
+        assert results['train_eval_seconds'][0] == 0.0
+    else:
+        assert evaluated == [True, True, True]
+
+
+def test_input_stall_callback():
+    rng = np.random.default_rng(0)
+    inputs = {'inputs': rng.random((20, 2, 1)).astype(np.float32), 'mask': np.ones((20, 2), dtype=np.float32)}
+    labels = np.eye(2, dtype=np.float32)[rng.integers(0, 2, size=20)]
+
+    def slow(x):
+        time.sleep(0.01)
+        return x
+
+    train = (
+        tf.data.Dataset.from_tensor_slices((inputs, labels)).batch(5)
+        .map(lambda x, y: (tf.numpy_function(slow, [x['inputs']], tf.float32), x['mask'], y))
+        .map(lambda x, mask, y: ({'inputs': tf.reshape(x, (-1, 2, 1)), 'mask': mask}, y))
+    )
+
+    model, _ = build_stacked_model({'model': {}}, 2, ['f1'], [Dense(2)])
+    stall_callback = InputStallCallback()
+    history = model.fit(stall_callback.watch(train), epochs=2, verbose=0, callbacks=[stall_callback])
+
+    # once traced every batch waits at least 10ms on the input pipeline
+    assert len(history.history['input_stall_seconds']) == 2
+    assert history.history['input_stall_seconds'][-1] >= 0.04
+
+
+def test_load_data_streams_from_s3(tmp_path):
+    moto = pytest.importorskip("moto")
+    features = ['f1', 'f2']
+    values = np.arange(30 * 3 * 2, dtype=np.float32).reshape(30, 3, 2)
+    selected = np.arange(30) % 3
+    write_dataset(tmp_path, 'packed', values, selected, features)
+
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='shards')
+        for path in tmp_path.iterdir():
+            s3.upload_file(str(path), 'shards', f'dataset/train/{path.name}')
+
+        data = load_data('s3://shards/dataset/train/', 3, features, batch_size=8, shuffle_buffer_size=100, layout='packed', stacked=True)
+        batches = list(data)
+
+    inputs = np.concatenate([batch['inputs'].numpy() for batch, _ in batches])
+    order = np.argsort(inputs[:, 0, 0])
+    np.testing.assert_array_equal(inputs[order], values)
+
+
+@pytest.mark.parametrize("order", ["sequential", "round_robin"])
+def test_train_models_group(tmp_path, monkeypatch, order):
+    moto = pytest.importorskip("moto")
+    features = ['f1', 'f2']
+    rng = np.random.default_rng(0)
+    for split in ['train', 'test']:
+        (tmp_path / split).mkdir()
+        write_dataset(tmp_path / split, 'columns', rng.random((40, 3, 2)), rng.integers(0, 3, size=40), features)
+    (tmp_path / 'layers.py').write_text(
+        "from tensorflow.keras.layers import Dense\n"
+        "LAYERS = {'D4': lambda: Dense(4, activation='relu'), 'D8': lambda: Dense(8, activation='relu')}\n"
+    )
+    base = {
+        'experiment_name': 'experiment', 'dataset': 'dataset', 'max_choices': 3, 'features': features,
+        'database': 'haven', 'table': 'results', 'layout': 'columns',
+    }
+    config_paths = []
+    # run b keeps its parsed tensors in memory rather than the records
+    for run_id, layers, epochs, cache in [('a', ['D4'], 2, None), ('b', ['D8', 'D4'], 3, 'memory')]:
+        (tmp_path / 'runs' / run_id).mkdir(parents=True)
+        config = {**base, 'run_id': run_id, 'model': {
+            'batch_size': 10, 'epochs': epochs, 'layers': layers, 'architecture': 'stacked', 'cache': cache,
+        }}
+        (tmp_path / 'runs' / run_id / 'config.json').write_text(json.dumps(config))
+        config_paths.append(f'runs/{run_id}/config.json')
+
+    writes = []
+    monkeypatch.setattr(build_model.db, 'write_data', lambda data, table, partition_cols: writes.append(data))
+    monkeypatch.chdir(tmp_path)
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mimic-log-odds-models')
+        train_models(config_paths, order=order, cache_records=True)
+        keys = sorted(content['Key'] for content in s3.list_objects_v2(Bucket='mimic-log-odds-models')['Contents'])
+
+    assert keys == [
+        'experiment/a/complete.json', 'experiment/a/model.keras', 'experiment/a/model.npz',
+        'experiment/b/complete.json', 'experiment/b/model.keras', 'experiment/b/model.npz',
+    ]
+    assert [results['run_id'].iloc[0] for results in writes] == ['a', 'b']
+    assert [results['epoch'].tolist() for results in writes] == [[1, 2], [1, 2, 3]]
+
+
+def test_train_models_checks_group(tmp_path):
+    for run_id, max_choices in [('a', 3), ('b', 4)]:
+        (tmp_path / f'{run_id}.json').write_text(json.dumps({'dataset': 'dataset', 'max_choices': max_choices}))
+
+    with pytest.raises(ValueError):
+        train_models([str(tmp_path / 'a.json'), str(tmp_path / 'b.json')])
+
@@ -1,12 +1,18 @@
 import os
 
+import numpy as np
 import pandas as pd
+import pytest
+import tensorflow as tf
 from pandas.testing import assert_frame_equal
 
 from mimic.log_odds.build_tfrecord import (
     collapse_choices,
+    collapse_choices_arrays,
+    record_features,
     serialize_row,
     write_tfrecord,
+    write_tfrecord_shards,
 )
 
 def test_collapse_choices():
@@ -31,6 +37,57 @@ def test_collapse_choices():
     assert set(result.columns) == set(expected.columns)
     assert_frame_equal(result[result.columns], expected[result.columns])
 
+def test_collapse_choices_empty():
+    data = pd.DataFrame({
+        '_individual': pd.Series([], dtype=object), '_decision': pd.Series([], dtype=np.int64),
+        '_selected': pd.Series([], dtype=bool), 'feature1': pd.Series([], dtype=np.float64),
+    })
+
+    result = collapse_choices(2, ['feature1'], {'feature1': -1.0}, data)
+
+    assert result.empty
+    assert set(result.columns) == {'_individual', '_decision', '_selected', 'feature1_0', 'feature1_1'}
+    float_features, _ = record_features(['feature1'], np.empty((0, 2, 1)), np.empty(0, dtype=np.int64), 'packed')
+    assert float_features[0][1].shape == (0, 2)
+
+def test_collapse_choices_arrays():
+    # rows arrive out of order, choice order within a decision is kept
+    data = pd.DataFrame([
+        {'_individual': 'b', '_decision': 0, '_selected': True, 'feature1': 0.5},
+        {'_individual': 'a', '_decision': 1, '_selected': False, 'feature1': 0.2},
+        {'_individual': 'a', '_decision': 0, '_selected': True, 'feature1': 0.3},
+        {'_individual': 'a', '_decision': 1, '_selected': True, 'feature1': 0.4},
+    ])
+
+    keys, values, selected, n_choices = collapse_choices_arrays(3, ['feature1'], {'feature1': -1.0}, data)
+
+    assert keys.to_dict('records') == [
+        {'_decision': 0, '_individual': 'a'},
+        {'_decision': 0, '_individual': 'b'},
+        {'_decision': 1, '_individual': 'a'},
+    ]
+    np.testing.assert_array_equal(values[:, :, 0], [[0.3, -1.0, -1.0], [0.5, -1.0, -1.0], [0.2, 0.4, -1.0]])
+    np.testing.assert_array_equal(selected, [0, 0, 1])
+    np.testing.assert_array_equal(n_choices, [1, 1, 2])
+
+@pytest.mark.parametrize("selections", [[False, False], [True, True]])
+def test_collapse_choices_arrays_needs_one_selection(selections):
+    data = pd.DataFrame([
+        {'_individual': 'a', '_decision': 0, '_selected': True, 'feature1': 0.1},
+        {'_individual': 'b', '_decision': 1, '_selected': selections[0], 'feature1': 0.2},
+        {'_individual': 'b', '_decision': 1, '_selected': selections[1], 'feature1': 0.3},
+    ])
+    with pytest.raises(ValueError, match=r"1 decisions .* \(1, b\)"):
+        collapse_choices_arrays(3, ['feature1'], {'feature1': -1.0}, data)
+
+def test_collapse_choices_too_many_choices():
+    data = pd.DataFrame([
+        {'_individual': 'a', '_decision': 0, '_selected': i == 0, 'feature1': 0.1 * i}
+        for i in range(3)
+    ])
+    with pytest.raises(ValueError):
+        collapse_choices(2, ['feature1'], {'feature1': -1.0}, data)
+
 def test_serialize_row():
     data = pd.DataFrame([
         {'_individual': 'a', '_decision': 0, '_selected': 1, 'feature1_0': 0.3, 'feature2_0': 0.4, 'feature1_1': 0.6, 'feature2_1': 0.8, 'feature1_2': -1.0, 'feature2_2': -1.0},
@@ -58,4 +115,43 @@ def test_write_tfrecord():
         if os.path.exists(output_path):
             os.remove(output_path)
 
-    
\ No newline at end of file
+    
+def test_write_tfrecord_matches_serialize_row():
+    data = pd.DataFrame([
+        {'_individual': 'a', '_decision': 0, '_selected': 1, 'feature1_0': 0.3, 'feature2_0': 0.4, 'feature1_1': 0.6, 'feature2_1': 0.8, 'feature1_2': -1.0, 'feature2_2': -1.0},
+        {'_individual': 'a', '_decision': 1, '_selected': 0, 'feature1_0': 0.9, 'feature2_0': 0.3, 'feature1_1': 0.2, 'feature2_1': 0.1, 'feature1_2': 0.6, 'feature2_2': 0.4},
+    ])
+
+    max_choices = 3
+    features = ['feature1', 'feature2']
+    output_path = 'test.tfrecord'
+
+    try:
+        write_tfrecord(max_choices, features, data, output_path)
+        records = [record.numpy() for record in tf.data.TFRecordDataset(output_path)]
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    expected = data.apply(lambda row: serialize_row(max_choices, features, row), axis=1)
+    for record, serialized in zip(records, expected):
+        assert tf.train.Example.FromString(record) == tf.train.Example.FromString(serialized)
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_write_tfrecord_shards(tmp_path, processes):
+    values = np.arange(40 * 2 * 3, dtype=np.float32).reshape(40, 2, 3)
+    selected = np.arange(40) % 2
+    float_features, int_features = record_features(['f1', 'f2', 'f3'], values, selected)
+
+    paths = write_tfrecord_shards(
+        float_features, int_features, str(tmp_path / 'data'),
+        max_shard_bytes=1000, processes=processes, chunk_size=7,
+    )
+
+    assert len(paths) > processes
+    assert all(os.path.getsize(path) <= 1000 for path in paths)
+    records = [record.numpy() for path in paths for record in tf.data.TFRecordDataset(path)]
+    assert len(records) == 40
+    parsed = [tf.train.Example.FromString(record).features.feature for record in records]
+    assert [feature['_selected'].int64_list.value[0] for feature in parsed] == list(selected)
+    assert [feature['f3_1'].float_list.value[0] for feature in parsed] == list(values[:, 1, 2])
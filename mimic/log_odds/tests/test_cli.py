@@ -0,0 +1,11 @@
+import sys
+import subprocess
+
+
+def test_cli_imports_without_tensorflow():
+    # a fresh interpreter, as this one has usually imported tensorflow already
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, mimic.cli; print('tensorflow' in sys.modules)"],
+        capture_output=True, text=True, check=True,
+    )
+    assert result.stdout.strip() == "False"
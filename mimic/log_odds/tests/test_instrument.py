@@ -0,0 +1,60 @@
+import json
+
+import mimic.log_odds.instrument as instrument
+from mimic.log_odds.instrument import METRICS_COLUMNS, JobMetrics
+
+
+def test_job_metrics_stages():
+    metrics = JobMetrics("job", partition=3)
+
+    for rows in [2, 5]:
+        with metrics.stage("read") as counts:
+            counts.update(rows=rows, bytes_read=10 * rows)
+    metrics.count("write", rows=7)
+    items = list(metrics.iterate("wait", iter("ab")))
+
+    record = metrics.record()
+    assert items == ['a', 'b']
+    assert record["job"] == "job"
+    assert record["context"] == {"partition": 3}
+    assert record["stages"]["read"]["rows"] == 7
+    assert record["stages"]["read"]["bytes_read"] == 70
+    assert record["stages"]["read"]["seconds"] >= 0
+    assert record["stages"]["write"] == {"seconds": 0.0, "rows": 7}
+    assert set(record["stages"]["wait"]) == {"seconds"}
+    assert record["peak_rss_mb"] > 0
+
+
+def test_job_metrics_emit(monkeypatch, capsys):
+    writes = []
+    monkeypatch.setattr(
+        instrument.db, 'write_data',
+        lambda data, table, partition_cols: writes.append((data, table, partition_cols)),
+    )
+    metrics = JobMetrics("job", run_id="abc")
+    with metrics.stage("fit") as counts:
+        counts.update(epochs=2)
+
+    metrics.emit()
+    assert json.loads(capsys.readouterr().out)["stages"]["fit"]["epochs"] == 2
+    assert writes == []
+
+    metrics.emit("haven", "job_metrics")
+    data, table, partition_cols = writes[0]
+    assert (table, partition_cols) == ("job_metrics", ['job'])
+    assert json.loads(data['context'].iloc[0]) == {"run_id": "abc"}
+    assert json.loads(data['stages'].iloc[0])["fit"]["epochs"] == 2
+
+
+def test_job_metrics_emit_same_columns(monkeypatch, capsys):
+    writes = []
+    monkeypatch.setattr(instrument.db, 'write_data', lambda data, table, partition_cols: writes.append(data))
+    monkeypatch.delenv("AWS_BATCH_JOB_ID", raising=False)
+
+    JobMetrics("batch_infer", experiment_name="experiment", partitions=[0, 1], train=True).emit("haven", "job_metrics")
+    JobMetrics("build_tfrecord", dataset="dataset", partition=3).emit("haven", "job_metrics")
+
+    assert [list(data.columns) for data in writes] == [METRICS_COLUMNS, METRICS_COLUMNS]
+    assert writes[0].dtypes.tolist() == writes[1].dtypes.tolist()
+    assert writes[0]['batch_job_id'].tolist() == [""]
+    assert json.loads(writes[0]['context'].iloc[0])["partitions"] == [0, 1]
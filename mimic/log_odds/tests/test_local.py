@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from mimic.log_odds.local import run_local, worker_configs
+
+EVENT = {'table': 'features', 'dataset': 'dataset', 'train_partitions': 3, 'test_partitions': 1}
+
+
+def fail_on_partition_one(config):
+    if config['partition'] == 1:
+        raise ValueError(f"bad partition in process {os.getpid()}")
+
+
+def test_worker_configs():
+    configs = worker_configs(EVENT)
+    assert [(c['train'], c['partition'], c['total_partitions']) for c in configs] == [
+        (True, 0, 3), (True, 1, 3), (True, 2, 3), (False, 0, 1),
+    ]
+    assert 'train_partitions' not in configs[0] and configs[0]['dataset'] == 'dataset'
+
+    # an incremental build only runs the partitions that changed
+    incremental = {
+        **EVENT,
+        'partitions': {'train': [2], 'test': []},
+        'manifests': 's3://mimic-log-odds-tfrecords/_manifests/dataset.json',
+    }
+    configs = worker_configs(incremental)
+    assert len(configs) == 1
+    assert configs[0]['partition'] == 2 and configs[0]['manifests'] == incremental['manifests']
+    assert 'partitions' not in configs[0]
+
+
+def test_worker_configs_ranges():
+    configs = worker_configs({**EVENT, 'partitions_per_job': 2}, ranges=True)
+    assert [(c['train'], c['partition_range']) for c in configs] == [
+        (True, [0, 2]), (True, [2, 3]), (False, [0, 1]),
+    ]
+    assert 'partitions_per_job' not in configs[0]
+
+    # planned workers pick their keys from the plan by partition
+    configs = worker_configs({**EVENT, 'partitions_per_job': 2, 'plan': 's3://bucket/plan.json'}, ranges=True)
+    assert [(c['train'], c['partition']) for c in configs] == [(True, 0), (True, 1), (True, 2), (False, 0)]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_run_local_aggregates_failures(processes, capsys):
+    failures = run_local(fail_on_partition_one, worker_configs(EVENT), processes)
+    assert [description for description, _ in failures] == ["train partition 1"]
+    assert "ValueError: bad partition" in failures[0][1]
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 4 and lines[-1].startswith("[4/4]")
+    assert sum("failed" in line for line in lines) == 1
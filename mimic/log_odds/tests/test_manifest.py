@@ -0,0 +1,118 @@
+import json
+
+import boto3
+import pandas as pd
+import pytest
+
+import mimic.log_odds.manifest as manifest_module
+from mimic.log_odds.build_tfrecord import manifest_key
+from mimic.log_odds.manifest import config_fingerprint, incremental_event, load_manifests, resolve_manifest
+
+EVENT = {
+    'database': 'haven', 'table': 'features', 'space': 'mimic-log-odds', 'dataset': 'dataset',
+    'train_partitions': 3, 'test_partitions': 1, 'max_choices': 3, 'features': ['size'],
+    'missing_values_map': {'size': -1},
+}
+
+
+def test_config_fingerprint():
+    assert config_fingerprint(EVENT) == config_fingerprint({**EVENT, 'space': 'other'})
+    assert config_fingerprint(EVENT) != config_fingerprint({**EVENT, 'features': ['size', 'age']})
+    assert config_fingerprint(EVENT) != config_fingerprint({**EVENT, 'train_partitions': 4})
+    assert config_fingerprint(EVENT) != config_fingerprint({**EVENT, 'bucket_column': '_bucket'})
+
+
+def test_incremental_event(monkeypatch):
+    moto = pytest.importorskip("moto")
+    queries = []
+
+    def read_data(sql):
+        queries.append(" ".join(sql.split()))
+        if "not _train" in sql:
+            return pd.DataFrame({'_partition': [0], '_rows': [5], '_checksum': ['AA']})
+        return pd.DataFrame({'_partition': [0, 1, 2], '_rows': [10, 20, 30], '_checksum': ['A0', 'B0', 'C0']})
+
+    monkeypatch.setattr(manifest_module.db, 'read_data', read_data)
+    build = config_fingerprint(EVENT)
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mimic-log-odds-tfrecords')
+        # partition 0 is current, partition 1 changed and test was built with another config
+        for partition, train, current in [(0, True, {'config': build, 'rows': '10-A0'}),
+                                          (1, True, {'config': build, 'rows': '20-OLD'}),
+                                          (0, False, {'config': 'old', 'rows': '5-AA'})]:
+            s3.put_object(
+                Bucket='mimic-log-odds-tfrecords', Key=manifest_key('dataset', partition, train),
+                Body=json.dumps(current),
+            )
+
+        event = incremental_event(EVENT, s3)
+        manifests = load_manifests(event['manifests'], s3)
+
+    assert queries[0].startswith(
+        "select _decision % 3 as _partition, count(*) as _rows, "
+        "to_hex(checksum(row(_decision, _individual, _selected, _train, size))) as _checksum"
+    )
+    assert event['partitions'] == {'train': [1, 2], 'test': [0]}
+    # the manifests are passed on by uri as they can outgrow a payload
+    assert event['manifests'] == 's3://mimic-log-odds-tfrecords/_manifests/dataset.json'
+    assert manifests['train']['2'] == {'config': build, 'rows': '30-C0'}
+    assert manifests['test']['0'] == {'config': build, 'rows': '5-AA'}
+
+
+def test_incremental_event_bucketed(monkeypatch):
+    moto = pytest.importorskip("moto")
+    queries = []
+
+    def read_data(sql):
+        queries.append(" ".join(sql.split()))
+        return pd.DataFrame({'_partition': [0, 2], '_rows': [10, 30], '_checksum': ['A0', 'C0']})
+
+    monkeypatch.setattr(manifest_module.db, 'read_data', read_data)
+    event = {**EVENT, 'table': 'features_bucketed', 'bucket_column': '_bucket', 'partition_key': '_individual'}
+    build = config_fingerprint(event)
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mimic-log-odds-tfrecords')
+        s3.put_object(
+            Bucket='mimic-log-odds-tfrecords', Key=manifest_key('dataset', 0, True),
+            Body=json.dumps({'config': build, 'rows': '10-A0'}),
+        )
+
+        event = incremental_event(event, s3)
+        manifests = load_manifests(event['manifests'], s3)
+
+    # partitions are the buckets repartition wrote, not the partition key modulo
+    assert queries[0].startswith("select _bucket as _partition, count(*) as _rows")
+    assert event['partitions']['train'] == [1, 2]
+    assert manifests['train']['1'] == {'config': build, 'rows': 'empty'}
+
+
+def test_lambda_submits_changed_partitions(load_lambda):
+    function = load_lambda('tfrecords')
+    batch = function.batch
+
+    uri = 's3://mimic-log-odds-tfrecords/_manifests/dataset.json'
+    function.handler({**EVENT, 'partitions': {'train': [2], 'test': []}, 'manifests': uri}, None)
+
+    assert len(batch.jobs) == 1
+    config = json.loads(batch.jobs[0]['containerOverrides']['command'][0])
+    assert (config['partition'], config['total_partitions'], config['train']) == (2, 3, True)
+    assert config['manifests'] == uri and 'partitions' not in config
+
+
+def test_resolve_manifest():
+    moto = pytest.importorskip("moto")
+    config = {'dataset': 'dataset', 'partition': 2, 'train': True}
+    assert resolve_manifest(config) is config
+
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='mimic-log-odds-tfrecords')
+        s3.put_object(
+            Bucket='mimic-log-odds-tfrecords', Key='_manifests/dataset.json',
+            Body=json.dumps({'train': {'2': {'config': 'c', 'rows': '30-C0'}}, 'test': {}}),
+        )
+        resolved = resolve_manifest({**config, 'manifests': 's3://mimic-log-odds-tfrecords/_manifests/dataset.json'})
+
+    assert resolved == {**config, 'manifest': {'config': 'c', 'rows': '30-C0'}}
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from tensorflow.keras.layers import BatchNormalization, Dense, Dropout
+
+from mimic.log_odds.build_model import build_export_model, export_numpy_model
+from mimic.log_odds.numpy_model import ACTIVATIONS, NumpyModel, UnsupportedLayerError
+
+
+@pytest.mark.parametrize("activation", sorted(ACTIVATIONS))
+def test_numpy_model_matches_keras(tmp_path, activation):
+    layers = [
+        Dense(16, activation='relu'),
+        Dropout(0.5),
+        Dense(8, activation=activation),
+        Dense(1, activation='linear', use_bias=False),
+    ]
+    model = build_export_model(['f1', 'f2', 'f3'], layers)
+    path = str(tmp_path / 'model.npz')
+    export_numpy_model(model, path)
+
+    x = np.random.default_rng(0).normal(size=(1000, 3)).astype(np.float32)
+    expected = model.predict(x, verbose=0)
+    result = NumpyModel.load(path).predict(x, batch_size=256)
+
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_export_numpy_model_unsupported(tmp_path):
+    model = build_export_model(['f1'], [Dense(4), BatchNormalization(), Dense(1)])
+    with pytest.raises(UnsupportedLayerError):
+        export_numpy_model(model, str(tmp_path / 'model.npz'))
+
+
+@pytest.mark.parametrize("precision,tolerance", [("float16", 1e-2), ("int8", 5e-2)])
+def test_numpy_model_reduced_precision(tmp_path, precision, tolerance):
+    model = build_export_model(['f1', 'f2', 'f3'], [Dense(16, activation='relu'), Dense(1)])
+    full_path, reduced_path = str(tmp_path / 'full.npz'), str(tmp_path / 'reduced.npz')
+    export_numpy_model(model, full_path)
+    export_numpy_model(model, reduced_path, precision)
+
+    with np.load(reduced_path) as arrays:
+        assert arrays['kernel_0'].dtype == np.dtype(precision)
+
+    x = np.random.default_rng(0).normal(size=(1000, 3)).astype(np.float32)
+    expected = NumpyModel.load(full_path).predict(x)
+    result = NumpyModel.load(reduced_path).predict(x)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, atol=tolerance * np.abs(expected).max())
+
+
+def test_numpy_model_unknown_precision(tmp_path):
+    model = build_export_model(['f1'], [Dense(1)])
+    with pytest.raises(ValueError):
+        export_numpy_model(model, str(tmp_path / 'model.npz'), 'int4')
@@ -0,0 +1,92 @@
+import json
+
+import boto3
+import pandas as pd
+import pytest
+
+import mimic.log_odds.planner as planner
+from mimic.log_odds.planner import build_plan, load_plan, plan_event, plan_partitions, resolve_plan, write_plan
+
+
+def test_plan_partitions_balances_rows():
+    # one individual carries most of the detections
+    weights = {0: 1000, 1: 10, 2: 10, 3: 10, 4: 400, 5: 400, 6: 200}
+
+    plan = plan_partitions(weights, 3)
+
+    loads = sorted(sum(weights[key] for key in keys) for keys in plan.values())
+    assert loads == [430, 600, 1000]
+    assert sorted(key for keys in plan.values() for key in keys) == list(weights)
+
+
+def test_plan_partitions_more_partitions_than_keys():
+    assert plan_partitions({'a': 5}, 3) == {'0': ['a'], '1': [], '2': []}
+
+
+def test_build_plan(monkeypatch):
+    queries = []
+
+    def read_data(sql):
+        queries.append(" ".join(sql.split()))
+        return pd.DataFrame({'_individual': [1, 2, 3], '_rows': [5, 3, 3]})
+
+    monkeypatch.setattr(planner.db, 'read_data', read_data)
+
+    plan = build_plan('haven', 'features', '_individual', 2, 1)
+
+    assert plan == {'key': '_individual', 'train': {'0': [1], '1': [2, 3]}, 'test': {'0': [1, 2, 3]}}
+    assert queries == [
+        "select _individual, count(*) as _rows from features where _train group by _individual",
+        "select _individual, count(*) as _rows from features where not _train group by _individual",
+    ]
+
+
+def test_plan_event(monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setattr(
+        planner.db, 'read_data', lambda sql: pd.DataFrame({'_individual': [1, 2], '_rows': [5, 3]}),
+    )
+    event = {'database': 'haven', 'space': 'mimic-log-odds', 'train_partitions': 2, 'test_partitions': 1}
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='mimic-log-odds-tfrecords')
+
+        planned = plan_event(event, 'tfrecords', 'dataset', 'features')
+
+        # plans live in a bucket the batch job role can read
+        assert planned['plan'] == 's3://mimic-log-odds-tfrecords/_plans/tfrecords/dataset.json'
+        assert load_plan(planned['plan'])['train'] == {'0': [1], '1': [2]}
+
+
+def test_resolve_plan(monkeypatch):
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='plans')
+        write_plan('s3://plans/build-contrast/table.json', {'key': '_individual', 'train': {'0': [1], '1': [2, 3]}, 'test': {'0': [4]}})
+        monkeypatch.setenv('AWS_BATCH_JOB_ARRAY_INDEX', '1')
+
+        config = resolve_plan({'database': 'haven', 'train': True, 'plan': 's3://plans/build-contrast/table.json'})
+
+    assert config == {
+        'database': 'haven', 'train': True, 'partition': 1, 'total_partitions': 2,
+        'partition_key': '_individual', 'keys': [2, 3],
+    }
+
+
+@pytest.mark.parametrize("app", ["tfrecords", "build_contrast", "batch_infer"])
+def test_lambda_submits_array_jobs(load_lambda, app):
+    function = load_lambda(app)
+    batch = function.batch
+
+    event = {
+        'database': 'haven', 'table': 'features', 'source_table': 'features', 'dataset': 'data',
+        'upload_table': 'scores', 'train_partitions': 4, 'test_partitions': 1,
+        'plan': 's3://plans/plan.json',
+    }
+    function.handler(event, None)
+
+    assert len(batch.jobs) == 2
+    assert batch.jobs[0]['arrayProperties'] == {'size': 4}
+    assert 'arrayProperties' not in batch.jobs[1]
+    configs = [json.loads(job['containerOverrides']['command'][0]) for job in batch.jobs]
+    assert [config['train'] for config in configs] == [True, False]
+    assert all(config['plan'] == 's3://plans/plan.json' and 'partition' not in config for config in configs)
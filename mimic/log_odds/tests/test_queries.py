@@ -0,0 +1,126 @@
+import pytest
+
+import mimic.log_odds.batch_infer as batch_infer
+import mimic.log_odds.build_contrast as build_contrast
+import mimic.log_odds.build_tfrecord as build_tfrecord
+import mimic.log_odds.repartition as repartition
+from mimic.log_odds.queries import partition_sql, split_sql, stage_columns
+
+
+def normalize(sql):
+    return " ".join(sql.split())
+
+
+def test_partition_sql():
+    sql = partition_sql('features', 1, 4, True)
+    assert normalize(sql) == "select * from features where _decision % 4 = 1 and _train"
+
+    sql = partition_sql('features', 0, 2, False, key='_individual')
+    assert normalize(sql) == "select * from features where _individual % 2 = 0 and not _train"
+
+
+def test_partition_sql_chunks():
+    sql = partition_sql('features', 1, 4, True, chunk=2, chunks=3)
+    assert normalize(sql) == (
+        "select * from features where _decision % 4 = 1 and _train "
+        "and (_decision / 4) % 3 = 2"
+    )
+
+
+def test_partition_sql_keys():
+    sql = partition_sql('features', 1, 4, False, key='_individual', keys=[3, 7], chunk=1, chunks=2)
+    assert normalize(sql) == (
+        "select * from features where _individual in (3, 7) and not _train "
+        "and _decision % 2 = 1"
+    )
+
+    sql = partition_sql('features', 1, 4, True, key='_individual', keys=["o'neil"])
+    assert normalize(sql) == "select * from features where _individual in ('o''neil') and _train"
+
+    sql = partition_sql('features', 1, 4, True, keys=[])
+    assert normalize(sql) == "select * from features where false and _train"
+
+
+def test_partition_sql_bucketed():
+    sql = partition_sql('features_bucketed', 2, 4, True, keys=[1, 2], bucket_column='_bucket', chunk=0, chunks=2)
+    assert normalize(sql) == "select * from features_bucketed where _bucket = 2 and _train and _decision % 2 = 0"
+
+
+def test_partition_sql_columns():
+    sql = partition_sql('features', 1, 4, True, columns=['_decision', 'size'])
+    assert normalize(sql) == "select _decision, size from features where _decision % 4 = 1 and _train"
+
+    sql = split_sql('features', False, columns=['_decision', 'size'])
+    assert normalize(sql) == "select _decision, size from features where not _train"
+
+
+def test_stage_columns():
+    assert stage_columns(['_decision', '_train'], ['size', '_decision']) == ['_decision', '_train', 'size']
+    assert stage_columns(['_decision', '_train']) is None
+
+
+class StageRead(Exception):
+    pass
+
+
+def first_query(monkeypatch, module, stage, *args, **kwargs):
+    queries = []
+
+    def read_data(sql):
+        queries.append(normalize(sql))
+        raise StageRead()
+
+    monkeypatch.setattr(module.db, 'read_data', read_data)
+    with pytest.raises(StageRead):
+        result = stage(*args, **kwargs)
+        # stages that read lazily only read once they are iterated
+        list(result)
+    return queries[0]
+
+
+def test_build_tfrecord_sql(monkeypatch):
+    sql = first_query(
+        monkeypatch, build_tfrecord, build_tfrecord.build_tfrecord,
+        'haven', 'features', 1, 4, True, 3, ['size', 'age'], {}, 'space', 'dataset',
+    )
+    assert sql == (
+        "select _decision, _individual, _selected, _train, size, age "
+        "from features where _decision % 4 = 1 and _train"
+    )
+
+
+def test_build_contrast_sql(monkeypatch):
+    args = ('haven', 'features', 0, 2, False, 'contrasts', 2, 2)
+
+    sql = first_query(monkeypatch, build_contrast, build_contrast.build_contrast_func, *args, features=['size'])
+    assert sql == (
+        "select _individual, _decision, _choice, _selected, _train, size "
+        "from features where _individual % 2 = 0 and not _train"
+    )
+
+    sql = first_query(monkeypatch, build_contrast, build_contrast.build_contrast_func, *args)
+    assert sql == "select * from features where _individual % 2 = 0 and not _train"
+
+
+def test_batch_infer_sql(monkeypatch):
+    monkeypatch.setattr(batch_infer, 'load_model', lambda *args: None)
+    sql = first_query(
+        monkeypatch, batch_infer, batch_infer.run_inference,
+        'haven', 'features', 1, 4, True, ['size', 'age'], 'scores', 'space', 'experiment', 'run',
+        chunk_rows=None,
+    )
+    assert sql == (
+        "select _individual, _decision, _choice, _selected, _train, size, age "
+        "from features where _decision % 4 = 1 and _train"
+    )
+
+
+def test_repartition_sql(monkeypatch):
+    sql = first_query(
+        monkeypatch, repartition, repartition.repartition,
+        'haven', 'features', 'features_bucketed', 2, 1, features=['size'], chunk_rows=None,
+    )
+    assert sql == (
+        "select _individual, _decision, _choice, _selected, _train, size, _individual % 2 as _bucket "
+        "from features where _train"
+    )
@@ -0,0 +1,109 @@
+import pandas as pd
+import pytest
+
+import mimic.log_odds.repartition as repartition_module
+from mimic.log_odds.repartition import assign_buckets, repartition
+
+
+def test_assign_buckets():
+    data = pd.DataFrame({'_individual': [0, 1, 2, 3, 5]})
+
+    assert assign_buckets(data, 2).tolist() == [0, 1, 0, 1, 1]
+    assert assign_buckets(data, 2, assignments={'0': [5], '1': [0, 1, 2, 3]}).tolist() == [1, 1, 1, 1, 0]
+    with pytest.raises(ValueError):
+        assign_buckets(data, 2, assignments={'0': [0]})
+
+
+def test_repartition_reads_each_split_once(monkeypatch):
+    queries, writes = [], []
+
+    def read_data(sql):
+        queries.append(" ".join(sql.split()))
+        train = "not" not in sql
+        partitions = 3 if train else 2
+        return pd.DataFrame({
+            '_individual': [0, 1, 2], '_train': [train] * 3, '_bucket': [i % partitions for i in range(3)],
+        })
+
+    monkeypatch.setattr(repartition_module.db, 'read_data', read_data)
+    monkeypatch.setattr(
+        repartition_module.db, 'write_data',
+        lambda data, table, partition_cols: writes.append((data.copy(), table, partition_cols)),
+    )
+
+    repartition('haven', 'features', 'features_bucketed', 3, 2, chunk_rows=None)
+
+    assert queries == [
+        "select *, _individual % 3 as _bucket from features where _train",
+        "select *, _individual % 2 as _bucket from features where not _train",
+    ]
+    assert [table for _, table, _ in writes] == ['features_bucketed'] * 2
+    assert [cols for _, _, cols in writes] == [['_train', '_bucket', '_chunk']] * 2
+    assert writes[0][0]['_bucket'].tolist() == [0, 1, 2]
+    assert writes[1][0]['_bucket'].tolist() == [0, 1, 0]
+
+
+def test_repartition_in_chunks(monkeypatch):
+    queries, writes, partitions = [], [], {}
+    rows = pd.DataFrame({'_individual': [0, 1, 2, 3, 4], '_train': [True] * 5})
+
+    def read_data(sql):
+        sql = " ".join(sql.split())
+        queries.append(sql)
+        if "count(*)" in sql:
+            return pd.DataFrame({'_rows': [5 if "not" not in sql else 0]})
+        if "not" in sql:
+            return rows.iloc[:0]
+        chunk = int(sql.split("% 3 = ")[1])
+        data = rows[rows['_individual'] % 3 == chunk].reset_index(drop=True)
+        return data.assign(_bucket=data['_individual'] % 2)
+
+    def write_data(data, table, partition_cols):
+        writes.append(data.copy())
+        # a write replaces the partitions it covers
+        for values, part in data.groupby(partition_cols):
+            partitions[values] = part
+
+    monkeypatch.setattr(repartition_module.db, 'read_data', read_data)
+    monkeypatch.setattr(repartition_module.db, 'write_data', write_data)
+
+    repartition('haven', 'features', 'features_bucketed', 2, 1, chunk_rows=2)
+
+    # 5 rows at 2 rows a chunk is read in 3 chunks, each written on its own
+    assert queries[:4] == [
+        "select count(*) as _rows from features where _train",
+        "select *, _individual % 2 as _bucket from features where _train and _individual % 3 = 0",
+        "select *, _individual % 2 as _bucket from features where _train and _individual % 3 = 1",
+        "select *, _individual % 2 as _bucket from features where _train and _individual % 3 = 2",
+    ]
+    assert queries[4:] == [
+        "select count(*) as _rows from features where not _train",
+        "select *, _individual % 1 as _bucket from features where not _train",
+    ]
+    assert [len(data) for data in writes] == [2, 2, 1]
+    # chunks landing in the same bucket do not overwrite each other
+    written = pd.concat(partitions.values())
+    assert sorted(zip(written['_individual'], written['_bucket'])) == [(0, 0), (1, 1), (2, 0), (3, 1), (4, 0)]
+
+
+def test_repartition_plan(monkeypatch):
+    queries, writes = [], []
+    monkeypatch.setattr(repartition_module, 'load_plan', lambda plan: {
+        'key': '_individual', 'train': {'0': [2], '1': [0, 1]}, 'test': {'0': [0, 1, 2]},
+    })
+
+    def read_data(sql):
+        queries.append(" ".join(sql.split()))
+        return pd.DataFrame({'_individual': [0, 1, 2]})
+
+    monkeypatch.setattr(repartition_module.db, 'read_data', read_data)
+    monkeypatch.setattr(
+        repartition_module.db, 'write_data', lambda data, table, partition_cols: writes.append(data.copy()),
+    )
+
+    repartition('haven', 'features', 'features_bucketed', 2, 1, plan='s3://plans/plan.json', chunk_rows=None)
+
+    # planned buckets are not a function of the key so they are assigned here
+    assert queries[0] == "select * from features where _train"
+    assert writes[0]['_bucket'].tolist() == [1, 1, 0]
+    assert writes[1]['_bucket'].tolist() == [0, 0, 0]
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from mimic.log_odds.reshape import block_to_wide, scatter_choices, wide_columns, wide_to_long
+
+
+def test_wide_columns():
+    assert wide_columns(['a', 'b'], 2) == ['a_0', 'b_0', 'a_1', 'b_1']
+
+
+def test_scatter_choices():
+    block = scatter_choices(
+        np.array([0, 0, 1]), np.array([0, 1, 0]),
+        np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]), 2, np.array([-1.0, -2.0]),
+    )
+
+    assert block.tolist() == [[[1.0, 2.0], [3.0, 4.0]], [[5.0, 6.0], [-1.0, -2.0]]]
+
+
+def test_wide_long_round_trip():
+    block = np.arange(24, dtype=np.float64).reshape(4, 3, 2)
+    keys = pd.DataFrame({'_decision': [0, 1, 2, 3], '_individual': ['a', 'a', 'b', 'c']})
+
+    wide = block_to_wide(keys, block, ['f1', 'f2'])
+
+    assert list(wide.columns) == ['_decision', '_individual', 'f1_0', 'f2_0', 'f1_1', 'f2_1', 'f1_2', 'f2_2']
+    assert wide['f2_1'].tolist() == [3.0, 9.0, 15.0, 21.0]
+    assert np.shares_memory(wide['f2_1'].to_numpy(), block)
+
+    long = wide_to_long(wide, ['f1', 'f2'], 3, id_columns=['_decision'])
+
+    assert list(long.columns) == ['f1', 'f2', '_decision']
+    np.testing.assert_array_equal(long[['f1', 'f2']].to_numpy(), block.reshape(-1, 2))
+    assert long['_decision'].tolist() == [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3]
+
+
+def test_block_to_wide_empty():
+    keys = pd.DataFrame({'_decision': np.array([], dtype=np.int64)})
+
+    wide = block_to_wide(keys, np.empty((0, 2, 1)), ['f'])
+
+    assert list(wide.columns) == ['_decision', 'f_0', 'f_1'] and wide.empty
+
+
+def test_wide_to_long_dtypes_and_padding():
+    wide = pd.DataFrame({
+        '_decision': [0, 1],
+        'f_0': [0.5, 1.5], '_choice_0': [10, 20],
+        'f_1': [2.5, -1.0], '_choice_1': [11, -1],
+    })
+
+    long = wide_to_long(wide, ['f', '_choice'], 2, id_columns=['_decision'], n_choices=[2, 1])
+
+    assert long['_choice'].dtype == np.int64
+    assert long.to_dict('list') == {'f': [0.5, 2.5, 1.5], '_choice': [10, 11, 20], '_decision': [0, 0, 1]}
@@ -0,0 +1,44 @@
+import json
+
+import boto3
+import pytest
+
+from mimic.log_odds.build_model import completed_runs
+
+
+def test_run_experiment_skips_completed_runs(load_lambda):
+    moto = pytest.importorskip("moto")
+
+    config = {
+        'experiment_name': 'experiment', 'dataset': 'dataset', 'group_size': 2,
+        'models': [{'layers': ['D4']}, {'layers': ['D8']}, {'layers': ['D16']}],
+    }
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        for bucket in ['mimic-log-odds-models', 'mimic-log-odds-tfrecords']:
+            s3.create_bucket(Bucket=bucket)
+        s3.put_object(Bucket='mimic-log-odds-models', Key='experiment/config.json', Body=json.dumps(config))
+        s3.put_object(Bucket='mimic-log-odds-models', Key='experiment/layers.py', Body=b'LAYERS = {}')
+        s3.put_object(Bucket='mimic-log-odds-tfrecords', Key='dataset/train/data.tfrecord', Body=b'records')
+
+        function = load_lambda('models', s3=s3)
+
+        def launch(force=False):
+            function.batch.jobs.clear()
+            function.handler({'experiment_name': 'experiment', 'force': force}, None)
+            return [job['containerOverrides']['command'] for job in function.batch.jobs]
+
+        commands = launch()
+        assert [len(command) for command in commands] == [5, 2]
+        first, second, third = commands[0][3:] + commands[1][1:]
+
+        s3.put_object(Bucket='mimic-log-odds-models', Key=f'experiment/{first}/complete.json', Body=b'{}')
+        assert completed_runs('experiment', s3) == {first}
+        assert launch() == [['--order', 'sequential', 'experiment', second, third]]
+        assert launch(force=True)[0] == ['--order', 'sequential', '--force', 'experiment', first, second]
+
+        # a rebuilt dataset changes every run_id
+        s3.put_object(Bucket='mimic-log-odds-tfrecords', Key='dataset/train/data.tfrecord', Body=b'new records')
+        commands = launch()
+        assert first not in commands[0] + commands[1]
+        assert [len(command) for command in commands] == [5, 2]
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from mimic.log_odds.shards import frame_records, write_records
+
+
+def test_frame_records_matches_tensorflow(tmp_path):
+    rng = np.random.default_rng(0)
+    # records of a length mostly share their bytes, as encoded Examples do
+    prefix = bytes(rng.integers(0, 256, size=40, dtype=np.uint8))
+    records = [prefix + bytes(rng.integers(0, 256, size=8, dtype=np.uint8)) for _ in range(50)]
+    records += [b"", b"a", b"ab", prefix]
+
+    path = str(tmp_path / 'data.tfrecord')
+    with tf.io.TFRecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    with open(path, 'rb') as f:
+        expected = f.read()
+
+    assert b"".join(frame_records(records)) == expected
+
+
+def test_write_records_framings_match(tmp_path):
+    records = [[bytes([i]) * (i % 7) for i in range(30)], [b"last"]]
+
+    written = {}
+    for framing in ["tensorflow", "numpy"]:
+        paths = write_records(iter(records), str(tmp_path / framing), max_shard_bytes=100, framing=framing)
+        written[framing] = [open(path, 'rb').read() for path in paths]
+
+    assert len(written['tensorflow']) > 1
+    assert written['numpy'] == written['tensorflow']
+    with pytest.raises(ValueError):
+        write_records(iter(records), str(tmp_path / 'other'), framing='other')
@@ -0,0 +1,17 @@
+import pandas as pd
+
+from mimic.log_odds.synthetic import feature_names, make_choices
+
+
+def test_make_choices():
+    data = make_choices(20, 3, 5, 4, min_choices=2, seed=1)
+
+    assert list(data.columns) == ['_individual', '_decision', '_choice', '_selected', '_train'] + feature_names(4)
+    sizes = data.groupby('_decision').size()
+    assert len(sizes) == 60
+    assert sizes.between(2, 5).all()
+    assert (data.groupby('_decision')['_selected'].sum() == 1).all()
+    assert (data.groupby('_individual')['_train'].nunique() == 1).all()
+    assert data['_choice'].is_unique
+
+    pd.testing.assert_frame_equal(data, make_choices(20, 3, 5, 4, min_choices=2, seed=1))
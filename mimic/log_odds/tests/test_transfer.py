@@ -0,0 +1,82 @@
+import os
+
+import boto3
+import pytest
+
+from mimic.log_odds.transfer import download_prefix, iter_s3_records
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='shards')
+        yield client
+
+
+def test_download_prefix_paginates(s3, tmp_path):
+    for i in range(1005):
+        s3.put_object(Bucket='shards', Key=f'dataset/train/partition={i}/data.tfrecord', Body=b'x' * 10)
+    s3.put_object(Bucket='shards', Key='dataset/test/partition=0/data.tfrecord', Body=b'y')
+
+    stats = download_prefix('shards', 'dataset/train/', str(tmp_path / 'train'), cache_dir=None, s3=s3)
+
+    assert stats['files'] == 1005
+    assert stats['bytes'] == stats['downloaded_bytes'] == 10050
+    assert len(os.listdir(tmp_path / 'train')) == 1005
+
+
+def test_download_prefix_cache(s3, tmp_path):
+    for i in range(3):
+        s3.put_object(Bucket='shards', Key=f'dataset/train/partition={i}/data.tfrecord', Body=f'shard{i}'.encode())
+    cache_dir = str(tmp_path / 'cache')
+    destination = str(tmp_path / 'train')
+
+    first = download_prefix('shards', 'dataset/train/', destination, cache_dir=cache_dir, s3=s3)
+    second = download_prefix('shards', 'dataset/train/', destination, cache_dir=cache_dir, s3=s3)
+    s3.put_object(Bucket='shards', Key='dataset/train/partition=1/data.tfrecord', Body=b'changed')
+    third = download_prefix('shards', 'dataset/train/', destination, cache_dir=cache_dir, s3=s3)
+
+    assert first['downloaded_bytes'] == 18
+    assert second['downloaded_bytes'] == 0
+    assert third['downloaded_bytes'] == len(b'changed')
+    contents = sorted(open(os.path.join(destination, path), 'rb').read() for path in os.listdir(destination))
+    assert contents == [b'changed', b'shard0', b'shard2']
+
+
+def test_download_prefix_only_shards_and_prunes(s3, tmp_path):
+    for i in range(2):
+        s3.put_object(Bucket='shards', Key=f'dataset/train/data-{i}.tfrecord', Body=f'shard{i}'.encode())
+    s3.put_object(Bucket='shards', Key='dataset/train/0-manifest.json', Body=b'{}')
+    s3.put_object(Bucket='shards', Key='dataset/test/data-0.tfrecord', Body=b'test')
+    cache_dir = str(tmp_path / 'cache')
+
+    download_prefix('shards', 'dataset/test/', str(tmp_path / 'test'), cache_dir=cache_dir, s3=s3)
+    first = download_prefix('shards', 'dataset/train/', str(tmp_path / 'train'), cache_dir=cache_dir, s3=s3)
+    s3.delete_object(Bucket='shards', Key='dataset/train/data-1.tfrecord')
+    second = download_prefix('shards', 'dataset/train/', str(tmp_path / 'train'), cache_dir=cache_dir, s3=s3)
+
+    assert first['files'] == 2 and first['pruned_files'] == 0
+    assert second['files'] == 1 and second['pruned_files'] == 1
+    assert os.listdir(tmp_path / 'train') == ['part0-data-0.tfrecord']
+    assert len(os.listdir(os.path.join(cache_dir, 'shards', 'dataset/train/'))) == 1
+    # other prefixes keep their entries
+    assert len(os.listdir(os.path.join(cache_dir, 'shards', 'dataset/test/'))) == 1
+
+
+def test_iter_s3_records(s3, tmp_path):
+    tf = pytest.importorskip("tensorflow")
+    path = str(tmp_path / 'data.tfrecord')
+    records = [b'a' * i for i in range(0, 300, 7)]
+    with tf.io.TFRecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    s3.upload_file(path, 'shards', 'dataset/data.tfrecord')
+
+    assert list(iter_s3_records(s3, 'shards', 'dataset/data.tfrecord', read_ahead_bytes=64)) == records
+
+    s3.put_object(Bucket='shards', Key='dataset/broken.tfrecord', Body=open(path, 'rb').read()[:-3])
+    with pytest.raises(ValueError):
+        list(iter_s3_records(s3, 'shards', 'dataset/broken.tfrecord'))
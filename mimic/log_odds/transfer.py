@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mimic", "shards")
+
+
+def list_objects(s3, bucket, prefix):
+    """
+    Returns every object under the prefix, following pagination
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    return [
+        content
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for content in page.get('Contents', [])
+    ]
+
+
+def cache_path(cache_dir, content):
+    etag = content['ETag'].strip('"')
+    return os.path.join(cache_dir, f"{etag}-{content['Size']}")
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def fetch_object(s3, bucket, content, destination, cache_dir=None):
+    """
+    Downloads a single object to `destination`, going through the
+    content addressed cache in `cache_dir` if one is given
+
+    Returns the number of bytes actually downloaded
+    """
+    if cache_dir is None:
+        s3.download_file(bucket, content['Key'], destination)
+        return content['Size']
+
+    cached = cache_path(cache_dir, content)
+    downloaded = 0
+    if not os.path.exists(cached):
+        # download next to the cache entry and move it into place
+        # so an interrupted download never looks like a cache hit
+        partial = f"{cached}.{os.getpid()}.{id(content)}.partial"
+        s3.download_file(bucket, content['Key'], partial)
+        os.replace(partial, cached)
+        downloaded = content['Size']
+    link_or_copy(cached, destination)
+    return downloaded
+
+
+def prune_cache(cache_dir, contents):
+    """
+    Removes the entries of `cache_dir` that are not one of `contents`,
+    downloads still in progress are left alone
+
+    Returns the number of entries removed
+    """
+    current = {os.path.basename(cache_path(cache_dir, content)) for content in contents}
+    stale = [
+        name for name in os.listdir(cache_dir)
+        if name not in current and not name.endswith(".partial")
+    ]
+    for name in stale:
+        os.remove(os.path.join(cache_dir, name))
+    return len(stale)
+
+
+def download_prefix(bucket, prefix, destination, cache_dir=DEFAULT_CACHE_DIR, max_workers=8, s3=None):
+    """
+    Inputs:
+    - bucket: str, bucket to download from
+    - prefix: str, prefix of the keys to download
+    - destination: str, directory to (re)create and download into
+    - cache_dir: str, directory of the shard cache keyed by ETag,
+      None to always download
+    - max_workers: int, number of concurrent downloads
+    - s3: boto3 s3 client, created if not given
+
+    Downloads the .tfrecord files under the prefix. Each prefix has its
+    own directory in the cache, and the shards that are no longer under
+    the prefix are removed from it once the download is done.
+
+    Returns a dict of transfer statistics
+    """
+    s3 = s3 or boto3.client('s3')
+    start = time.perf_counter()
+
+    contents = [
+        content for content in list_objects(s3, bucket, prefix)
+        if content['Key'].endswith(".tfrecord")
+    ]
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    os.makedirs(destination)
+    if cache_dir is not None:
+        cache_dir = os.path.join(cache_dir, bucket, prefix)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _fetch(item):
+        i, content = item
+        path = os.path.join(destination, f"part{i}-{content['Key'].split('/')[-1]}")
+        return fetch_object(s3, bucket, content, path, cache_dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded = list(executor.map(_fetch, enumerate(contents)))
+    pruned = prune_cache(cache_dir, contents) if cache_dir is not None else 0
+
+    seconds = time.perf_counter() - start
+    return {
+        "prefix": prefix,
+        "files": len(contents),
+        "pruned_files": pruned,
+        "bytes": sum(content['Size'] for content in contents),
+        "downloaded_bytes": sum(downloaded),
+        "seconds": seconds,
+        "downloaded_mb_per_second": sum(downloaded) / 1e6 / seconds if seconds else 0.0,
+    }
+
+
+def parse_s3_uri(uri):
+    bucket, _, prefix = uri[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def iter_s3_records(s3, bucket, key, read_ahead_bytes=1 << 20):
+    """
+    Streams the records of a TFRecord file in S3 without staging it on
+    disk, reading `read_ahead_bytes` at a time. Each record is framed as
+    a little endian uint64 length, a uint32 crc of the length, the data
+    and a uint32 crc of the data. The crcs are not checked here.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    buffer = bytearray()
+    offset = 0
+    try:
+        for chunk in body.iter_chunks(chunk_size=read_ahead_bytes):
+            buffer += chunk
+            while len(buffer) - offset >= 12:
+                (length,) = struct.unpack_from("<Q", buffer, offset)
+                end = offset + 12 + length + 4
+                if len(buffer) < end:
+                    break
+                yield bytes(buffer[offset + 12:end - 4])
+                offset = end
+            del buffer[:offset]
+            offset = 0
+    finally:
+        body.close()
+    if buffer:
+        raise ValueError(f"truncated record in s3://{bucket}/{key}")
+
+
+def report(stats):
+    print(json.dumps(stats))